@@ -1,12 +1,16 @@
-from pygrametl.tables import Dimension,FactTable, BulkDimension, CachedDimension
+import pygrametl
+from pygrametl import getdbfriendlystr
+from pygrametl.tables import Dimension,FactTable, BulkDimension, BulkFactTable, CachedDimension, SlowlyChangingDimension, TypeOneSlowlyChangingDimension
 
 from pyelt.datalayers.dv import *
 
 
 class Dim(AbstractOrderderTable):
+    """Dimensie in een datamart. Bij het bijwerken van een bestaand lid (gevonden op de _lookup_fields) worden de velden overschreven (SCD type 1); voor historie zie :class:`Scd2Dim`."""
     id = Columns.SerialColumn()
     _lookup_fields = []
     __dbschema__ = 'dm'
+    __scd_type__ = 1
 
     @classmethod
     def cls_create_dbname(cls):
@@ -31,7 +35,9 @@ class Dim(AbstractOrderderTable):
         return lookup_fields
 
     @classmethod
-    def cls_to_pygram_dim(cls, schema_name, lookup_fields = []):
+    def cls_to_pygram_dim(cls, schema_name, lookup_fields = [], prefill = False):
+        """
+        :param prefill: alle sleutels in één keer in het geheugen laden, zodat lookups geen queries meer doen"""
         # cls.cls_init_cols()
         # if not lookup_fields:
 
@@ -42,7 +48,9 @@ class Dim(AbstractOrderderTable):
                 key='id',
                 attributes= cls.cls_get_column_names_no_id(),
                 lookupatts = lookup_fields,
-                cachefullrows=True)
+                size = 0 if prefill else 10000,
+                prefill = prefill,
+                cachefullrows= not prefill)
         else:
             dim = Dimension(
                 name=schema_name + '.' + cls.cls_get_name(),
@@ -51,18 +59,55 @@ class Dim(AbstractOrderderTable):
         return dim
 
     @classmethod
-    def cls_to_pygram_bulk_dim(cls, schema_name, lookup_fields = [], bulkloader = None):
-        cls.cls_init_cols()
+    def cls_to_pygram_bulk_dim(cls, schema_name, lookup_fields = [], bulkloader = None, bulksize = 50000, strconverter = getdbfriendlystr):
+        """BulkDimension: houdt alle rijen van de dim in het geheugen en schrijft nieuwe rijen per bulksize weg met de bulkloader."""
+        if not lookup_fields:
+            lookup_fields = cls.cls_get_lookup_fields()
         dim = BulkDimension(
-            name = schema_name + '.' + 'dim_patient',
+            name = schema_name + '.' + cls.cls_get_name(),
             key = 'id',
             attributes = cls.cls_get_column_names_no_id(),
             lookupatts = lookup_fields,
-            bulksize = 50000,
-            nullsubst = '0',  # anders kan bulkdimension er niet mee omgaan
+            bulksize = bulksize,
+            nullsubst = '\\N',  # NULL in het tekstformaat van COPY
+            strconverter = strconverter,
             bulkloader = bulkloader)
         return dim
 
+    @classmethod
+    def cls_get_scd_column_names(cls):
+        """Namen van de kolommen die de versies van een lid bijhouden (alleen bij :class:`Scd2Dim`)"""
+        return []
+
+    @classmethod
+    def cls_to_pygram_scd_dim(cls, schema_name):
+        """Dimensie voor het bijwerken van bestaande leden met scdensure: bij SCD type 1 worden gewijzigde velden overschreven, bij type 2 komt er een nieuwe versie. De nieuwste versie van alle leden wordt in één keer in het geheugen geladen."""
+        lookup_fields = cls.cls_get_lookup_fields()
+        attributes = cls.cls_get_column_names_no_id()
+        if cls.__scd_type__ == 2:
+            dim = SlowlyChangingDimension(
+                name=schema_name + '.' + cls.cls_get_name(),
+                key='id',
+                attributes=attributes,
+                lookupatts=lookup_fields,
+                versionatt='_version',
+                fromatt='_valid_from',
+                fromfinder=pygrametl.now,
+                toatt='_valid_to',
+                cachesize=-1,
+                prefill=True)
+        else:
+            dim = TypeOneSlowlyChangingDimension(
+                name=schema_name + '.' + cls.cls_get_name(),
+                key='id',
+                attributes=attributes,
+                lookupatts=lookup_fields,
+                type1atts=[name for name in attributes if name not in lookup_fields],
+                cachesize=-1,
+                prefill=True,
+                cachefullrows=True)
+        return dim
+
     @classmethod
     def cls_to_pygram_mapping(cls):
         d = {}
@@ -72,7 +117,22 @@ class Dim(AbstractOrderderTable):
         return d
 
 
+class Scd2Dim(Dim):
+    """Dimensie met historie (SCD type 2): bij een wijziging krijgt een lid een nieuwe rij met het volgende _version nummer. De vorige versie krijgt een _valid_to; de actuele versie heeft _valid_to NULL."""
+    __scd_type__ = 2
+    _version = Columns.IntColumn(default_value=1)
+    _valid_from = Columns.DateTimeColumn()
+    _valid_to = Columns.DateTimeColumn()
+
+    @classmethod
+    def cls_get_scd_column_names(cls):
+        return ['_version', '_valid_from', '_valid_to']
+
+
 class Fact(AbstractOrderderTable):
+    """Fact in een datamart. Met _partition_fields (kolommen van de fact die rechtstreeks uit de bron komen) wordt de fact bij een incrementele verversing alleen opnieuw afgeleid voor de waardes van die kolommen waarin iets is gewijzigd."""
+    _partition_fields = []
+
     @classmethod
     def cls_create_dbname(cls):
         full_name = cls.__qualname__
@@ -100,6 +160,10 @@ class Fact(AbstractOrderderTable):
                 list_col_names.append(col.fk)
         return list_col_names
 
+    @classmethod
+    def cls_get_partition_fields(cls):
+        return [col.name for col in cls._partition_fields]
+
     @classmethod
     def cls_to_pygram_fact(cls, schema_name):
         fct = FactTable(
@@ -108,6 +172,19 @@ class Fact(AbstractOrderderTable):
             measures=cls.cls_get_measure_names())
         return fct
 
+    @classmethod
+    def cls_to_pygram_bulk_fact(cls, schema_name, bulkloader = None, bulksize = 50000, strconverter = getdbfriendlystr):
+        """BulkFactTable: schrijft de rijen per bulksize weg met de bulkloader."""
+        fct = BulkFactTable(
+            name=schema_name + '.' + cls.cls_get_name(),
+            keyrefs=cls.cls_get_key_names(),
+            measures=cls.cls_get_measure_names(),
+            bulksize=bulksize,
+            nullsubst='\\N',  # NULL in het tekstformaat van COPY
+            strconverter=strconverter,
+            bulkloader=bulkloader)
+        return fct
+
 
 class DmReference(FkReference):
     def __init__(self, dim_cls, fk_name = ''):
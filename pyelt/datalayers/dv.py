@@ -35,6 +35,23 @@ class AbstractOrderderTable(Table, metaclass=OrderedTableMetaClass):
         key = [col.name for col in cls.__cols__ if col.is_key]
         return key
 
+def hash_key_sql(bk_sql: str) -> str:
+    """Sql-expressie voor de hash key van een business key: de eerste 64 bits van md5(bk) als bigint. Geeft NULL als bk NULL is.
+
+    Wordt bij 'hash_keys' in de config gebruikt als _id van hubs en links, zodat sor, hubs, sats en links de _id zelf kunnen uitrekenen zonder de hub op te zoeken.
+
+    Twee verschillende bk's met dezelfde hash zijn bij 64 bits onwaarschijnlijk maar niet onmogelijk; bij het laden van een hub wordt daarop gecontroleerd en een botsing als fout gelogd."""
+    return "('x' || substr(md5(({})::text), 1, 16))::bit(64)::bigint".format(bk_sql)
+
+
+def hashdiff_sql(field_sqls: List[str]) -> str:
+    """Sql-expressie voor de _hashdiff van een sat-rij: md5 over alle velden als uuid (16 bytes, vaste breedte).
+
+    Elk veld telt mee met zijn lengte ervoor en NULL als '-', net als :func:`pyelt.helpers.hashing.row_hash`, zodat (NULL, 'a') en ('a', NULL) of ('a', 'bc') en ('ab', 'c') verschillende hashes geven."""
+    parts = ["COALESCE(length(({0})::text) || ':' || ({0})::text, '-')".format(field_sql) for field_sql in field_sqls]
+    return "md5({})::uuid".format(' || '.join(parts))
+
+
 class DvTable(AbstractOrderderTable):
     """Basis abstracte tabel voor alle datavault tabellen. Deze bevat de vast velden die in alle datavault tabellen nodig zijn."""
     _id = Columns.SerialColumn()
@@ -59,6 +76,7 @@ class Sat(DvTable):
     _finish_date = Columns.TextColumn()
     _active = Columns.BoolColumn(default_value=True, indexed=True)
     _revision = Columns.IntColumn()
+    _hashdiff = Column('_hashdiff', 'uuid')
     # wordt aangemaakt in metaclass: hub = FkReference(Hub, _id)
 
 
@@ -139,6 +157,8 @@ class HubEntity(metaclass=HubEntityMetaClass):
     __dbschema__ = 'dv'
     __dbname__ = ''
     __subtype__ = ''
+    __pit__ = False
+    __materialize__ = False
 
     class Hub(Hub):
         pass
@@ -161,6 +181,17 @@ class HubEntity(metaclass=HubEntityMetaClass):
         view_name = cls.__name__.lower().replace('_entity', '').replace('entity', '') + '_view'
         return view_name
 
+    @classmethod
+    def cls_get_pit_name(cls) -> str:
+        return cls.__name__.lower().replace('_entity', '').replace('entity', '') + '_pit'
+
+    @classmethod
+    def cls_get_pit(cls) -> 'PitTable':
+        """Point-in-time tabel van de entity, als __pit__ = True: per hub _id en run de _runid van de actieve rij van elke sat."""
+        if '__pit_cls__' not in cls.__dict__:
+            cls.__pit_cls__ = create_pit_table(cls.cls_get_pit_name(), cls.__dbschema__, cls.cls_get_sats())
+        return cls.__pit_cls__
+
     @classmethod
     def cls_get_schema(cls, dwh) -> 'Schema':
         schema = dwh.get_schema(cls.__dbschema__)
@@ -193,6 +224,7 @@ class LinkEntity(metaclass=LinkEntityMetaClass):
     """Een link entity is een link met 0, 1 of meerdere sats"""
     __dbschema__ = 'dv'
     __dbname__= ''
+    __bridge__ = False
     class Link(Link):
         pass
 
@@ -208,6 +240,19 @@ class LinkEntity(metaclass=LinkEntityMetaClass):
     def cls_get_name(cls) ->str:
         return cls.__name__.lower().replace('_link', '') + '_link'
 
+    @classmethod
+    def cls_get_bridge_name(cls) -> str:
+        return camelcase_to_underscores(cls.__name__).replace('_link', '').replace('_entity', '') + '_bridge'
+
+    @classmethod
+    def cls_get_bridge(cls) -> 'PitTable':
+        """Bridge tabel van de link entity, als __bridge__ = True: per link _id en run het type, de fk's naar de hubs en de _runid van de actieve rij van elke sat."""
+        if '__bridge_cls__' not in cls.__dict__:
+            fk_names = [link_ref.fk for link_ref in cls.Link.cls_get_link_refs().values()]
+            extra_columns = [col for col in cls.Link.cls_get_columns() if col.name == 'type' or col.name in fk_names]
+            cls.__bridge_cls__ = create_pit_table(cls.cls_get_bridge_name(), cls.Link.__dbschema__, cls.cls_get_sats(), extra_columns)
+        return cls.__bridge_cls__
+
     @classmethod
     def cls_get_sats(cls) -> Dict[str, Sat]:
         return cls.__sats__
@@ -225,6 +270,41 @@ class LinkEntity(metaclass=LinkEntityMetaClass):
 
 
 
+class PitTable(AbstractOrderderTable):
+    """Point-in-time tabel van een entity, of bridge tabel van een link entity.
+
+    Bevat per _id en snapshot (_runid van de run) de _runid van de op dat moment actieve rij van elke sat. Alleen de rij van de laatste snapshot is _active.
+    Wordt aangemaakt met :func:`create_pit_table`; __sat_columns__ bevat per kolom de sat (en bij een HybridSat het type) waar hij naar verwijst."""
+    _id = Columns.IntColumn(pk=True)
+    _runid = Columns.FloatColumn(pk=True)
+    _snapshot_date = Columns.DateTimeColumn()
+    _active = Columns.BoolColumn(default_value=True)
+
+
+def create_pit_table(name: str, schema_name: str, sats: Dict[str, Sat], extra_columns: List[Column] = []) -> PitTable:
+    """Maakt de PitTable-class voor de gegeven sats. Per sat komt er een kolom {sat}_runid, per type van een HybridSat {sat}_{type}_runid.
+
+    :param extra_columns: kolommen die uit de hub of link worden overgenomen, zoals de fk's van een link in een bridge"""
+    classdict = OrderedDict()
+    for col in extra_columns:
+        classdict[col.name] = Column(col.name, type=col.type)
+    sat_columns = OrderedDict()
+    for sat_cls in sats.values():
+        if issubclass(sat_cls, HybridSat):
+            for type in sat_cls.cls_get_types():
+                sat_columns['{}_{}_runid'.format(sat_cls.cls_get_short_name(), type).replace(' ', '_')] = (sat_cls, type)
+        else:
+            sat_columns['{}_runid'.format(sat_cls.cls_get_short_name())] = (sat_cls, '')
+    for col_name in sat_columns:
+        classdict[col_name] = Columns.FloatColumn()
+    pit_cls = OrderedTableMetaClass(name, (PitTable,), classdict)
+    pit_cls.__dbname__ = name
+    pit_cls.__dbschema__ = schema_name
+    pit_cls.name = name
+    pit_cls.__sat_columns__ = sat_columns
+    return pit_cls
+
+
 class EnsembleView():
-    pass
+    __materialize__ = False
 #####################################
@@ -37,7 +37,13 @@ class Dwh(Database):
         self.config = config  # type: Dict[str, str]
         if 'conn_dwh' in self.config:
             conn_string = self.config['conn_dwh']  # type: str
-            super().__init__(conn_string)
+            pool_size = 5
+            if 'pool_size' in self.config and self.config['pool_size']:
+                pool_size = int(self.config['pool_size'])
+            max_overflow = 10
+            if 'max_overflow' in self.config:
+                max_overflow = int(self.config['max_overflow'])
+            super().__init__(conn_string, pool_size=pool_size, max_overflow=max_overflow)
         self.schemas = {}
         self.schemas['dv'] = Schema('dv', self, DwhLayerTypes.DV)  # type: Schema
         self.schemas['valset'] = Schema('valset', self, DwhLayerTypes.VALSET)  # type: Schema
@@ -51,6 +57,22 @@ class Dwh(Database):
             self.schemas[name] = sor
         return sor
 
+    def use_hash_keys(self) -> bool:
+        """Met 'hash_keys' in de config is de _id van hubs en links een hash van de business key (zie :func:`pyelt.datalayers.dv.hash_key_sql`) in plaats van een volgnummer. Kies dit bij het aanmaken van een nieuwe dwh; bestaande tabellen worden niet omgezet."""
+        return 'hash_keys' in self.config and self.config['hash_keys']
+
+    def use_key_side_tables(self) -> bool:
+        """Met 'sor_key_resolution': 'side_table' in de config worden de _id's van hubs en links per sor-rij bewaard in een smalle tabel {sor_table}_keys, in plaats van in fk-kolommen in de (brede) sor-tabel. Bij hash keys is dit niet nodig."""
+        return 'sor_key_resolution' in self.config and self.config['sor_key_resolution'] == 'side_table' and not self.use_hash_keys()
+
+    def use_dv_delta_mode(self) -> bool:
+        """Met 'dv_delta_mode' in de config leest elke hub-, sat- en link-mapping alleen de sor-rijen met een _runid na de laatste run die de mapping verwerkte (bewaard in sys.watermarks). Met 'dv_full_reconcile' worden eenmalig weer alle rijen gelezen."""
+        return 'dv_delta_mode' in self.config and self.config['dv_delta_mode'] and not ('dv_full_reconcile' in self.config and self.config['dv_full_reconcile'])
+
+    def use_datamart_delta_mode(self) -> bool:
+        """Met 'datamart_delta_mode' in de config verwerkt elke datamart alleen de hubs en links die na de vorige verversing (bewaard in sys.watermarks) zijn gewijzigd. Met 'datamart_full_refresh' worden eenmalig weer alle dims en facts volledig ververst."""
+        return 'datamart_delta_mode' in self.config and self.config['datamart_delta_mode'] and not ('datamart_full_refresh' in self.config and self.config['datamart_full_refresh'])
+
     def get_schema(self, name=''):
         found = None
         if name in self.schemas:
@@ -141,6 +163,18 @@ class Dwh(Database):
         WITH (
           OIDS=FALSE
         );
+
+        CREATE TABLE sys.watermarks
+        (
+          name text NOT NULL,
+          value text,
+          runid numeric(8,2),
+          date timestamp without time zone,
+          CONSTRAINT watermarks_pkey PRIMARY KEY (name)
+        )
+        WITH (
+          OIDS=FALSE
+        );
         INSERT INTO sys.runs (runid, rundate) VALUES (0, now());
         """ #type: str
 
@@ -166,6 +200,24 @@ class Dwh(Database):
             self.execute(sql, 'insert version')
         return new_version_number
 
+    def get_watermark(self, name: str) -> str:
+        """Geeft de laatst opgeslagen waarde voor name uit sys.watermarks, of None"""
+        sql = """SELECT value FROM sys.watermarks WHERE name = '{}'""".format(name.replace("'", "''"))
+        rows = self.execute_read(sql, 'get watermark')
+        if len(rows) > 0:
+            return rows[0][0]
+        else:
+            return None
+
+    def set_watermark(self, name: str, value: str, runid: float) -> None:
+        params = {'name': name.replace("'", "''"), 'value': value.replace("'", "''"), 'runid': runid}
+        if self.get_watermark(name) is not None:
+            sql = """UPDATE sys.watermarks SET value = '{value}', runid = {runid}, date = now() WHERE name = '{name}'""".format(**params)
+            self.execute(sql, 'update watermark')
+        else:
+            sql = """INSERT INTO sys.watermarks (name, value, runid, date) VALUES ('{name}', '{value}', {runid}, now());""".format(**params)
+            self.execute(sql, 'insert watermark')
+
     def confirm_execute(self, sql: str, log_message: str='') -> None:
         ask_confirm = False
         if 'ask_confirm_on_db_changes' in self.config:
@@ -34,7 +34,6 @@ class SorQuery(Table):
 
     def reflect(self):
         self.columns = []
-        cursor = self.db.engine.raw_connection().cursor()
 
         sql = self.sql + ' OFFSET 0 ROWS FETCH NEXT 1 ROWS ONLY'
 
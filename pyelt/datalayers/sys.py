@@ -18,3 +18,11 @@ class Sys():
         schemaname = Columns.TextColumn(pk=True,unique=True)
         version = Columns.FloatColumn(unique=True)
         date = Columns.DateTimeColumn()
+
+    class Watermarks(AbstractOrderderTable):
+        """Laatst geladen waarde (high-water mark) per incrementeel geladen mapping"""
+        __dbschema__ = 'sys'
+        name = Columns.TextColumn(pk=True, unique=True)
+        value = Columns.TextColumn()
+        runid = Columns.FloatColumn()
+        date = Columns.DateTimeColumn()
@@ -1,4 +1,4 @@
-
+from typing import Any
 
 
 def camelcase_to_underscores(string):
@@ -13,3 +13,19 @@ def camelcase_to_underscores(string):
 
     return string
 
+
+def strip_where(filter: str) -> str:
+    """Haalt alleen een WHERE aan het begin van het filter weg; een WHERE verderop (bijvoorbeeld in een subquery) blijft staan."""
+    filter = filter.strip()
+    if filter[:5].upper() == 'WHERE' and (len(filter) == 5 or not (filter[5].isalnum() or filter[5] == '_')):
+        filter = filter[5:].strip()
+    return filter
+
+
+def copy_text_value(value: Any, nullsubst: str = '\\N') -> str:
+    """Zet een waarde om naar het tekstformaat van COPY ... FROM STDIN: backslash, tab en regeleinden worden ge-escaped, None wordt nullsubst."""
+    if value is None:
+        return nullsubst
+    if isinstance(value, bool):
+        return 't' if value else 'f'
+    return str(value).replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
@@ -0,0 +1,45 @@
+"""Hashing van rijen in de etl in plaats van in de bron (hash_mode 'etl').
+
+De hash is onafhankelijk van het soort bron: een rij uit Oracle, SQL Server, MySQL, Postgres of een bestand met dezelfde waardes geeft dezelfde hash."""
+import datetime
+import hashlib
+from decimal import Decimal
+from typing import Any, Iterable, List, Sequence
+
+
+def canonical_value(value: Any) -> str:
+    """Zet een waarde (niet None) om naar een vaste tekstrepresentatie. Getallen worden genormaliseerd (1, 1.0 en Decimal('1.00') worden '1'), datums in iso-formaat."""
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    if isinstance(value, (int, float, Decimal)):
+        number = Decimal(repr(value)) if isinstance(value, float) else Decimal(value)
+        if not number.is_finite():
+            return str(number)
+        if number == number.to_integral_value():
+            return str(number.quantize(Decimal(1)))
+        return format(number.normalize(), 'f')
+    if isinstance(value, (datetime.datetime, datetime.date, datetime.time)):
+        return value.isoformat()
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return bytes(value).hex()
+    return str(value)
+
+
+def row_hash(values: Sequence[Any]) -> str:
+    """blake2b hash (32 hex-tekens, even lang als md5) van de waardes van een rij"""
+    # elke waarde met lengte ervoor, zodat ('a', 'bc') en ('ab', 'c') verschillen; NULL als '-', anders dan een lege string ('0:')
+    canonical = ''
+    for value in values:
+        if value is None:
+            canonical += '-'
+        else:
+            text = canonical_value(value)
+            canonical += '{}:{}'.format(len(text), text)
+    return hashlib.blake2b(canonical.encode('utf8'), digest_size=16).hexdigest()
+
+
+def hash_rows(rows: Iterable[Sequence[Any]], field_names: List[str], key_names: List[str]):
+    """Generator die van elke rij alleen de sleutelvelden en de hash van alle velden teruggeeft, zoals SourceTable.load(md5_only=True)"""
+    key_indexes = [field_names.index(key_name) for key_name in key_names]
+    for row in rows:
+        yield tuple(row[index] for index in key_indexes) + (row_hash(row),)
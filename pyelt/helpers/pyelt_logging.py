@@ -1,4 +1,5 @@
 import logging
+import threading
 from datetime import datetime
 from time import sleep
 
@@ -38,6 +39,9 @@ class ConsoleColors:
     END = '\033[0m'
 
 class Logger:
+    # per thread wordt bijgehouden voor welke pipe er gelogd wordt, zodat bij parallelle runs de log leesbaar blijft
+    _context = threading.local()
+
     def __init__(self):
         self.logger = None #type: logging.logger
         self.start_time = datetime.now()  # type: datetime.datetime
@@ -98,7 +102,19 @@ class Logger:
 
         return path, filename
 
+    @staticmethod
+    def set_context(name: str) -> None:
+        """Zet de naam (bv. de pipe) waarmee alle log-regels van de huidige thread worden voorafgegaan."""
+        Logger._context.name = name
+
+    @staticmethod
+    def get_context() -> str:
+        return getattr(Logger._context, 'name', '')
+
     def log_simple(self, msg: str) -> None:
+        context = Logger.get_context()
+        if context:
+            msg = '[{}] {}'.format(context, msg)
         self.logger.info(self.strip_formatting_tags(msg))
         if self.to_console:
             Logger.pprint(msg)
@@ -122,6 +138,9 @@ class Logger:
                 descr = '-' + descr
             for i in range(indent_level):
                 descr = ' ' + descr
+            context = Logger.get_context()
+            if context:
+                descr = '<darkcyan>[{}]</> {}'.format(context, descr)
             for i in range(len(self.strip_formatting_tags(descr)), 60):
                 # uitvullen tot 50 positities
                 descr += ' '
@@ -145,6 +164,9 @@ class Logger:
                 err_msg += str(arg)
         while err_msg.endswith('\n'):
             err_msg = err_msg[:-1]
+        context = Logger.get_context()
+        if context:
+            log_msg = '[{}] {}'.format(context, log_msg)
         msg = """
 <red>==========================================================================
 ERROR tijdens : {}
@@ -1,11 +1,33 @@
+from typing import List, Tuple, Union
+
 from pyelt.datalayers.database import Column
 from pyelt.datalayers.dm import Dim, DmReference
-from pyelt.datalayers.dv import HubEntity, Hub
+from pyelt.datalayers.dv import HubEntity, Hub, LinkEntity
 from pyelt.mappings.base import BaseTableMapping, FieldMapping
 from pyelt.mappings.transformations import FieldTransformation
 
 
-class DvToDimMapping(BaseTableMapping):
+class BaseDvToDmMapping(BaseTableMapping):
+    def __init__(self, source, target):
+        super().__init__(source, target)
+        self.change_keys = [] #type: List[Tuple[str, Union[HubEntity, LinkEntity]]]
+
+    def track_changes(self, source_field: str, dv_cls: Union[HubEntity, LinkEntity]) -> None:
+        """Geeft aan dat source_field in de bron-query de _id van een hub of link van dv_cls bevat. Bij een incrementele verversing worden dan alleen de rijen gelezen waarvan de hub of link, of een van de sats, na de vorige verversing is gewijzigd.
+
+        Voorbeeld::
+
+            mapping = DvToFactMapping(sql, FactBehandeling)
+            mapping.track_changes('patient_id', Patient)
+            mapping.track_changes('behandeling_id', BehandelingLinkEntity)
+        """
+        self.change_keys.append((source_field, dv_cls))
+
+    def get_change_keys(self) -> List[Tuple[str, Union[HubEntity, LinkEntity]]]:
+        return self.change_keys
+
+
+class DvToDimMapping(BaseDvToDmMapping):
     def __init__(self, source, target):
         # if not isinstance(source, str) and issubclass(source, HubEntity):
         #     source.cls_init_sats()
@@ -28,7 +50,17 @@ class DvToDimMapping(BaseTableMapping):
                 d[field_mapping.target.name] = field_mapping.source.name
         return d
 
-    def generate_sql(self, dwh):
+    def get_change_keys(self) -> List[Tuple[str, Union[HubEntity, LinkEntity]]]:
+        # bij een entity als bron is de hub zelf de sleutel (zie generate_sql)
+        if not isinstance(self.source, str) and issubclass(self.source, HubEntity):
+            return [('_id', self.source)]
+        return self.change_keys
+
+    def generate_sql(self, dwh, filter: str = ''):
+        """:param filter: alleen bij een entity als bron: filter op de hub, met alias hub"""
+        if isinstance(self.source, str):
+            # de bron is een query, bijvoorbeeld zoals gemaakt door de MappingWriter
+            return self.source
         if not issubclass(self.source, HubEntity):
             return ""
         entity = self.source #type: HubEntity
@@ -39,7 +71,9 @@ class DvToDimMapping(BaseTableMapping):
         params['schema'] = dv_schema
         params['hub'] = entity.cls_get_hub_name()
         params['join'] = self.__get_join(dv_schema)
-        sql = """SELECT {fields} FROM {schema}.{hub} AS hub {join}""".format(**params)
+        params['filter'] = filter if filter else '1=1'
+        sql = """SELECT {fields} FROM {schema}.{hub} AS hub {join}
+WHERE {filter}""".format(**params)
         return sql
 
     def __get_fields(self):
@@ -114,9 +148,10 @@ class DvToDmFieldMapping(FieldMapping):
         self.table = target
         self.source_type = source_type
 
-class DvToFactMapping(BaseTableMapping):
+class DvToFactMapping(BaseDvToDmMapping):
     def __init__(self, source, target,automap = False):
         super().__init__(source, target)
+        self.lookup_mappings = [] #type: List[Tuple[List[str], DmReference]]
 
 
     def map_field(self, source: str, target: str = '', transform_func: 'FieldTransformation'=None, ref: str = '') -> None:
@@ -134,9 +169,16 @@ class DvToFactMapping(BaseTableMapping):
                 d[field_mapping.target.get_fk_field_name()] = field_mapping.source.name
         return d
 
-    def map_lookup_field(self, source: str, dim_reference: DmReference):
-        dim = dim_reference.ref_table
-        dim._lookup_fields
+    def map_lookup_field(self, source: Union[str, List[str]], dim_reference: DmReference):
+        """De fk naar de dim wordt bij het laden opgezocht met de waarde(s) van source in de _lookup_fields van de dim (in dezelfde volgorde)."""
+        if isinstance(source, str):
+            source = [source]
+        self.lookup_mappings.append((source, dim_reference))
+
+    def generate_sql(self, dwh):
+        if isinstance(self.source, str):
+            return self.source
+        return ""
 
     def map_function(self, get_bronsysteem_id, fk_grouperdatum):
         pass
@@ -8,7 +8,7 @@ from pyelt.mappings.base import BaseTableMapping
 
 
 class SourceToSorMapping(BaseTableMapping):
-    def __init__(self, source: Union['SourceTable', 'SourceQuery', 'File'], target: Union[str, Table], auto_map: bool = True, filter='', ignore_fields: List[str] = []) -> None:
+    def __init__(self, source: Union['SourceTable', 'SourceQuery', 'File'], target: Union[str, Table], auto_map: bool = True, filter='', ignore_fields: List[str] = [], hash_mode: str = '', watermark_column: str = '') -> None:
         #todo transformations
         if isinstance(source, File):
             self.file_name = source.file_name
@@ -30,6 +30,10 @@ class SourceToSorMapping(BaseTableMapping):
         self.ignore_fields = ignore_fields
         # self.field_mappings = [] #type: List[FieldMapping]
         self.auto_map = auto_map
+        # 'source' of 'etl', leeg: uit config (zie EtlSourceToSor.get_hash_mode)
+        self.hash_mode = hash_mode
+        # kolom in de bron die alleen oploopt (bijv. modified_at of een volgnummer); alleen rijen na de vorige hoogste waarde worden geladen
+        self.watermark_column = watermark_column.lower()
         if auto_map: self.create_auto_mappings(source, ignore_fields)
 
 
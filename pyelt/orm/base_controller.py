@@ -1,15 +1,21 @@
-from typing import List
+from collections import OrderedDict
+from typing import Any, Dict, Iterable, List, Union
 
-from pyelt.datalayers.database import DBStatus
-from pyelt.datalayers.dv import DvEntity, Sat
+from pyelt.datalayers.dv import HubEntity, HybridSat, Sat
 from pyelt.datalayers.dwh import Dwh
+from pyelt.helpers.exceptions import PyeltException
+from pyelt.orm.dv_objects import DBStatus, DbSession, Row, chunks, close_pit_rows, close_sat_row, get_field_names, get_row_class, insert_hub_row, insert_sat_row, load_active_sat_rows, save_hub_rows, save_sat_rows
+
+DvEntity = HubEntity
 
 
 class Controller:
     entity_cls = DvEntity
+    chunk_size = 10000  #: aantal entities per query bij :meth:`load`
 
     def __init__(self, dwh: 'Dwh'):
         self.dwh = dwh
+        self.session = DbSession()  #: sessie met identity map; None als er geen DbSession is aangemaakt
 
     def new(self, bk='', runid=0) -> DvEntity:
         entity = self.entity_cls()
@@ -17,11 +23,9 @@ class Controller:
         entity.__dict__['bk'] = bk
         entity.__dict__['_runid'] = runid
         entity.__dict__['type'] = self.entity_cls.cls_get_name()
-        for sat_name, sat_cls in self.__class__.entity_cls.cls_get_sats().items():
-            sat = sat_cls()
-            sat.__dict__['_id'] = 0
-            sat.__dict__['dbstatus'] = DBStatus.initialised
-            entity.__dict__[sat_name.lower()] = sat
+        for sat_cls in self.__class__.entity_cls.cls_get_sats().values():
+            sat = self.create_sat(sat_cls)
+            entity.__dict__[sat_cls.cls_get_short_name()] = sat
             setattr(sat_cls, 'load', self.load_sat)
         return entity
 
@@ -81,17 +85,124 @@ class Controller:
             return_list.append(entity)
         return return_list
 
+    def load(self, filter='', sats: List[Union[str, Sat]] = None, chunk_size: int = 0) -> List[DvEntity]:
+        """Laadt de entities met de opgegeven sats direct erbij (eager loading).
+
+        Per chunk van chunk_size entities wordt elke sat met één query opgehaald (_id = ANY(...)), in plaats van één query per sat per entity bij :meth:`load_by_hub`. Overige sats worden zoals bij load_by_hub pas bij gebruik geladen.
+
+        Voorbeeld::
+
+            patienten.load("bk LIKE '12%'", sats=[Patient.Personalia, 'adres'])
+
+        :param sats: sat classes of (korte) namen van sats; None is alle sats van de entity behalve HybridSats. Een HybridSat heeft per _id een actieve rij per type en kan niet vooraf worden geladen; die wordt bij gebruik geladen voor het type van de sat (zie :meth:`load_sat`)
+        :param chunk_size: aantal entities per query, standaard :attr:`chunk_size`
+        """
+        return_list = []
+        for chunk in self.iter_load(filter, sats, chunk_size):
+            return_list.extend(chunk)
+        return return_list
+
+    def iter_load(self, filter='', sats: List[Union[str, Sat]] = None, chunk_size: int = 0) -> Iterable[List[DvEntity]]:
+        """Zelfde als :meth:`load`, maar geeft de entities per chunk terug, zodat niet alle entities tegelijk in het geheugen staan"""
+        if not filter:
+            filter = '1 = 1'
+        if not chunk_size:
+            chunk_size = self.chunk_size
+        sat_classes = self.__get_sat_classes(sats)
+        params = {'dv': self.dwh.dv.name, 'hub': self.entity_cls.cls_get_hub_name(), 'filter': filter, 'chunk_size': chunk_size, 'last_id': None}
+        while True:
+            # pagineren op _id, zodat elke chunk een korte query is zonder open cursor
+            params['filter_page'] = '_id > {last_id}'.format(**params) if params['last_id'] is not None else '1 = 1'
+            sql = """SELECT * FROM {dv}.{hub} WHERE ({filter}) AND {filter_page} ORDER BY _id LIMIT {chunk_size}""".format(**params)
+            hub_rows = self.dwh.execute_read(sql, 'load {}'.format(params['hub']))
+            if not hub_rows:
+                return
+            ids = [row['_id'] for row in hub_rows]
+            sat_rows = {sat_cls: self.load_sats(sat_cls, ids) for sat_cls in sat_classes}
+            yield [self.__create_entity(row, sat_rows) for row in hub_rows]
+            if len(hub_rows) < chunk_size:
+                return
+            params['last_id'] = ids[-1]
+
+    def load_sats(self, sat_cls: Sat, ids: List[int]) -> Dict[int, Row]:
+        """Haalt de actieve rijen van de sat op voor alle ids in één query. Niet voor een HybridSat: die heeft per _id meerdere actieve rijen (één per type).
+
+        Rijen die al in de identity map van de :class:`DbSession` staan worden niet opnieuw opgehaald. Net als daar zijn de rijen :class:`Row`'s, ook als ze door :class:`pyelt.orm.dv_objects.SatData` zijn geladen."""
+        if issubclass(sat_cls, HybridSat):
+            raise PyeltException('{} is een HybridSat en kan niet per _id worden geladen'.format(sat_cls.cls_get_name()))
+        sat_name = sat_cls.cls_get_name()
+        rows = {}
+        missing = []
+        for id in ids:
+            row = self.session.get_row(sat_name, id) if self.session else None
+            if row is None:
+                missing.append(id)
+            else:
+                rows[id] = row
+        for chunk in chunks(missing, self.chunk_size):
+            for db_row in load_active_sat_rows(self.dwh, self.dwh.dv.name, sat_name, chunk, [col.name for col in sat_cls.cls_get_columns()]):
+                if db_row['_id'] not in rows:
+                    row = get_row_class(sat_name, db_row.keys())(db_status=DBStatus.loaded, **db_row)
+                    rows[row._id] = row
+                    if self.session:
+                        self.session.add_rows(sat_name, [row])
+        return rows
+
+    def __get_sat_classes(self, sats: List[Union[str, Sat]] = None) -> List[Sat]:
+        entity_sats = self.entity_cls.cls_get_sats()
+        if sats is None:
+            return [sat_cls for sat_cls in entity_sats.values() if not issubclass(sat_cls, HybridSat)]
+        sat_names = {sat_name.lower(): sat_cls for sat_name, sat_cls in entity_sats.items()}
+        sat_names.update({sat_cls.cls_get_short_name(): sat_cls for sat_cls in entity_sats.values()})
+        sat_classes = [sat_names[sat.lower()] if isinstance(sat, str) else sat for sat in sats]
+        for sat_cls in sat_classes:
+            if issubclass(sat_cls, HybridSat):
+                raise PyeltException('{} is een HybridSat en kan niet vooraf worden geladen'.format(sat_cls.cls_get_name()))
+        return sat_classes
+
+    def __create_entity(self, row, sat_rows: Dict[Sat, Dict[int, Row]]) -> DvEntity:
+        entity = self.entity_cls()
+        entity.__dict__['dbstatus'] = DBStatus.loaded
+        for field_name, field_value in row.items():
+            entity.__dict__[field_name] = field_value
+        for sat_cls in self.entity_cls.cls_get_sats().values():
+            sat = self.create_sat(sat_cls, row['_id'])
+            if sat_cls in sat_rows:
+                if row['_id'] in sat_rows[sat_cls]:
+                    self.__set_sat_fields(sat, sat_rows[sat_cls][row['_id']])
+                else:
+                    sat.__dict__['dbstatus'] = DBStatus.new
+            else:
+                setattr(sat_cls, 'load', self.load_sat)
+            entity.__dict__[sat_cls.cls_get_short_name()] = sat
+        return entity
+
+    @staticmethod
+    def __set_sat_fields(sat: Sat, row: Row) -> None:
+        for field_name, field_value in row.as_dict().items():
+            if field_name != 'db_status':
+                sat.__dict__[field_name] = field_value
+        sat.__dict__['dbstatus'] = DBStatus.loaded
+
+    @staticmethod
+    def create_sat(sat_cls: Sat, id: int = 0) -> Sat:
+        """Lege sat als container voor de velden. De Table-constructor wordt overgeslagen; die is alleen nodig voor de ddl."""
+        sat = sat_cls.__new__(sat_cls)
+        sat.__dict__['_id'] = id
+        sat.__dict__['dbstatus'] = DBStatus.initialised
+        return sat
+
     def load_sat(self, sat):
-        print(sat.cls_get_name())
-        params = {'dv': 'dv', 'sat': sat.__class__.cls_get_name(), 'id': sat._id}
-        sql = """SELECT * FROM {dv}.{sat} WHERE _id = {id} AND _active""".format(**params)
-        print(sql)
-        rows = self.dwh.execute_read(sql, '')
+        """Laadt de actieve rij van één sat. Bij een HybridSat de rij van het type van de sat (sat.type), buiten de identity map om."""
+        if isinstance(sat, HybridSat):
+            sat_name = sat.__class__.cls_get_name()
+            field_names = [col.name for col in sat.__class__.cls_get_columns()]
+            db_rows = [db_row for db_row in load_active_sat_rows(self.dwh, self.dwh.dv.name, sat_name, [sat._id], field_names) if db_row['type'] == sat.__dict__.get('type')]
+            rows = [get_row_class(sat_name, db_row.keys())(db_status=DBStatus.loaded, **db_row) for db_row in db_rows]
+        else:
+            rows = list(self.load_sats(sat.__class__, [sat._id]).values())
         if rows:
-            row = rows[0]  # {'voornaam': 'asd', 'achternaam': 'asdahgd'}
-            for field_name, field_value in row.items():
-                sat.__dict__[field_name] = field_value
-            sat.__dict__['dbstatus'] = DBStatus.loaded
+            self.__set_sat_fields(sat, rows[0])
         else:
             sat.__dict__['dbstatus'] = DBStatus.new
 
@@ -101,18 +212,43 @@ class Controller:
         else:
             self.save_entity(value)
 
-    def save_entities(self, value):
-        pass
+    def save_entities(self, entities: List[DvEntity], source_system='sys'):
+        """Slaat alle entities in één transactie op: eerst alle nieuwe hubs in één keer, daarna per sat alle nieuwe en gewijzigde rijen in één versioneringsslag (zie :func:`pyelt.orm.dv_objects.save_sat_rows`)."""
+        with self.dwh.transaction():
+            new_entities = [entity for entity in entities if entity.dbstatus == DBStatus.new]
+            if new_entities:
+                rows = [{'bk': entity.bk, 'type': entity.type, '_runid': entity._runid, '_source_system': source_system} for entity in new_entities]
+                ids = save_hub_rows(self.dwh, self.dwh.dv.name, self.entity_cls.cls_get_hub_name(), rows)
+                for entity in new_entities:
+                    entity._id = ids[entity.bk]
+                if self.session:
+                    self.session.set_hub_ids(self.entity_cls.cls_get_hub_name(), ids)
+            sat_rows = OrderedDict()  # type: Dict[Sat, List[Dict[str, Any]]]
+            for entity in entities:
+                for sat in entity.__dict__.values():
+                    if not isinstance(sat, Sat) or not self.__is_pending(entity, sat):
+                        continue
+                    row = {name: sat.__dict__[name] for name in get_field_names(sat.__dict__)}
+                    row.update({'_id': entity._id, '_runid': sat.__dict__.get('_runid', entity._runid), '_source_system': source_system})
+                    sat_rows.setdefault(sat.__class__, []).append(row)
+            for sat_cls, rows in sat_rows.items():
+                save_sat_rows(self.dwh, self.dwh.dv.name, sat_cls.cls_get_name(), rows, hybrid=issubclass(sat_cls, HybridSat))
+                if self.session:
+                    self.session.invalidate(sat_cls.cls_get_name(), [row['_id'] for row in rows])
+            if sat_rows:
+                self.close_pits(list(OrderedDict.fromkeys(row['_id'] for rows in sat_rows.values() for row in rows)))
+            for entity in entities:
+                entity.__dict__['dbstatus'] = DBStatus.loaded
+
+    @staticmethod
+    def __is_pending(entity: DvEntity, sat: Sat) -> bool:
+        # bij een nieuwe entity telt elke sat waarin iets is ingevuld
+        if sat.dbstatus in (DBStatus.new, DBStatus.changed):
+            return True
+        return entity.dbstatus == DBStatus.new and len(get_field_names(sat.__dict__)) > 0
 
     def save_entity(self, entity):
-        # entity = self.check_changed(entity)
-        if entity.dbstatus == DBStatus.new:
-            self.save_new_hub(entity)
-        for sat_name, sat in entity.sats().items():
-            if sat.dbstatus == DBStatus.new:
-                self.save_new_sat(entity, sat)
-            elif sat.dbstatus == DBStatus.changed:
-                self.save_sat(sat)
+        self.save_entities([entity])
 
     def save_entity_old(self, entity):
         # entity = self.check_changed(entity)
@@ -137,72 +273,37 @@ class Controller:
         return entity
 
     def save_new_hub(self, entity, source_system='sys'):
-        params = {}
-        params['dv'] = self.dwh.dv.name
-        params['hub'] = entity.__class__.cls_get_hub_name()
-        params['_runid'] = entity._runid
-        params['_source_system'] = source_system
-        params['type'] = entity.type
-        params['bk'] = entity.bk
-        params['fixed_field_names'] = "_runid, _source_system, _insert_date, _valid, _validation_msg, type, bk"
-        params['fixed_values'] = "{_runid}, '{_source_system}', now(), True, '', '{type}', '{bk}'".format(**params)
-        sql = """INSERT INTO {dv}.{hub} ({fixed_field_names}) SELECT {fixed_values}
-WHERE NOT EXISTS (SELECT 1 FROM {dv}.{hub} WHERE bk='{bk}') RETURNING _id;""".format(**params)
-        print(sql)
-        result = self.dwh.execute_returning(sql, 'INSERT HUB')
-        id = result[0][0]
-        entity._id = id
+        values = {'_runid': entity._runid, '_source_system': source_system, 'type': entity.type, 'bk': entity.bk}
+        entity._id = insert_hub_row(self.dwh, self.dwh.dv.name, entity.__class__.cls_get_hub_name(), values)
 
     def save_sat(self, sat, source_system='sys'):
-        params = {}
-        params['dv'] = self.dwh.dv.name
-        params['sat'] = sat.__class__.cls_get_name()
-        field_names = ''
-        field_values = ''
-        for fld_name, fld_value in sat.__dict__.items():
-            if not (fld_name.startswith('_') or fld_name == 'dbstatus'):
-                field_names += fld_name + ', '
-                field_values += "'{}', ".format(fld_value)
-        field_names = field_names[:-2]
-        field_values = field_values[:-2]
-        params['fixed_field_names'] = "_id, _runid, _active, _source_system, _insert_date, _finish_date, _revision, _valid, _validation_msg, _hash"
-        params['_id'] = sat._id
-        params['_runid'] = sat._runid
-        params['_source_system'] = source_system
-        params['_revision'] = sat._revision
-        params['fixed_values'] = "{_id}, {_runid} + 0.01, True, '{_source_system}', now(), NULL, {_revision} + 1, True, '', ''".format(**params)
-        params['field_names'] = field_names
-        params['values'] = field_values
-        params['type'] = ''
-        sql = """UPDATE {dv}.{sat} SET _active = False, _finish_date = Now() WHERE _id = {_id} AND _runid = {_runid};
-
-INSERT INTO {dv}.{sat} ({fixed_field_names}, {field_names}) VALUES ({fixed_values}, {values});""".format(**params)
-        self.dwh.execute(sql, 'INSERT SAT')
+        dv_schema = self.dwh.dv.name
+        sat_name = sat.__class__.cls_get_name()
+        with self.dwh.transaction():
+            close_sat_row(self.dwh, dv_schema, sat_name, sat._id, sat._runid)
+            values = {name: sat.__dict__[name] for name in get_field_names(sat.__dict__)}
+            values.update({'_id': sat._id, '_runid': float(sat._runid) + 0.01, '_source_system': source_system, '_revision': sat._revision + 1})
+            insert_sat_row(self.dwh, dv_schema, sat_name, values)
+            self.close_pits([sat._id])
         # sql = """UPDATE {dv}.{sat} previous SET _active = FALSE, _finish_date = current._insert_date
         #                 FROM {dv}.{sat} current WHERE previous._active = TRUE AND previous._id = current._id AND current._revision = (previous._revision + 1);""".format(
         #     **params)
         # self.dwh.execute(sql, '  update sat set old ones inactive')
 
     def save_new_sat(self, hub, sat, source_system='sys'):
-        params = {}
-        params['dv'] = self.dwh.dv.name
-        params['sat'] = sat.__class__.cls_get_name()
-        params['_id'] = hub._id
-        params['_runid'] = hub._runid
-        params['_source_system'] = source_system
-        params['_revision'] = 1
-        field_names = ''
-        field_values = ''
-        for fld_name, fld_value in sat.__dict__.items():
-            if not (fld_name.startswith('_') or fld_name == 'dbstatus'):
-                field_names += fld_name + ', '
-                field_values += "'{}', ".format(fld_value)
-        field_names = field_names[:-2]
-        field_values = field_values[:-2]
-        params['fixed_field_names'] = "_id, _runid, _active, _source_system, _insert_date, _finish_date, _revision, _valid, _validation_msg, _hash"
-        params['fixed_values'] = "{_id}, {_runid}, True, '{_source_system}', now(), NULL, {_revision}, True, '', ''".format(**params)
-        params['field_names'] = field_names
-        params['values'] = field_values
-        params['type'] = ''
-        sql = """INSERT INTO {dv}.{sat} ({fixed_field_names}, {field_names}) VALUES ({fixed_values}, {values});""".format(**params)
-        self.dwh.execute(sql, 'INSERT SAT')
+        values = {name: sat.__dict__[name] for name in get_field_names(sat.__dict__)}
+        values.update({'_id': hub._id, '_runid': hub._runid, '_source_system': source_system, '_revision': 1})
+        insert_sat_row(self.dwh, self.dwh.dv.name, sat.__class__.cls_get_name(), values)
+        self.close_pits([hub._id])
+
+    def close_pits(self, ids: List[int]) -> None:
+        """Na het wijzigen van sats zijn de pit-rijen van ids verouderd: die van de entity zelf, van de entities waar hij van afleidt en van zijn subclasses (die hebben dezelfde hub en deels dezelfde sats)."""
+        entity_classes = [cls for cls in self.entity_cls.__mro__ if issubclass(cls, HubEntity) and cls is not HubEntity]
+        subclasses = list(self.entity_cls.__subclasses__())
+        while subclasses:
+            cls = subclasses.pop()
+            entity_classes.append(cls)
+            subclasses += cls.__subclasses__()
+        for cls in entity_classes:
+            if cls.__pit__:
+                close_pit_rows(self.dwh, self.dwh.dv.name, cls.cls_get_pit_name(), ids)
@@ -1,9 +1,194 @@
-from pyelt.datalayers.database import Column
+import hashlib
+from collections import OrderedDict
+from typing import Any, Dict, Iterable, List, Tuple
 
+from pyelt.datalayers.database import Column
+from pyelt.datalayers.dv import hash_key_sql
 from pyelt.datalayers.dwh import Dwh
+from pyelt.helpers.exceptions import PyeltException
+
+
+def chunks(items: List[Any], chunk_size: int) -> Iterable[List[Any]]:
+    """Deelt items op in lijsten van hoogstens chunk_size"""
+    for index in range(0, len(items), chunk_size):
+        yield items[index:index + chunk_size]
+
+
+def statement_name(operation: str, dv_schema: str, table_name: str, field_names: Iterable[str] = ()) -> str:
+    """Naam van het prepared statement voor een operatie op een tabel. Bij een statement dat afhangt van de velden komt een hash van de veldnamen erbij; te lange namen (max 63 tekens in postgres) worden ingekort met een hash."""
+    name = 'orm_{}_{}_{}'.format(operation, dv_schema, table_name)
+    field_names = list(field_names)
+    if field_names:
+        name += '_' + hashlib.md5(','.join(field_names).encode('utf8')).hexdigest()[:8]
+    if len(name) > 63:
+        name = name[:54] + '_' + hashlib.md5(name.encode('utf8')).hexdigest()[:8]
+    return name
+
+
+def load_active_sat_rows(dwh: 'Dwh', dv_schema: str, sat_name: str, ids: List[int], field_names: List[str]) -> List[Any]:
+    """Actieve rijen van de sat voor ids, via één prepared statement per sat en combinatie van velden.
+
+    De velden staan expliciet in de select: bij SELECT * geeft postgres na een nieuwe kolom in de sat (ddl) "cached plan must not change result type" op het al voorbereide statement."""
+    sql = """SELECT {fields} FROM {dv}.{sat} WHERE _id = ANY($1::bigint[]) AND _active""".format(fields=', '.join(field_names), dv=dv_schema, sat=sat_name)
+    return dwh.execute_prepared(statement_name('load', dv_schema, sat_name, field_names), sql, (list(ids), ), 'load {}'.format(sat_name))
+
+
+def insert_hub_row(dwh: 'Dwh', dv_schema: str, hub_name: str, values: Dict[str, Any]) -> int:
+    """Voegt één hub-rij toe (bk, type, _runid en _source_system) via een prepared statement. Geeft de nieuwe _id, of None als de bk al bestaat.
+
+    Bij hash keys wordt de _id in de insert uit de bk berekend."""
+    sql = """INSERT INTO {dv}.{hub} (_runid, _source_system, _insert_date, _valid, _validation_msg, type, bk) VALUES ($1, $2, now(), True, '', $3, $4)
+ON CONFLICT (bk) DO NOTHING RETURNING _id""".format(dv=dv_schema, hub=hub_name)
+    if dwh.use_hash_keys():
+        sql = """INSERT INTO {dv}.{hub} (_id, _runid, _source_system, _insert_date, _valid, _validation_msg, type, bk) VALUES ({id}, $1, $2, now(), True, '', $3, $4)
+ON CONFLICT (bk) DO NOTHING RETURNING _id""".format(dv=dv_schema, hub=hub_name, id=hash_key_sql('$4'))
+    params = (values['_runid'], values['_source_system'], values['type'], values['bk'])
+    result = dwh.execute_prepared(statement_name('insert', dv_schema, hub_name), sql, params, 'insert {}'.format(hub_name))
+    return result[0][0] if result else None
+
+
+def insert_sat_row(dwh: 'Dwh', dv_schema: str, sat_name: str, values: Dict[str, Any]) -> bool:
+    """Voegt één actieve sat-rij toe via een prepared statement per sat en combinatie van velden. Geeft False als er al een rij met dezelfde _id en _runid is."""
+    field_names = get_field_names(values)
+    params = {'dv': dv_schema, 'sat': sat_name}
+    params['fields'] = ''.join(', ' + name for name in field_names)
+    params['values'] = ''.join(', ${}'.format(index + 5) for index in range(len(field_names)))
+    sql = """INSERT INTO {dv}.{sat} (_id, _runid, _active, _source_system, _insert_date, _finish_date, _revision, _valid, _validation_msg, _hash{fields})
+VALUES ($1, $2, True, $3, now(), NULL, $4, True, '', ''{values})
+ON CONFLICT DO NOTHING RETURNING _id""".format(**params)
+    values = (values['_id'], values['_runid'], values['_source_system'], values['_revision']) + tuple(values[name] for name in field_names)
+    result = dwh.execute_prepared(statement_name('insert', dv_schema, sat_name, field_names), sql, values, 'insert {}'.format(sat_name))
+    return len(result) > 0
+
+
+def close_sat_row(dwh: 'Dwh', dv_schema: str, sat_name: str, id: int, runid: float) -> None:
+    """Maakt de sat-rij met _id en _runid inactief, via een prepared statement per sat"""
+    sql = """UPDATE {dv}.{sat} SET _active = False, _finish_date = now() WHERE _id = $1 AND _runid = $2""".format(dv=dv_schema, sat=sat_name)
+    dwh.execute_prepared(statement_name('close', dv_schema, sat_name), sql, (id, runid), 'close {}'.format(sat_name))
+
+
+def close_pit_rows(dwh: 'Dwh', dv_schema: str, pit_name: str, ids: List[int]) -> None:
+    """Maakt de actieve pit-rijen van ids inactief nadat de orm een sat van die _id's heeft gewijzigd. De view gebruikt voor die _id's dan de actieve sat-rijen, tot de etl er weer een pit-rij voor maakt."""
+    sql = """UPDATE {dv}.{pit} SET _active = False WHERE _id = ANY($1::bigint[]) AND _active""".format(dv=dv_schema, pit=pit_name)
+    dwh.execute_prepared(statement_name('close', dv_schema, pit_name), sql, (list(ids), ), 'close {}'.format(pit_name))
+
+
+def get_field_names(values: Dict[str, Any]) -> List[str]:
+    """Namen van de inhoudelijke velden van een hub- of sat-rij: zonder de technische velden (_...) en de status"""
+    return [name for name in values.keys() if not (name.startswith('_') or name in ('db_status', 'dbstatus'))]
+
+
+def save_hub_rows(dwh: 'Dwh', dv_schema: str, hub_name: str, rows: List[Dict[str, Any]]) -> Dict[str, int]:
+    """Voegt de nieuwe hub-rijen (met bk, type, _runid en _source_system) set-based toe: via execute_values in een tijdelijke tabel en daarna met één insert in de hub. Bestaande bk's worden overgeslagen.
+
+    :return: per bk de _id in de hub, ook van bk's die al bestonden"""
+    params = {'dv': dv_schema, 'hub': hub_name, 'stage': hub_name + '_orm_stage'}
+    # bij hash keys is de _id de hash van de bk, anders vult de hub hem zelf (serial)
+    params['id_field'] = '_id, ' if dwh.use_hash_keys() else ''
+    params['id_value'] = hash_key_sql('stage.bk') + ', ' if dwh.use_hash_keys() else ''
+    with dwh.transaction():
+        sql = """DROP TABLE IF EXISTS {stage};
+CREATE TEMP TABLE {stage} (bk text, type text, _runid numeric, _source_system text) ON COMMIT DROP;""".format(**params)
+        dwh.execute(sql, 'create {stage}'.format(**params))
+        values = [(row['bk'], row['type'], row['_runid'], row['_source_system']) for row in rows]
+        dwh.execute_values('INSERT INTO {stage} (bk, type, _runid, _source_system) VALUES %s'.format(**params), values, 'stage {hub}'.format(**params))
+        # het hoofdstatement ziet de hub van voor de insert: de tweede select geeft dus alleen de al bestaande bk's
+        sql = """WITH inserted AS (
+    INSERT INTO {dv}.{hub} ({id_field}_runid, _source_system, _insert_date, _valid, _validation_msg, type, bk)
+    SELECT DISTINCT ON (stage.bk) {id_value}stage._runid, stage._source_system, now(), True, '', stage.type, stage.bk
+    FROM {stage} stage
+    WHERE NOT EXISTS (SELECT 1 FROM {dv}.{hub} hub WHERE hub.bk = stage.bk)
+    RETURNING _id, bk
+)
+SELECT _id, bk FROM inserted
+UNION
+SELECT hub._id, hub.bk FROM {dv}.{hub} hub JOIN {stage} stage ON stage.bk = hub.bk;""".format(**params)
+        result = dwh.execute_returning(sql, 'insert {hub}'.format(**params))
+    return {bk: id for id, bk in result}
+
+
+def save_sat_rows(dwh: 'Dwh', dv_schema: str, sat_name: str, rows: List[Dict[str, Any]], hybrid: bool = False) -> List[tuple]:
+    """Versioneert de sat-rijen set-based: via execute_values in een tijdelijke tabel, daarna in één statement per _id vergelijken met de actieve sat-rij, de vorige versie afsluiten en een nieuwe versie toevoegen. Rijen zonder wijziging worden overgeslagen.
+
+    Een nieuwe versie van een bestaande rij krijgt de _runid van de vorige versie + 0.01 en de volgende _revision.
+
+    :param hybrid: True bij een HybridSat; die heeft per _id een actieve rij per type en wordt dus per _id en type geversioneerd
+    :return: (_id, _runid, _revision) van de toegevoegde versies"""
+    if hybrid and not all('type' in row for row in rows):
+        raise PyeltException('{} is een HybridSat; elke rij moet een type hebben'.format(sat_name))
+    # per _id (en type) telt de laatst opgegeven rij
+    rows_by_id = OrderedDict(((row['_id'], row['type'] if hybrid else None), row) for row in rows)
+    field_names = []
+    for row in rows_by_id.values():
+        field_names += [name for name in get_field_names(row) if name not in field_names]
+    params = {'dv': dv_schema, 'sat': sat_name, 'stage': sat_name + '_orm_stage'}
+    params['join_type'] = ' AND current.type = stage.type' if hybrid else ''
+    params['close_type'] = ' AND sat.type = changed.type' if hybrid else ''
+    params['fields'] = ''.join(', ' + name for name in field_names)
+    params['stage_fields'] = ', '.join('stage.' + name for name in field_names) or 'NULL'
+    params['current_fields'] = ', '.join('current.' + name for name in field_names) or 'NULL'
+    with dwh.transaction():
+        sql = """DROP TABLE IF EXISTS {stage};
+CREATE TEMP TABLE {stage} ON COMMIT DROP AS SELECT _id, _runid, _source_system{fields} FROM {dv}.{sat} WITH NO DATA;""".format(**params)
+        dwh.execute(sql, 'create {stage}'.format(**params))
+        values = [tuple([row['_id'], row['_runid'], row['_source_system']] + [row.get(name) for name in field_names]) for row in rows_by_id.values()]
+        dwh.execute_values('INSERT INTO {stage} (_id, _runid, _source_system{fields}) VALUES %s'.format(**params), values, 'stage {sat}'.format(**params))
+        sql = """WITH changed AS (
+    SELECT stage.*, current._runid AS previous_runid, COALESCE(current._revision, 0) AS previous_revision
+    FROM {stage} stage
+    LEFT JOIN {dv}.{sat} current ON current._id = stage._id{join_type} AND current._active
+    WHERE current._id IS NULL OR ({current_fields}) IS DISTINCT FROM ({stage_fields})
+), closed AS (
+    UPDATE {dv}.{sat} sat SET _active = False, _finish_date = now()
+    FROM changed WHERE sat._id = changed._id{close_type} AND sat._runid = changed.previous_runid
+)
+INSERT INTO {dv}.{sat} (_id, _runid, _active, _source_system, _insert_date, _finish_date, _revision, _valid, _validation_msg{fields})
+SELECT _id, COALESCE(previous_runid + 0.01, _runid), True, _source_system, now(), NULL, previous_revision + 1, True, ''{fields}
+FROM changed
+RETURNING _id, _runid, _revision;""".format(**params)
+        result = dwh.execute_returning(sql, 'insert {sat}'.format(**params))
+    return result
+
+
+class LruCache():
+    """Dict met een maximaal aantal items. Bij een volle cache valt het item dat het langst niet is gebruikt eruit."""
+
+    def __init__(self, max_size: int = 100000):
+        self.max_size = max_size
+        self.__items = OrderedDict()  # type: OrderedDict
+
+    def __contains__(self, key) -> bool:
+        return key in self.__items
+
+    def __len__(self) -> int:
+        return len(self.__items)
+
+    def get(self, key, default=None):
+        if key not in self.__items:
+            return default
+        self.__items.move_to_end(key)
+        return self.__items[key]
+
+    def set(self, key, value) -> None:
+        self.__items[key] = value
+        self.__items.move_to_end(key)
+        while len(self.__items) > self.max_size:
+            self.__items.popitem(last=False)
+
+    def remove(self, key) -> None:
+        self.__items.pop(key, None)
+
+    def clear(self) -> None:
+        self.__items.clear()
 
 
 class DbSession():
+    """Singleton met de dwh en runid van de orm, en een cache van wat in deze sessie al is geladen of opgeslagen:
+
+    - identity map: de geladen hub- en sat-rijen per (tabel, _id), altijd als :class:`Row` (zie :func:`get_row_class`)
+    - per hub de _id per bk
+
+    Beide zijn begrensd tot *orm_cache_size* items (config, standaard 100000); het langst niet gebruikte item valt eruit. Bij het opslaan van sat-rijen worden ze uit de identity map gehaald."""
     _instance = None
 
     def __new__(cls, *args, **kwargs):
@@ -23,8 +208,41 @@ class DbSession():
             cls._instance.config = config  #: pyelt_config
             cls._instance.dwh = Dwh(config)
             cls._instance.runid = runid  # type: float
+            cls._instance.init_cache('orm_cache_size' in config and config['orm_cache_size'] or 100000)
         return cls._instance
 
+    def init_cache(self, cache_size: int) -> None:
+        self.cache_size = cache_size
+        self.identity_map = LruCache(cache_size)  # type: LruCache
+        self.hub_ids = {}  # type: Dict[str, LruCache]
+
+    def get_row(self, table_name: str, id: int):
+        """Rij uit de identity map, of None als die in deze sessie (nog) niet is geladen"""
+        return self.identity_map.get((table_name, id))
+
+    def add_rows(self, table_name: str, rows: Iterable['Row']) -> None:
+        for row in rows:
+            self.identity_map.set((table_name, row._id), row)
+
+    def invalidate(self, table_name: str, ids: Iterable[int]) -> None:
+        """Haalt de rijen uit de identity map, zodat ze de volgende keer opnieuw uit de db komen"""
+        for id in ids:
+            self.identity_map.remove((table_name, id))
+
+    def get_hub_id(self, hub_name: str, bk: str) -> int:
+        if hub_name not in self.hub_ids:
+            return None
+        return self.hub_ids[hub_name].get(bk)
+
+    def set_hub_ids(self, hub_name: str, ids: Dict[str, int]) -> None:
+        if hub_name not in self.hub_ids:
+            self.hub_ids[hub_name] = LruCache(self.cache_size)
+        for bk, id in ids.items():
+            self.hub_ids[hub_name].set(bk, id)
+
+    def clear(self) -> None:
+        self.init_cache(self.cache_size)
+
 
 class DBStatus:
     pre_initialised = 'PREINIT'
@@ -35,31 +253,63 @@ class DBStatus:
 
 
 class Row():
-    def __getattribute__(self, item):
-        val = super().__getattribute__(item)
-        if isinstance(val, Column):
-            val = val.default_value
-        return val
+    """Basis voor de rij-classes van :func:`get_row_class`: alleen __slots__ voor de velden, geen __dict__ per rij en geen __getattribute__."""
+    __slots__ = ()
+    _fields = ()  # type: Tuple[str, ...]
+
+    def __init__(self, *values, **named_values):
+        """values in de volgorde van _fields; ontbrekende velden worden None"""
+        for name, value in zip(self._fields, values):
+            setattr(self, name, value)
+        for name in self._fields[len(values):]:
+            setattr(self, name, named_values.get(name))
+
+    def as_dict(self) -> Dict[str, Any]:
+        return OrderedDict((name, getattr(self, name)) for name in self._fields)
+
+
+_row_classes = {}  # type: Dict[Tuple[str, Tuple[str, ...]], type]
+
+
+def get_row_class(name: str, field_names: Iterable[str]) -> type:
+    """Geeft de rij-class met __slots__ voor de velden van een hub of sat. Wordt per tabel en combinatie van velden één keer gemaakt; db_status komt er altijd bij."""
+    fields = tuple(field_names)
+    if 'db_status' not in fields:
+        fields += ('db_status',)
+    key = (name, fields)
+    if key not in _row_classes:
+        _row_classes[key] = type(name + '_row', (Row,), {'__slots__': fields, '_fields': fields})
+    return _row_classes[key]
 
 
 class EntityRow():
+    """Rij van een entity. De sats zijn properties (zie :func:`get_entity_row_class`) die bij het eerste gebruik de sat voor alle rijen van de entity laden; de overige velden zijn gewone slots."""
+    __slots__ = ('_id', '_runid', 'bk', 'db_status', 'entity')
+
     def __init__(self, entity):
         self._id = 0
         self.entity = entity
 
-    def __getattribute__(self, item):
-        val = super().__getattribute__(item)
-        if isinstance(val, SatData):
-            if val.db_status == DBStatus.pre_initialised:
-                sat_rows = val.load()
-                self.entity.sats[item] = val
-            else:
-                sat_rows = self.entity.sats[item].rows
-            if self._id in sat_rows:
-                val = sat_rows[self._id]
-                # else:
-                #     val = val.default_value
-        return val
+    def get_sat_row(self, sat_name: str):
+        sat = self.entity.sats[sat_name]
+        if sat.db_status == DBStatus.pre_initialised:
+            # de sat wordt in één keer geladen voor alle rijen van de entity, niet alleen voor deze rij
+            self.entity.load_sat(sat)
+        if self._id in sat.rows:
+            return sat.rows[self._id]
+        return sat
+
+
+def get_entity_row_class(name: str, sat_names: Iterable[str]) -> type:
+    """EntityRow-class met per sat een property"""
+    sat_names = tuple(sat_names)
+    key = (name, sat_names)
+    if key not in _row_classes:
+        namespace = {'__slots__': ()}
+        for sat_name in sat_names:
+            namespace[sat_name] = property(lambda self, sat_name=sat_name: self.get_sat_row(sat_name))
+        _row_classes[key] = type(name + '_entity_row', (EntityRow,), namespace)
+    return _row_classes[key]
 
 
 class DvData():
@@ -74,23 +324,35 @@ class DvData():
     def load(self, filter='1=1'):
         pass
 
+    def get_field_names(self) -> List[str]:
+        """Velden van een nieuwe rij"""
+        return ['_id', '_runid', '_source_system']
+
     def new(self):
-        row = Row()
-        row.__dict__['db_status'] = DBStatus.new
+        row_cls = get_row_class(self.name, self.get_field_names())
         id = len(self.rows) * -1
-        row.__dict__['_id'] = id
-        row.__dict__['_runid'] = self.runid
-        row.__dict__['_source_system'] = 'manual insert'
+        row = row_cls(db_status=DBStatus.new, _id=id, _runid=self.runid, _source_system='manual insert')
         # self.rows.append(row)
         self.rows[id] = row
         return row
 
     def save(self):
-        for row in self.rows.values():
-            if row.db_status == DBStatus.new:
-                self._save_new_row(row)
-            elif row.db_status == DBStatus.changed:
-                self._update_row(row)
+        """Schrijft alle nieuwe en gewijzigde rijen in één transactie weg, per soort in één keer (zie :meth:`_save_new_rows`)"""
+        new_rows = [row for row in self.rows.values() if row.db_status == DBStatus.new]
+        changed_rows = [row for row in self.rows.values() if row.db_status == DBStatus.changed]
+        with self.dwh.transaction():
+            if new_rows:
+                self._save_new_rows(new_rows)
+            if changed_rows:
+                self._save_changed_rows(changed_rows)
+
+    def _save_new_rows(self, rows):
+        for row in rows:
+            self._save_new_row(row)
+
+    def _save_changed_rows(self, rows):
+        for row in rows:
+            self._update_row(row)
 
     def _save_new_row(self, row):
         pass
@@ -109,12 +371,9 @@ class HubData(DvData):
         params = {'dv': 'dv', 'hub': hub_name, 'filter': filter}
         sql = """SELECT * FROM {dv}.{hub} WHERE {filter}""".format(**params)
         rows = self.dwh.execute_read(sql, '')
+        row_cls = get_row_class(self.name, self.get_field_names())
         for row in rows:
-            hub = Row()
-            hub.__dict__['_id'] = row['_id']
-            hub.__dict__['_runid'] = row['_runid']
-            hub.__dict__['bk'] = row['bk']
-            hub.__dict__['db_status'] = DBStatus.loaded
+            hub = row_cls(row['_id'], row['_runid'], row['_source_system'], row['type'], row['bk'], DBStatus.loaded)
             # for sat_cls in sats:
             #     sat = sat_cls()
             #     sat._id = row['_id']
@@ -136,41 +395,61 @@ class HubData(DvData):
             #     setattr(sat_cls, 'load', self.load_sat)
 
             # return_list.append(entity)
+        if self.session:
+            self.session.add_rows(self.name, self.rows.values())
+            self.session.set_hub_ids(self.name, {row['bk']: row['_id'] for row in rows})
         return self.rows
 
+    def get_ids(self, bks: List[str]) -> Dict[str, int]:
+        """_id per bk. Bk's die de sessie al kent komen uit het geheugen, de rest in één query per chunk."""
+        ids = {}
+        missing = []
+        for bk in bks:
+            id = self.session.get_hub_id(self.name, bk) if self.session else None
+            if id is None:
+                missing.append(bk)
+            else:
+                ids[bk] = id
+        params = {'dv': self.dwh.dv.name, 'hub': self.name}
+        sql = """SELECT bk, _id FROM {dv}.{hub} WHERE bk = ANY($1::text[])""".format(**params)
+        for chunk in chunks(missing, EntityData.chunk_size):
+            rows = self.dwh.execute_prepared(statement_name('ids', params['dv'], self.name), sql, (chunk, ), 'get ids {hub}'.format(**params))
+            found = {row['bk']: row['_id'] for row in rows}
+            if self.session:
+                self.session.set_hub_ids(self.name, found)
+            ids.update(found)
+        return ids
+
+    def get_field_names(self) -> List[str]:
+        return ['_id', '_runid', '_source_system', 'type', 'bk']
+
     def new(self):
         row = super().new()
-        row.__dict__['type'] = self.type
-        row.__dict__['bk'] = ''
+        row.type = self.type
+        row.bk = ''
         return row
 
+    def _save_new_rows(self, rows):
+        ids = save_hub_rows(self.dwh, self.dwh.dv.name, self.name, [row.as_dict() for row in rows])
+        # de tijdelijke (negatieve) _id's vervangen door die uit de hub
+        for row in rows:
+            del self.rows[row._id]
+            row._id = ids[row.bk]
+            row.db_status = DBStatus.loaded
+            self.rows[row._id] = row
+        if self.session:
+            self.session.set_hub_ids(self.name, ids)
+
     def _save_new_row(self, row):
-        params = {}
-        params['dv'] = self.dwh.dv.name
-        params['hub'] = self.name
-        params['_runid'] = row._runid
-        params['_source_system'] = row._source_system
-        params['type'] = row.type
-        params['bk'] = row.bk
-        params['fixed_field_names'] = "_runid, _source_system, _insert_date, _valid, _validation_msg, type, bk"
-        params['fixed_values'] = "{_runid}, '{_source_system}', now(), True, '', '{type}', '{bk}'".format(**params)
-        sql = """INSERT INTO {dv}.{hub} ({fixed_field_names}) SELECT {fixed_values}
-WHERE NOT EXISTS (SELECT 1 FROM {dv}.{hub} WHERE bk='{bk}') RETURNING _id;""".format(**params)
-        print(sql)
-        result = self.dwh.execute_returning(sql, 'INSERT HUB')
+        id = insert_hub_row(self.dwh, self.dwh.dv.name, self.name, row.as_dict())
         row.db_status = DBStatus.loaded
-        if result:
-            id = result[0][0]
+        if id is not None:
             row._id = id
         else:
-            # bestaat al in db: id laden
-            sql = """SELECT _id FROM {dv}.{hub} WHERE bk='{bk}';""".format(**params)
-            result = self.dwh.execute_returning(sql, 'GET HUB ID BY BK')
-            id = result[0][0]
-            row._id = id
-        print(sql)
-        result = self.dwh.execute_returning(sql, 'INSERT HUB')
-
+            # bestaat al in db: id uit de sessie, of anders uit de hub laden
+            row._id = self.get_ids([row.bk])[row.bk]
+        if self.session:
+            self.session.set_hub_ids(self.name, {row.bk: row._id})
         return row
 
 
@@ -192,108 +471,93 @@ class SatData(DvData):
         sql = """SELECT * FROM {dv}.{sat} WHERE {filter} AND _active""".format(**params)
         print(sql)
         rows = self.dwh.execute_read(sql, '')
+        self._add_loaded_rows(rows)
+        self.db_status = DBStatus.loaded
+        return self.rows
+
+    def _add_loaded_rows(self, rows):
+        if rows:
+            # de volgorde van de velden is die van de query, zodat elke rij in één keer kan worden overgenomen
+            row_cls = get_row_class(self.name, rows[0].keys())
         for row in rows:
-            sat = Row()
-            sat.__dict__['db_status'] = DBStatus.loaded
-            for field_name, field_value in row.items():
-                sat.__dict__[field_name] = field_value
+            sat = row_cls(*row, db_status=DBStatus.loaded)
             # self.rows.append(sat)
             self.rows[sat._id] = sat
-        self.db_status = DBStatus.loaded
+            if self.session:
+                self.session.add_rows(self.name, [sat])
+
+    def load_ids(self, ids: List[int]) -> Dict[int, Row]:
+        """Laadt de actieve rijen van ids. Rijen die al in de identity map van de sessie staan worden niet opnieuw opgehaald."""
+        missing = []
+        for id in ids:
+            row = self.session.get_row(self.name, id) if self.session else None
+            if row is None:
+                missing.append(id)
+            else:
+                self.rows[id] = row
+        if missing:
+            self._add_loaded_rows(load_active_sat_rows(self.dwh, self.dwh.dv.name, self.name, missing, self.get_field_names()))
+            self.db_status = DBStatus.loaded
         return self.rows
 
+    def _save_new_rows(self, rows):
+        self.__save_rows(rows)
+
+    def _save_changed_rows(self, rows):
+        self.__save_rows(rows)
+
+    def __save_rows(self, rows):
+        versions = save_sat_rows(self.dwh, self.dwh.dv.name, self.name, [row.as_dict() for row in rows])
+        versions = {id: (runid, revision) for id, runid, revision in versions}
+        for row in rows:
+            if row._id in versions:
+                row._runid, row._revision = versions[row._id]
+            row.db_status = DBStatus.loaded
+        if self.session:
+            self.session.invalidate(self.name, [row._id for row in rows])
+
+    def get_field_names(self) -> List[str]:
+        return super().get_field_names() + ['_revision'] + [col.name for col in self.__class__.get_columns()]
+
     def new(self):
         row = super().new()
-        row.__dict__['_revision'] = 0
-        cols = self.__class__.get_columns()
-        for col in cols:
-            row.__dict__[col.name] = col.default_value
+        row._revision = 0
+        for col in self.__class__.get_columns():
+            setattr(row, col.name, col.default_value)
         return row
 
     def _save_new_row(self, row):
-        params = {}
-        params['dv'] = self.dwh.dv.name
-        params['sat'] = self.name
-        params['_id'] = row._id
-        params['_runid'] = row._runid
-        params['_source_system'] = row._source_system
-        params['_revision'] = 1
-        field_names = ''
-        field_values = ''
-        for fld_name, fld_value in row.__dict__.items():
-            if not (fld_name.startswith('_') or fld_name == 'db_status'):
-                field_names += fld_name + ', '
-                field_values += "'{}', ".format(fld_value)
-        field_names = field_names[:-2]
-        field_values = field_values[:-2]
-        params['fixed_field_names'] = "_id, _runid, _active, _source_system, _insert_date, _finish_date, _revision, _valid, _validation_msg, _hash"
-        params['fixed_values'] = "{_id}, {_runid}, True, '{_source_system}', now(), NULL, {_revision}, True, '', ''".format(**params)
-        params['field_names'] = field_names
-        params['values'] = field_values
-        params['type'] = ''
-        sql = """INSERT INTO {dv}.{sat} ({fixed_field_names}, {field_names}) SELECT {fixed_values}, {values}
-WHERE NOT EXISTS (SELECT 1 FROM {dv}.{sat} WHERE _id={_id} AND _runid = {_runid}) RETURNING _id""".format(**params)
-        result = self.dwh.execute_returning(sql, 'INSERT SAT')
+        values = dict(row.as_dict(), _revision=1)
+        is_inserted = insert_sat_row(self.dwh, self.dwh.dv.name, self.name, values)
         row.db_status = DBStatus.loaded
-        if not result:
+        if not is_inserted:
             # bestaat al in db: _revision updaten
-            old_row = self._load_row(params['_id'])
+            old_row = self._load_row(row._id)
             self._update_row(old_row, row)
         return row
 
     def _load_row(self, id):
-        sat_name = self.name
-        filter = '_id = {} AND _active'.format(id)
-        params = {'dv': 'dv', 'sat': sat_name, 'filter': filter}
-        sql = """SELECT * FROM {dv}.{sat} WHERE {filter}""".format(**params)
-        print(sql)
-        rows = self.dwh.execute_read(sql, '')
+        rows = load_active_sat_rows(self.dwh, self.dwh.dv.name, self.name, [id], self.get_field_names())
         if rows:
             row = rows[0]
-            sat = Row()
-            sat.__dict__['db_status'] = DBStatus.loaded
-            for field_name, field_value in row.items():
-                sat.__dict__[field_name] = field_value
-            return sat
+            row_cls = get_row_class(self.name, row.keys())
+            return row_cls(*row, db_status=DBStatus.loaded)
 
     def _update_row(self, old_row, new_row):
         is_changed = False
-        for fld_name, fld_value in new_row.__dict__.items():
+        for fld_name, fld_value in new_row.as_dict().items():
             if not (fld_name.startswith('_') or fld_name == 'db_status'):
-                if fld_value != old_row.__dict__[fld_name]:
+                if fld_value != getattr(old_row, fld_name):
                     is_changed = True
                     break
         if not is_changed:
             return
 
-        params = {}
-        params['dv'] = self.dwh.dv.name
-        params['sat'] = self.name
-        params['_id'] = new_row._id
-        params['_previous_runid'] = old_row._runid
         new_row._runid = float(old_row._runid) + 0.01
-        params['_runid'] = new_row._runid
-        params['_source_system'] = new_row._source_system
         new_row._revision = old_row._revision + 1
-        params['_revision'] = new_row._revision
-        field_names = ''
-        field_values = ''
-        for fld_name, fld_value in new_row.__dict__.items():
-            if not (fld_name.startswith('_') or fld_name == 'db_status'):
-                field_names += fld_name + ', '
-                field_values += "'{}', ".format(fld_value)
-        field_names = field_names[:-2]
-        field_values = field_values[:-2]
-        params['fixed_field_names'] = "_id, _runid, _active, _source_system, _insert_date, _finish_date, _revision, _valid, _validation_msg, _hash"
-        params['fixed_values'] = "{_id}, {_runid}, True, '{_source_system}', now(), NULL, {_revision}, True, '', ''".format(**params)
-        params['field_names'] = field_names
-        params['values'] = field_values
-        params['type'] = ''
-
-        sql = """UPDATE {dv}.{sat} SET _active = False, _finish_date = Now() WHERE _id = {_id} AND _runid = {_previous_runid};
-
-INSERT INTO {dv}.{sat} ({fixed_field_names}, {field_names}) VALUES ({fixed_values}, {values});""".format(**params)
-        self.dwh.execute(sql, 'INSERT SAT')
+        with self.dwh.transaction():
+            close_sat_row(self.dwh, self.dwh.dv.name, self.name, new_row._id, old_row._runid)
+            insert_sat_row(self.dwh, self.dwh.dv.name, self.name, new_row.as_dict())
         return new_row
 
         # def __getattribute__(self, item):
@@ -319,6 +583,8 @@ INSERT INTO {dv}.{sat} ({fixed_field_names}, {field_names}) VALUES ({fixed_value
 
 
 class EntityData(DvData):
+    chunk_size = 10000
+
     def __init__(self):
         super().__init__()
         self.hub = self.get_hub()
@@ -329,19 +595,19 @@ class EntityData(DvData):
             self.sats[sat_name.lower()] = sat
 
     def load(self, filter='1=1', sats=[]):
+        """Laadt de hub-rijen. De sats in sats (namen) worden direct geladen, met per sat één query per chunk_size rijen; de overige sats pas bij het eerste gebruik."""
 
         hub_name = self.hub.name
         params = {'dv': 'dv', 'hub': hub_name, 'filter': filter}
         sql = """SELECT * FROM {dv}.{hub} WHERE {filter}""".format(**params)
         rows = self.dwh.execute_read(sql, '')
+        row_cls = get_entity_row_class(hub_name, self.sats.keys())
         for row in rows:
-            entity = EntityRow(self)
-            entity.__dict__['_id'] = row['_id']
-            entity.__dict__['_runid'] = row['_runid']
-            entity.__dict__['bk'] = row['bk']
-            entity.__dict__['db_status'] = DBStatus.loaded
-            for sat_name, sat in self.sats.items():
-                entity.__dict__[sat_name] = sat
+            entity = row_cls(self)
+            entity._id = row['_id']
+            entity._runid = row['_runid']
+            entity.bk = row['bk']
+            entity.db_status = DBStatus.loaded
 
             # self.rows.append(hub)
             self.rows[entity._id] = entity
@@ -359,8 +625,18 @@ class EntityData(DvData):
             #     setattr(sat_cls, 'load', self.load_sat)
 
             # return_list.append(entity)
+        for sat_name in sats:
+            self.load_sat(self.sats[sat_name.lower()])
         return self.rows
 
+    def load_sat(self, sat: 'SatData') -> Dict[int, Row]:
+        """Laadt de actieve sat-rijen van alle geladen rijen van de entity"""
+        ids = [id for id in self.rows.keys() if id > 0]
+        for chunk in chunks(ids, self.chunk_size):
+            sat.load_ids(chunk)
+        sat.db_status = DBStatus.loaded
+        return sat.rows
+
         # def __getattribute__(self, item):
         #     val = super().__getattribute__(item)
         #     if isinstance(val, SatData):
@@ -2,7 +2,8 @@ import datetime
 import inspect
 import math
 from collections import OrderedDict
-from typing import List
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Union
 
 # from main import get_root_path
 # from sample_domains import _ensemble_views
@@ -13,13 +14,16 @@ from pyelt.datalayers.dwh import Dwh, DwhLayerTypes
 from pyelt.datalayers.sys import *
 from pyelt.datalayers.valset import DvValueset
 
+from pyelt.helpers.exceptions import PyeltException
 from pyelt.helpers.pyelt_logging import Logger, LoggerTypes
 from pyelt.helpers.validations import DomainValidator, MappingsValidator
 from pyelt.mappings.sor_to_dv_mappings import SorToValueSetMapping, EntityViewToEntityMapping, EntityViewToLinkMapping, SorToEntityMapping, SorToLinkMapping
 from pyelt.mappings.source_to_sor_mappings import SourceToSorMapping
+from pyelt.mappings.dv_to_datamart_mappings import DvToDimMapping, DvToFactMapping
 from pyelt.mappings.validations import SorValidation, DvValidation, Validation
 from pyelt.process.ddl import * # DdlSor, DdlDv, Ddl, DdlDatamart
-from pyelt.process.etl import EtlSourceToSor, EtlSorToDv
+from pyelt.process.etl import BaseEtl, EtlSourceToSor, EtlSorToDv, EtlDvToDatamart
+from pyelt.process.scheduler import TableLocks, TaskGraph
 from pyelt.sources.databases import SourceDatabase
 
 
@@ -82,6 +86,7 @@ Voorbeeld::
             cls._instance.sql_logger = None  # type: Logger
             cls._instance.domain_modules = {}
             cls._instance.datamart_modules = {}
+            cls._instance.datamart_mappings = []  # type: List[Union[DvToDimMapping, DvToFactMapping]]
         return cls._instance
 
 
@@ -103,7 +108,7 @@ Voorbeeld::
             self.pipes[source_system] = pipe
         return self.pipes[source_system]
 
-    def run(self, parts=['sor', 'valuesets', 'hubs', 'links', 'views', 'viewlinks']) -> None:
+    def run(self, parts=['sor', 'valuesets', 'hubs', 'links', 'views', 'viewlinks', 'datamarts']) -> None:
         """
         Deze functie start de run van de pipeline. Er wordt ddl uitgevoerd, een logbestand aangemaakt, een sql_logbestand en de etl per pipe wordt uitgevoerd..
 
@@ -148,6 +153,7 @@ Voorbeeld::
 
             pipe.run_extra_sql()
             pipe.create_db_functions()
+            pipe.create_dv_from_view_mappings(parts)
 
             self.logger.log('FINISH DDL PIPE ' + pipe.source_system, indent_level=1)
 
@@ -165,14 +171,24 @@ Voorbeeld::
 
         #to do asyncstatus_msg
         self.logger.log('<b>START ETL</>')
-        for pipe in self.pipes.values():
-            self.logger.log('=====================================')
-            self.logger.log('===== START PIPE {}'.format(pipe.source_system))
-            self.logger.log('=====================================')
-            pipe.run(parts)
-            self.logger.log('=====================================')
-            self.logger.log('===== FINISH PIPE {}'.format(pipe.source_system))
-            self.logger.log('=====================================', )
+        max_parallel_pipes = 1
+        if 'max_parallel_pipes' in self.config and self.config['max_parallel_pipes']:
+            max_parallel_pipes = int(self.config['max_parallel_pipes'])
+        if max_parallel_pipes > 1 and len(self.pipes) > 1:
+            self.run_pipes_parallel(parts, max_parallel_pipes)
+        else:
+            for pipe in self.pipes.values():
+                self.logger.log('=====================================')
+                self.logger.log('===== START PIPE {}'.format(pipe.source_system))
+                self.logger.log('=====================================')
+                pipe.run(parts)
+                self.logger.log('=====================================')
+                self.logger.log('===== FINISH PIPE {}'.format(pipe.source_system))
+                self.logger.log('=====================================', )
+        if 'hubs' in parts or 'links' in parts:
+            self.refresh_ensemble_views()
+        if 'datamarts' in parts:
+            self.run_datamarts()
         self.logger.log('FINISH ETL')
         self.logger.log('')
         self.end_run()
@@ -196,6 +212,65 @@ Voorbeeld::
 
         self.send_log_mail()
 
+    def refresh_ensemble_views(self) -> None:
+        """Ververst de gematerialiseerde ensemble views (__materialize__ = True). Een ensemble combineert entities uit verschillende pipes en wordt daarom pas ververst als alle pipes klaar zijn."""
+        if not ('create_views' in self.config and self.config['create_views']):
+            return
+        etl = BaseEtl(self)
+        with self.dwh.connection():
+            for module_name, module in self.domain_modules.items():
+                for name, cls in inspect.getmembers(module, inspect.isclass):
+                    if cls.__base__ == EnsembleView and cls.__materialize__:
+                        etl.refresh_ensemble_view(cls)
+
+    def run_datamarts(self) -> None:
+        """Vult de dims en facts van de datamarts aan de hand van :attr:`datamart_mappings`. Draait na alle pipes, omdat een datamart entities uit verschillende bronnen kan combineren.
+
+        Voorbeeld::
+
+            pipeline.datamart_mappings.extend(init_dv_to_datamart_mappings())
+        """
+        if not self.datamart_mappings:
+            return
+        self.logger.log('<b>START FROM DV TO DATAMARTS</>', indent_level=1)
+        etl = EtlDvToDatamart(self)
+        etl.dv_to_datamarts(self.datamart_mappings)
+        self.logger.log('<b>FINISH FROM DV TO DATAMARTS</>', indent_level=1)
+
+    def run_pipes_parallel(self, parts, max_workers: int) -> None:
+        """
+        Runt de pipes naast elkaar op een pool van *max_workers* threads.
+
+        Alle ddl, ook die van de dv-tabellen die vanuit views worden gevuld, is dan al serieel uitgevoerd (zie :meth:`run`). Elke pipe laadt zijn eigen sor-schema, dus de stappen van bron naar sor lopen volledig parallel. De dv-stappen van twee pipes worden alleen na elkaar uitgevoerd als ze dezelfde hub, sat, link of valueset tabel vullen (zie :meth:`Pipe.get_dv_table_names`).
+
+        In de log wordt elke regel voorafgegaan door de naam van de pipe.
+
+        :param parts: zie :meth:`run`
+        :param max_workers: maximaal aantal pipes dat tegelijk draait; in te stellen met 'max_parallel_pipes' in de config
+        """
+        table_locks = TableLocks()
+        self.logger.log('START {} PIPES PARALLEL ON {} WORKERS'.format(len(self.pipes), max_workers))
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = OrderedDict()
+            for pipe in self.pipes.values():
+                futures[pipe.source_system] = executor.submit(self.__run_pipe_with_locks, pipe, parts, table_locks)
+            for source_system, future in futures.items():
+                try:
+                    future.result()
+                except Exception as ex:
+                    self.logger.log_error('PIPE ' + source_system, err_msg=str(ex))
+
+    def __run_pipe_with_locks(self, pipe: 'Pipe', parts, table_locks: TableLocks) -> None:
+        Logger.set_context(pipe.source_system)
+        try:
+            self.logger.log('===== START PIPE {}'.format(pipe.source_system))
+            pipe.run_sor(parts)
+            with table_locks.acquire(pipe.get_dv_table_names()):
+                pipe.run_dv(parts)
+            self.logger.log('===== FINISH PIPE {}'.format(pipe.source_system))
+        finally:
+            Logger.set_context('')
+
     def validate_domains(self) -> bool:
         """Valideert of de geregistreerde domeinen van alle pipes geldig zijn.
 
@@ -421,6 +496,7 @@ Voorbeeld::
         ddl = Ddl(self, schema)
         ddl.create_or_alter_table(Sys.Runs)
         ddl.create_or_alter_table(Sys.Currentversion)
+        ddl.create_or_alter_table(Sys.Watermarks)
 
     def create_valueset_from_domain(self, schema):
         """
@@ -490,7 +566,7 @@ Voorbeeld::
         for name, module in self.datamart_modules.items():
             ddl = DdlDatamart(self, self.dwh.get_or_create_datamart_schema(name))
             for name, cls in inspect.getmembers(module, inspect.isclass):
-                if cls.__base__ == Dim:
+                if cls.__base__ in (Dim, Scd2Dim) and cls is not Scd2Dim:
                     ddl.create_or_alter_dim(cls)
 
             # Dezelfde for-loop wordt hieronder herhaald, want eerst moeten alle dims zijn aangemaakt voordat de facts aangemaakt kunnen worden met ref. integriteit op de database
@@ -544,7 +620,12 @@ Bijvoorbeeld, we maken een pipe aan met de naam 'timeff', met als bronsysteem ee
             temp_data_transfer_path = ''
             if 'datatransfer_path' in pipeline.config:
                 temp_data_transfer_path = pipeline.config['datatransfer_path']
-            self.source_db = SourceDatabase(config['source_connection'], config['default_schema'], temp_data_transfer_path)
+            fetch_batch_size = 10000
+            if 'fetch_batch_size' in config:
+                fetch_batch_size = config['fetch_batch_size']
+            elif 'fetch_batch_size' in pipeline.config:
+                fetch_batch_size = pipeline.config['fetch_batch_size']
+            self.source_db = SourceDatabase(config['source_connection'], config['default_schema'], temp_data_transfer_path, fetch_batch_size)
         elif 'source_path' in config:
             self.source_path = config['source_path']
         self.sor = pipeline.dwh.get_or_create_sor_schema(config['sor_schema'])
@@ -635,8 +716,27 @@ Bijvoorbeeld, we maken een pipe aan met de naam 'timeff', met als bronsysteem ee
         for mapping in self.mappings:
             if isinstance(mapping, SourceToSorMapping):
                 ddl.create_or_alter_sor(mapping)
+            elif type(mapping) == SorToEntityMapping and not mapping.bk_mapping and self.pipeline.dwh.use_hash_keys():
+                # zonder bk is er geen hash te berekenen en bij hash keys zijn er geen fk-kolommen in de sor om de _id via de key_mappings in te zetten
+                raise PyeltException('{}: bij hash_keys moet een hub-mapping een bk_mapping hebben; key_mappings zonder bk worden niet ondersteund.'.format(mapping.name))
         self.pipeline.logger.log('FINISH CREATE SOR'.format(self.pipeline.runid), indent_level=2)
 
+    def create_dv_from_view_mappings(self, parts = ['sor', 'valuesets', 'hubs', 'links', 'views', 'viewlinks']):
+        """
+        Voert ddl uit van de dv-tabellen en views die gevuld worden vanuit views (EntityViewToEntityMapping en EntityViewToLinkMapping).
+
+        Draait in de ddl-fase van de pipeline, voor alle pipes na elkaar, zodat tijdens de (eventueel parallelle) etl geen ddl meer op het gedeelde dv-schema plaatsvindt.
+
+        :param parts: zie :meth:`run`
+        """
+        ddl = DdlDv(self)
+        for mapping in self.mappings:
+            if 'views' in parts and isinstance(mapping, EntityViewToEntityMapping):
+                ddl.create_or_alter_entity(mapping)
+                ddl.create_or_alter_view(mapping)
+            elif 'viewlinks' in parts and isinstance(mapping, EntityViewToLinkMapping):
+                ddl.create_or_alter_link(mapping)
+
     def create_db_functions(self):
         """
         DDL functie. Maakt nieuwe database functies aan.
@@ -659,89 +759,293 @@ Bijvoorbeeld, we maken een pipe aan met de naam 'timeff', met als bronsysteem ee
         :param parts: lijst van keywords. De eventuele aanwezigheid van een keyword in deze lijst bepaald of het log bestand dat hoort bij dit keyword gemaakt wordt en of de bijhorende DDL uitgevoerd wordt.
 
         """
+        self.run_sor(parts)
+        self.run_dv(parts)
 
-        for func in self.run_before_sor:
-            func(self)
+    def unit_of_work(self):
+        """Context manager rond de etl van één mapping. Met 'unit_of_work' in de config lopen alle statements daarvan in één transactie met één commit (zie :meth:`Database.transaction`); een mislukte mapping wordt dan in zijn geheel teruggedraaid. Anders wordt alleen de connectie van de pipe gebruikt en volgt na elk statement een commit."""
+        if self.use_unit_of_work():
+            return self.pipeline.dwh.transaction()
+        return self.pipeline.dwh.connection()
 
-        if 'sor' in parts:
-            #SOR
-            etl = EtlSourceToSor(self)
-            self.pipeline.logger.log('START FROM SOURCE TO SOR', indent_level=1)
+    def use_unit_of_work(self) -> bool:
+        return 'unit_of_work' in self.pipeline.config and self.pipeline.config['unit_of_work']
 
-            for mapping in self.mappings:
-                if isinstance(mapping, SourceToSorMapping):
-                    self.pipeline.logger.log('START <blue>{}</>'.format(mapping), indent_level=3)
-                    etl.source_to_sor(mapping)
-                    etl.validate_duplicate_keys(mapping, self.sor)
-                    self.pipeline.logger.log('FINISH <blue>{}</>'.format(mapping), indent_level=3)
-            for validation in self.validations:
-                if isinstance(validation, SorValidation):
-                    etl.validate_sor(validation)
-
-            for func in self.run_after_sor:
+    def run_sor(self, parts = ['sor', 'valuesets', 'hubs', 'links', 'views', 'viewlinks']):
+        """
+        Runt het deel van de pipe van bron naar sor. Raakt alleen het eigen sor-schema en kan daardoor parallel aan andere pipes draaien.
+
+        :param parts: zie :meth:`run`
+        """
+        # alle statements van de pipe (in deze thread) over één connectie uit de pool
+        with self.pipeline.dwh.connection():
+            for func in self.run_before_sor:
                 func(self)
 
-            self.pipeline.logger.log('FINISH FROM SOURCE TO SOR', newline=True, indent_level=1)
+            if 'sor' in parts:
+                #SOR
+                etl = EtlSourceToSor(self)
+                self.pipeline.logger.log('START FROM SOURCE TO SOR', indent_level=1)
+
+                for mapping in self.mappings:
+                    if isinstance(mapping, SourceToSorMapping):
+                        self.pipeline.logger.log('START <blue>{}</>'.format(mapping), indent_level=3)
+                        with self.unit_of_work():
+                            etl.source_to_sor(mapping)
+                        etl.validate_duplicate_keys(mapping, self.sor)
+                        self.pipeline.logger.log('FINISH <blue>{}</>'.format(mapping), indent_level=3)
+                for validation in self.validations:
+                    if isinstance(validation, SorValidation):
+                        etl.validate_sor(validation)
+
+                for func in self.run_after_sor:
+                    func(self)
+
+                self.pipeline.logger.log('FINISH FROM SOURCE TO SOR', newline=True, indent_level=1)
+
+    def run_dv(self, parts = ['sor', 'valuesets', 'hubs', 'links', 'views', 'viewlinks']):
+        """
+        Runt het deel van de pipe van sor naar de dv (valuesets, hubs, sats en links).
+
+        :param parts: zie :meth:`run`
+        """
+        with self.pipeline.dwh.connection():
+            #DV
+            etl = EtlSorToDv(self)
+            if 'valuesets' in parts:
+                self.pipeline.logger.log('START FROM SOR TO VALUESETS', indent_level=1)
+                #DV refs
+                for mapping in self.mappings:
+                    if isinstance(mapping, SorToValueSetMapping):
+                        with self.unit_of_work():
+                            etl.sor_to_valuesets(mapping)
+                self.pipeline.logger.log('FINISH FROM SOR TO REFS', newline=True, indent_level=1)
+
+            # DV Entities (Hubs en Sats)
+            if 'hubs' in parts:
+                self.pipeline.logger.log('START FROM SOR TO HUBS', indent_level=1)
+                self.run_task_graph(self.create_dv_task_graph(['hubs'], etl))
+                self.pipeline.logger.log('FINISH FROM SOR TO HUBS', newline=True, indent_level=1)
+
+            if 'views' in parts:
+                self.pipeline.logger.log('START FROM HUBS TO HUBS', indent_level=1)
+                for mapping in self.mappings:
+                    if isinstance(mapping, EntityViewToEntityMapping):
+                        with self.unit_of_work():
+                            etl.view_to_entity(mapping)
+                self.pipeline.logger.log('FINISH FROM HUBS TO HUBS', newline=True, indent_level=1)
+
+            # DV Links; na de views, want links kunnen verwijzen naar hubs die vanuit views worden gevuld
+            if 'links' in parts:
+                self.pipeline.logger.log('START FROM SOR TO LINKS', indent_level=1)
+                self.run_task_graph(self.create_dv_task_graph(['links'], etl))
+                self.pipeline.logger.log('FINISH FROM SOR TO LINKS', newline=True, indent_level=1)
+
+            if 'viewlinks' in parts:
+                self.pipeline.logger.log('START FROM HUBS TO LINKS', indent_level=1)
+                for mapping in self.mappings:
+                    if isinstance(mapping, EntityViewToLinkMapping):
+                        with self.unit_of_work():
+                            etl.view_to_link(mapping)
+                self.pipeline.logger.log('FINISH FROM HUBS TO LINKS', newline=True, indent_level=1)
+
+            # pit en bridge tabellen en gematerialiseerde views; na alle stappen die hubs, sats en links vullen, ook die vanuit views
+            if 'hubs' in parts or 'views' in parts or 'links' in parts or 'viewlinks' in parts:
+                self.run_task_graph(self.create_pit_task_graph(parts, etl))
 
-        #DV
-        ddl = DdlDv(self)
-        etl = EtlSorToDv(self)
-        if 'valuesets' in parts:
-            self.pipeline.logger.log('START FROM SOR TO VALUESETS', indent_level=1)
-            #DV refs
             for mapping in self.mappings:
-                if isinstance(mapping, SorToValueSetMapping):
-                    etl.sor_to_valuesets(mapping)
-            self.pipeline.logger.log('FINISH FROM SOR TO REFS', newline=True, indent_level=1)
+                if isinstance(mapping, SourceToSorMapping):
+                    etl.copy_to_exceptions_table(mapping.sor_table, self.sor)
+
+
+            #delete /tmp/datatranfser
+            if self.source_db:
+                path = self.source_db.get_or_create_datatransfer_path()
+
+
+    def run_task_graph(self, graph: TaskGraph) -> None:
+        """Voert de taken van *graph* uit op maximaal 'max_parallel_dv_tasks' (config) threads."""
+        max_parallel_dv_tasks = 1
+        if 'max_parallel_dv_tasks' in self.pipeline.config and self.pipeline.config['max_parallel_dv_tasks']:
+            max_parallel_dv_tasks = int(self.pipeline.config['max_parallel_dv_tasks'])
+        graph.run(max_parallel_dv_tasks)
+
+    def create_dv_task_graph(self, parts, etl: EtlSorToDv) -> TaskGraph:
+        """
+        Bouwt de graaf van taken voor het laden van hubs, sats en links. :meth:`run_dv` bouwt en draait een aparte graaf voor de hubs en voor de links, met de views daartussen, in dezelfde volgorde als zonder graaf:
+
+        - eerst de hub, daarna alle sats van die hub naast elkaar en als laatste de deletes (record status sat);
+        - dv-validaties wachten op alle hubs en sats;
+        - een link wacht alleen op de hubs waar hij naar verwijst en op eerdere mappings die fk's in dezelfde sor-tabel zetten;
+        - taken die dezelfde tabel vullen lopen in volgorde van de mappings na elkaar.
 
-        # DV Entities (Hubs en Sats)
+        Pit en bridge tabellen en gematerialiseerde views worden pas na de views en viewlinks bijgewerkt, zie :meth:`create_pit_task_graph`.
+
+        Met hash keys (config 'hash_keys') worden geen fk's in de sor gezet en hoeven sats en links niet op de hubs te wachten; link-sats wachten nog wel op hun link.
+
+        Met 'unit_of_work' in de config wordt elke mapping (hub of link, sats en deletes) één taak, en dus één transactie: een transactie hoort bij één connectie en kan daarom niet over taken in verschillende threads worden verdeeld. Er lopen dan alleen verschillende mappings naast elkaar.
+
+        De ddl op de sor-tabellen (extra fk-kolommen) wordt vooraf en serieel uitgevoerd.
+
+        :param parts: zie :meth:`run`
+        :param etl: het etl-object dat de taken uitvoert
+        :return: TaskGraph
+        """
+        graph = TaskGraph(self.pipeline.logger, task_context=self.unit_of_work)
+        hash_keys = self.pipeline.dwh.use_hash_keys()
+        hub_tasks = {}  # type: Dict[str, List[str]]
         if 'hubs' in parts:
-            self.pipeline.logger.log('START FROM SOR TO HUBS', indent_level=1)
             for mapping in self.mappings:
-                if type(mapping) == SorToEntityMapping:
-                    if not isinstance(mapping.source, SorQuery):
-                        DdlSor(self).try_add_fk_sor_hub(mapping)
-                    etl.sor_to_entity(mapping)
-            for validation in self.validations:
+                if type(mapping) == SorToEntityMapping and not isinstance(mapping.source, SorQuery) and not hash_keys:
+                    DdlSor(self).try_add_fk_sor_hub(mapping)
+            for index, mapping in enumerate(self.mappings):
+                if type(mapping) != SorToEntityMapping:
+                    continue
+                entity = mapping.target
+                hub = '{}.{}'.format(entity.__dbschema__, entity.cls_get_hub_name())
+                hub_writes = [hub] if hash_keys else [hub, self.__get_sor_table_name(mapping)]
+                record_status_sats = []
+                if entity.cls_has_record_status_sat():
+                    record_status_sats.append('{}.{}'.format(entity.__dbschema__, entity.cls_get_record_status_sat().cls_get_name()))
+                if self.use_unit_of_work():
+                    sats = ['{}.{}'.format(entity.__dbschema__, sat_mappings.target.cls_get_name()) for sat_mappings in mapping.sat_mappings.values()]
+                    entity_task = graph.add_task('{} {}'.format(index, mapping), etl.sor_to_entity, mapping, writes=hub_writes + sats + record_status_sats)
+                    hub_tasks.setdefault(hub, []).append(entity_task)
+                    continue
+                hub_task = graph.add_task('{} {}'.format(index, mapping), etl.sor_to_hub, mapping, writes=hub_writes)
+                hub_tasks.setdefault(hub, []).append(hub_task)
+                sat_tasks = []
+                for sat_mappings in mapping.sat_mappings.values():
+                    sat = '{}.{}'.format(entity.__dbschema__, sat_mappings.target.cls_get_name())
+                    sat_tasks.append(graph.add_task('{} {}'.format(index, sat_mappings), etl.sor_to_sat, mapping, sat_mappings, depends_on=[] if hash_keys else [hub_task], writes=[sat]))
+                graph.add_task('{} deletes {}'.format(index, mapping), etl.sor_to_hub_deletes, mapping, depends_on=[hub_task] + sat_tasks, writes=record_status_sats)
+            for index, validation in enumerate(self.validations):
                 if isinstance(validation, DvValidation):
-                    etl.validate_dv(validation)
-            self.pipeline.logger.log('FINISH FROM SOR TO HUBS', newline=True, indent_level=1)
-
-        if 'views' in parts:
-            self.pipeline.logger.log('START FROM HUBS TO HUBS', indent_level=1)
-            for mapping in self.mappings:
-                if isinstance(mapping, EntityViewToEntityMapping):
-                    ddl.create_or_alter_entity(mapping)
-                    ddl.create_or_alter_view(mapping)
-                    etl.view_to_entity(mapping)
-            self.pipeline.logger.log('FINISH FROM HUBS TO HUBS', newline=True, indent_level=1)
+                    graph.add_task('{} validate {}'.format(index, validation.msg), etl.validate_dv, validation, depends_on=list(graph.tasks.keys()))
 
-        #DV Links
         if 'links' in parts:
-            self.pipeline.logger.log('START FROM SOR TO LINKS', indent_level=1)
             for mapping in self.mappings:
-                if type(mapping) == SorToLinkMapping:
+                if type(mapping) == SorToLinkMapping and not hash_keys:
                     DdlSor(self).try_add_fk_sor_link(mapping)
-                    etl.sor_to_link(mapping)
-            self.pipeline.logger.log('FINISH FROM SOR TO LINKS', newline=True, indent_level=1)
+            for index, mapping in enumerate(self.mappings):
+                if type(mapping) != SorToLinkMapping:
+                    continue
+                link_entity = mapping.target
+                link = '{}.{}'.format(link_entity.__dbschema__, link_entity.Link.cls_get_name())
+                referenced_hub_tasks = []
+                for hub_cls in ([] if hash_keys else mapping.hubs.values()):
+                    referenced_hub_tasks.extend(hub_tasks.get('{}.{}'.format(hub_cls.__dbschema__, hub_cls.cls_get_name()), []))
+                link_writes = [link] if hash_keys else [link, self.__get_sor_table_name(mapping)]
+                record_status_sats = []
+                if link_entity.cls_has_record_status_sat():
+                    record_status_sats.append('{}.{}'.format(link_entity.__dbschema__, link_entity.cls_get_record_status_sat().cls_get_name()))
+                if self.use_unit_of_work():
+                    sats = ['{}.{}'.format(link_entity.__dbschema__, sat_mappings.target.cls_get_name()) for sat_mappings in mapping.sat_mappings.values()]
+                    graph.add_task('{} {}'.format(index, mapping), etl.sor_to_link, mapping, depends_on=referenced_hub_tasks, writes=link_writes + sats + record_status_sats)
+                    continue
+                link_task = graph.add_task('{} {}'.format(index, mapping), etl.sor_to_link_table, mapping, depends_on=referenced_hub_tasks, writes=link_writes)
+                sat_tasks = []
+                for sat_mappings in mapping.sat_mappings.values():
+                    sat = '{}.{}'.format(link_entity.__dbschema__, sat_mappings.target.cls_get_name())
+                    sat_tasks.append(graph.add_task('{} {}'.format(index, sat_mappings), etl.sor_to_sat, mapping, sat_mappings, depends_on=[link_task], writes=[sat]))
+                graph.add_task('{} deletes {}'.format(index, mapping), etl.sor_to_link_deletes, mapping, depends_on=[link_task] + sat_tasks, writes=record_status_sats)
+        return graph
+
+    def create_pit_task_graph(self, parts, etl: EtlSorToDv) -> TaskGraph:
+        """
+        Bouwt de graaf van taken die de pit tabellen (entities met __pit__) en bridge tabellen (link entities met __bridge__) bijwerken van alle hubs en links die de pipe in deze run heeft gevuld, vanuit de sor of vanuit views.
+        Gematerialiseerde views van die entities (__materialize__) worden ververst nadat hun pit is bijgewerkt.
 
-        if 'viewlinks' in parts:
-            self.pipeline.logger.log('START FROM HUBS TO LINKS', indent_level=1)
-            for mapping in self.mappings:
-                if isinstance(mapping, EntityViewToLinkMapping):
-                    ddl.create_or_alter_link(mapping)
-                    etl.view_to_link(mapping)
-            self.pipeline.logger.log('FINISH FROM HUBS TO LINKS', newline=True, indent_level=1)
+        Draait na alle stappen die hubs, sats en links vullen. Wijzigingen daarna (bijvoorbeeld via de orm) maken een pit-rij verouderd; de view van de entity valt dan terug op de actieve sat-rijen, zie :meth:`DdlDv.get_view_sql`.
 
+        :param parts: zie :meth:`run`
+        :param etl: het etl-object dat de taken uitvoert
+        :return: TaskGraph
+        """
+        graph = TaskGraph(self.pipeline.logger, task_context=self.unit_of_work)
+        entities = []
+        link_entities = []
         for mapping in self.mappings:
-            if isinstance(mapping, SourceToSorMapping):
-                etl.copy_to_exceptions_table(mapping.sor_table, self.sor)
+            if isinstance(mapping, EntityViewToEntityMapping):
+                if 'views' in parts and mapping.target not in entities:
+                    entities.append(mapping.target)
+            elif isinstance(mapping, SorToEntityMapping):
+                if 'hubs' in parts and mapping.target not in entities:
+                    entities.append(mapping.target)
+            elif isinstance(mapping, EntityViewToLinkMapping):
+                if 'viewlinks' in parts and mapping.target not in link_entities:
+                    link_entities.append(mapping.target)
+            elif isinstance(mapping, SorToLinkMapping):
+                if 'links' in parts and mapping.target not in link_entities:
+                    link_entities.append(mapping.target)
+        create_views = 'create_views' in self.pipeline.config and self.pipeline.config['create_views']
+        for entity in self.get_domain_entities():
+            if entity not in entities:
+                continue
+            view_depends_on = []
+            if entity.__pit__:
+                pit = '{}.{}'.format(entity.__dbschema__, entity.cls_get_pit_name())
+                view_depends_on.append(graph.add_task('pit {}'.format(pit), etl.update_pit, entity, writes=[pit]))
+            if entity.__materialize__ and create_views:
+                view = '{}.{}'.format(entity.__dbschema__, entity.cls_get_view_name())
+                graph.add_task('refresh {}'.format(view), etl.refresh_entity_view, entity, depends_on=view_depends_on, writes=[view])
+        for link_entity in link_entities:
+            if link_entity.__bridge__:
+                bridge = '{}.{}'.format(link_entity.Link.__dbschema__, link_entity.cls_get_bridge_name())
+                graph.add_task('bridge {}'.format(bridge), etl.update_bridge, link_entity, writes=[bridge])
+        return graph
+
+    def get_domain_entities(self) -> List['HubEntity']:
+        """Geeft alle entities uit de geregistreerde domeinen, bijvoorbeeld om hun pit tabel of gematerialiseerde view bij te werken."""
+        entities = []
+        for module in self.pipeline.domain_modules.values():
+            for name, cls in inspect.getmembers(module, inspect.isclass):
+                if HubEntity in cls.__mro__ and cls != HubEntity and cls not in entities:
+                    entities.append(cls)
+        return entities
 
+    def __get_sor_table_name(self, mapping) -> str:
+        if isinstance(mapping.source, SorQuery):
+            return '{}.{}'.format(self.sor.name, mapping.source.get_main_table())
+        return '{}.{}'.format(self.sor.name, mapping.source.name)
 
-        #delete /tmp/datatranfser
-        if self.source_db:
-            path = self.source_db.get_or_create_datatransfer_path()
+    def get_dv_table_names(self) -> List[str]:
+        """
+        Geeft de namen (schema.tabel) van alle dv- en valueset-tabellen die deze pipe vult. Wordt gebruikt om bij parallelle runs alleen de pipes na elkaar te laten lopen die dezelfde tabellen raken.
+
+        De ddl van de dv (ook die van mappings vanuit views) is dan al uitgevoerd, zie :meth:`create_dv_from_view_mappings`. EntityViewToEntityMapping en EntityViewToLinkMapping zijn subclasses van SorToEntityMapping en SorToLinkMapping en tellen dus ook mee.
 
+        :return: lijst met tabelnamen
+        """
+        table_names = set()
+        entities = []
+        for mapping in self.mappings:
+            if isinstance(mapping, SorToValueSetMapping):
+                table_names.add('{}.{}'.format(mapping.target.__dbschema__, mapping.target.cls_get_name()))
+            elif isinstance(mapping, SorToEntityMapping):
+                entity = mapping.target
+                if entity not in entities:
+                    entities.append(entity)
+                table_names.add('{}.{}'.format(entity.__dbschema__, entity.cls_get_hub_name()))
+                for sat in entity.cls_get_sats().values():
+                    table_names.add('{}.{}'.format(entity.__dbschema__, sat.cls_get_name()))
+            elif isinstance(mapping, SorToLinkMapping):
+                link_entity = mapping.target
+                table_names.add('{}.{}'.format(link_entity.__dbschema__, link_entity.Link.cls_get_name()))
+                for sat in link_entity.cls_get_sats().values():
+                    table_names.add('{}.{}'.format(link_entity.__dbschema__, sat.cls_get_name()))
+                if link_entity.__bridge__:
+                    table_names.add('{}.{}'.format(link_entity.Link.__dbschema__, link_entity.cls_get_bridge_name()))
+        # entities die alleen vanuit een view worden gevuld hoeven niet in een geregistreerd domein te staan
+        entities += [entity for entity in self.get_domain_entities() if entity not in entities]
+        for entity in entities:
+            if '{}.{}'.format(entity.__dbschema__, entity.cls_get_hub_name()) not in table_names:
+                continue
+            if entity.__pit__:
+                table_names.add('{}.{}'.format(entity.__dbschema__, entity.cls_get_pit_name()))
+            if entity.__materialize__:
+                table_names.add('{}.{}'.format(entity.__dbschema__, entity.cls_get_view_name()))
+        return list(table_names)
 
     def validate(self):
         """
@@ -15,17 +15,37 @@ class BaseProcess():
         self.sql_logger = self.pipeline.sql_logger
 
     def execute(self, sql: str, log_message: str='') -> None:
+        if self.is_failed_transaction(log_message):
+            return
         self.sql_logger.log_simple(sql + '\r\n')
         try:
             rowcount = self.dwh.execute(sql, log_message)
             self.logger.log(log_message, rowcount=rowcount, indent_level=5)
         except Exception as err:
+            self.set_transaction_failed()
+            if 'on_errors' in self.dwh.config and self.dwh.config['on_errors'] == 'throw':
+                raise Exception(err, sql, log_message)
+            else:
+                self.logger.log_error(log_message, sql, err.args[0])
+
+    def execute_copy(self, sql: str, file, log_message: str='') -> None:
+        """Voert een COPY ... FROM STDIN uit met de data uit file (zie :meth:`Database.copy_expert`)."""
+        if self.is_failed_transaction(log_message):
+            return
+        self.sql_logger.log_simple(sql + '\r\n')
+        try:
+            rowcount = self.dwh.copy_expert(sql, file, log_message)
+            self.logger.log(log_message, rowcount=rowcount, indent_level=5)
+        except Exception as err:
+            self.set_transaction_failed()
             if 'on_errors' in self.dwh.config and self.dwh.config['on_errors'] == 'throw':
                 raise Exception(err, sql, log_message)
             else:
                 self.logger.log_error(log_message, sql, err.args[0])
 
     def execute_read(self, sql: str, log_message: str='') -> List[List[Any]]:
+        if self.is_failed_transaction(log_message):
+            return []
         self.sql_logger.log_simple(sql + '\r\n')
         result = []
         try:
@@ -33,6 +53,7 @@ class BaseProcess():
 
             self.logger.log(log_message, indent_level=5)
         except Exception as err:
+            self.set_transaction_failed()
             self.logger.log_error(log_message, sql, err.args[0])
             raise Exception(err)
             # if 'on_errors' in self.dwh.pyelt_config and self.dwh.pyelt_config['on_errors'] == 'throw':
@@ -55,6 +76,20 @@ class BaseProcess():
             self.logger.log_error(log_message, sql, err.args[0])
             raise Exception(err)
 
+    def set_transaction_failed(self) -> None:
+        """Markeert de lopende unit of work (zie :meth:`Database.transaction`) als mislukt; aan het eind wordt die teruggedraaid"""
+        transaction = self.dwh.get_transaction()
+        if transaction:
+            transaction.is_failed = True
+
+    def is_failed_transaction(self, log_message: str='') -> bool:
+        """In een mislukte unit of work worden de overige statements overgeslagen: ze zouden toch worden teruggedraaid"""
+        transaction = self.dwh.get_transaction()
+        if transaction and transaction.is_failed:
+            self.logger.log('<red>OVERGESLAGEN</> ' + log_message, indent_level=5)
+            return True
+        return False
+
     def _get_fixed_params(self) -> Dict[str, Any]:
         params = {}
         params['runid'] = self.runid
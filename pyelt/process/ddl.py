@@ -1,3 +1,6 @@
+import hashlib
+from typing import Tuple
+
 from pyelt.datalayers.dm import *
 from pyelt.datalayers.dv import *
 from pyelt.datalayers.sor import *
@@ -126,7 +129,7 @@ rows: {}
             add_fields = ''
             for col in table_cls.__cols__:
                 if not col.name in db_tbl:
-                    add_fields += 'ADD COLUMN {} {}, '.format(col.name, col.type)
+                    add_fields += 'ADD COLUMN {} {}, '.format(col.name, self.__get_column_type(col))
             for constraint_name, constraint_sql in constraints.items():
                 if not constraint_name in db_tbl:
                     add_fields += 'ADD {}, '.format(constraint_sql)
@@ -146,7 +149,7 @@ rows: {}
     def __get_columns_def(self, table_cls):
         sql = ''
         for col in table_cls.cls_get_columns():
-            sql += """{} {}""".format(col.name, col.type)
+            sql += """{} {}""".format(col.name, self.__get_column_type(col))
             if not col.nullable:
                 sql += ' NOT NULL '
             if col.default_value:
@@ -156,6 +159,12 @@ rows: {}
         sql = sql[:-3]
         return sql
 
+    def __get_column_type(self, col: Column) -> str:
+        # bij hash keys is _id geen serial maar een berekende bigint; sats en links verwijzen er met bigints naar
+        if self.dwh.use_hash_keys() and (col.name == '_id' or col.name.startswith('fk_')) and col.type.lower() in ('serial', 'integer', 'int'):
+            return 'bigint'
+        return col.type
+
     def __get_constraints(self, table_cls: AbstractOrderderTable) -> str:
         constraints = {}
         pk_fields = ''
@@ -186,6 +195,9 @@ rows: {}
 
     def __get_fk_constraints(self, table_cls: AbstractOrderderTable) -> str:
         constraints = {}
+        if self.dwh.use_hash_keys():
+            # sats en links worden bij hash keys onafhankelijk van (en tegelijk met) de hub geladen
+            return constraints
         for name, ref in table_cls.__ordereddict__.items():
             if isinstance(ref, FkReference):
                 params = {}
@@ -211,6 +223,15 @@ rows: {}
                 index_name = "ix_{table_name}_{field}".format(**params)
                 params['index_name'] = index_name
                 indexes[index_name] = "CREATE INDEX {index_name} ON {schema}.{table_name}({field})".format(**params)
+        if issubclass(table_cls, (Sat, PitTable)):
+            # bij het laden wordt per _id de actieve rij opgezocht om de _hashdiff te vergelijken; views zoeken de actieve rij van de pit op
+            params = {}
+            params['schema'] = table_cls.__dbschema__
+            params['table_name'] = table_cls.__dbname__
+            params['fields'] = '_id, type' if issubclass(table_cls, HybridSat) else '_id'
+            index_name = "ix_{table_name}__id_active".format(**params)
+            params['index_name'] = index_name
+            indexes[index_name] = "CREATE INDEX {index_name} ON {schema}.{table_name}({fields}) WHERE _active".format(**params)
         return indexes
 
     def create_or_alter_functions(self, db_functions: Dict[str, DbFunction]) -> None:
@@ -331,6 +352,13 @@ class DdlSor(Ddl):
                     self.execute(sql, 'alter <blue>{}_hash</>'.format(sor_table_name))
                     sor_table.is_reflected = False
 
+        if 'dv_delta_mode' in self.dwh.config and self.dwh.config['dv_delta_mode']:
+            # in dv_delta_mode lezen hubs, sats en links alleen de sor-rijen met een _runid na hun vorige verwerking
+            if sor_table_name not in sor or 'ix_{}__runid'.format(sor_table_name) not in sor.tables[sor_table_name]:
+                sql = """CREATE INDEX IF NOT EXISTS ix_{sor_table}__runid ON {sor}.{sor_table} USING btree (_runid);""".format(**params)
+                self.execute(sql, 'create index on <blue>{}._runid</>'.format(sor_table_name))
+                sor.is_reflected = False
+
     def __get_fixed_sor_columns_def(self):
         sql = """
         _id serial NOT NULL,
@@ -373,6 +401,10 @@ class DdlSor(Ddl):
         else:
             return
 
+        if self.dwh.use_key_side_tables():
+            self.try_create_sor_keys_table(sor_table)
+            return
+
         sor = self.pipe.sor
         if not sor.is_reflected:
             sor.reflect()
@@ -401,6 +433,10 @@ class DdlSor(Ddl):
         if len(link_entity.cls_get_sats()) == 0:
             return
 
+        if self.dwh.use_key_side_tables():
+            self.try_create_sor_keys_table(mapping.source.name)
+            return
+
         sor = self.pipe.sor
         if not sor.is_reflected:
             sor.reflect()
@@ -424,6 +460,29 @@ class DdlSor(Ddl):
             self.execute(sql, 'create index on ' + fk_name)
             sor.is_reflected = False
 
+    def try_create_sor_keys_table(self, sor_table: str) -> None:
+        """Maakt de smalle tabel {sor_table}_keys aan met per sor-rij (_id) en relatie (bv. 'fk_patient_hub') de _id van de hub of link. Wordt gebruikt bij 'sor_key_resolution': 'side_table'."""
+        sor = self.pipe.sor
+        if not sor.is_reflected:
+            sor.reflect()
+
+        params = {}
+        params.update(self._get_fixed_params())
+        params['sor_table'] = sor_table
+        if sor_table + '_keys' not in sor:
+            sql = """CREATE TABLE IF NOT EXISTS {sor}.{sor_table}_keys (
+                  _id integer NOT NULL,
+                  relation text NOT NULL,
+                  fk integer,
+                  CONSTRAINT {sor_table}_keys_pkey PRIMARY KEY (relation, _id)
+            )
+            WITH (
+              OIDS=FALSE,
+              autovacuum_enabled=true
+            );""".format(**params)
+            self.execute(sql, 'create <blue>{}_keys</>'.format(sor_table))
+            sor.is_reflected = False
+
     def create_or_alter_sor_functions(self, db_function) -> None:
         sor = self.pipe.sor
         if not sor.is_reflected:
@@ -452,6 +511,8 @@ class DdlDv(Ddl):
         sats = entity.cls_get_sats()
         for sat in sats.values():
             super().create_or_alter_table(sat)
+        if entity.__pit__:
+            super().create_or_alter_table(entity.cls_get_pit())
         return
 
     def create_or_alter_link(self, link_entity: Link) -> None:
@@ -461,28 +522,61 @@ class DdlDv(Ddl):
         sats = link_entity.cls_get_sats()
         for sat in sats.values():
             super().create_or_alter_table(sat)
+        if link_entity.__bridge__:
+            super().create_or_alter_table(link_entity.cls_get_bridge())
 
     def create_or_alter_view(self, entity_cls: 'HubEntity'):
+        """Maakt de view van een entity aan: de hub met de actieve rij van elke sat. Met __materialize__ = True wordt het een tabel met dezelfde naam, zie :meth:`create_or_alter_materialized_view`."""
         schema = entity_cls.cls_get_schema(self.dwh)
         if not schema.is_reflected:
             schema.reflect()
         params = {}
         params.update(self._get_fixed_params())
         params['dv_schema'] = schema.name
+        params['view_name'] = entity_cls.cls_get_view_name()
+        params['select'] = self.get_view_sql(entity_cls)
 
-        view_name = entity_cls.cls_get_view_name()
-        params['view_name'] = view_name
-        params['hub'] = entity_cls.cls_get_hub_name()
-
-        if view_name in schema:
+        if entity_cls.__materialize__:
+            self.create_or_alter_materialized_view(schema, params['view_name'], params['select'], key='_id')
+            return
+        if params['view_name'] in schema.tables:
+            # alleen een tabel die pyelt zelf als gematerialiseerde view heeft aangemaakt mag weg
+            if not self.get_materialized_view_definition(schema, params['view_name']):
+                self.logger.log_error(params['view_name'], err_msg='Tabel {dv_schema}.{view_name} bestaat al en is geen gematerialiseerde view van pyelt; de view wordt niet aangemaakt'.format(**params))
+                return
+            sql = """DROP TABLE {dv_schema}.{view_name};""".format(**params)
+            self.execute(sql, 'drop materialized view')
+        elif params['view_name'] in schema.views:
             sql = """DROP VIEW {dv_schema}.{view_name};""".format(**params)
             self.execute(sql, 'drop view')
 
+        sql = """CREATE OR REPLACE VIEW {dv_schema}.{view_name} AS
+    {select}""".format(**params)
+        self.execute(sql, 'create <darkcyan>{}</>'.format(params['view_name']))
+        # schema.is_reflected = False
+
+    def get_view_sql(self, entity_cls: 'HubEntity') -> str:
+        """Geeft de select van de view van een entity. Wordt ook gebruikt om een gematerialiseerde view te verversen."""
+        params = {}
+        params.update(self._get_fixed_params())
+        params['dv_schema'] = entity_cls.__dbschema__
+        params['hub'] = entity_cls.cls_get_hub_name()
+
         sql_sat_fields = ''
         sql_join = ''
         sql_join_refs = ''
         index = 1
 
+        # met een pit worden de sats op hun primary key (_id, _runid) gejoind in plaats van op _active.
+        # De actieve pit-rij is actueel: de etl werkt de pit na de dv-stappen bij en de orm maakt de pit-rij inactief als hij een sat wijzigt.
+        # Zonder actieve pit-rij wordt teruggevallen op de actieve sat-rijen
+        pit_columns = {}
+        if entity_cls.__pit__:
+            pit_cls = entity_cls.cls_get_pit()
+            params['pit'] = pit_cls.cls_get_name()
+            pit_columns = {(sat_cls.cls_get_name(), type): col_name for col_name, (sat_cls, type) in pit_cls.__sat_columns__.items()}
+            sql_join += """LEFT OUTER JOIN {dv_schema}.{pit} AS pit ON pit._id = hub._id AND pit._active\r\n        """.format(**params)
+
         all_sats = entity_cls.__sats__
 
         for sat_cls in all_sats.values():
@@ -502,8 +596,13 @@ class DdlDv(Ddl):
                                 alias = sat_cls.name[idx:] + '_type'
                             sql_sat_fields += "sat{}.{} AS {}, ".format(index, col.name, alias)
 
-                    sql_join += """LEFT OUTER JOIN {dv_schema}.{sat} AS {sat_alias} ON {sat_alias}._id = hub._id AND {sat_alias}._active AND ({sat_alias}.type = '{type}' OR {sat_alias}.type IS NULL)\r\n        """.format(
-                        **params)
+                    if pit_columns:
+                        params['pit_column'] = pit_columns[(sat_cls.cls_get_name(), type)]
+                        sql_join += """LEFT OUTER JOIN {dv_schema}.{sat} AS {sat_alias} ON {sat_alias}._id = hub._id AND ({sat_alias}._runid = pit.{pit_column} OR (pit._id IS NULL AND {sat_alias}._active)) AND {sat_alias}.type = '{type}'\r\n        """.format(
+                            **params)
+                    else:
+                        sql_join += """LEFT OUTER JOIN {dv_schema}.{sat} AS {sat_alias} ON {sat_alias}._id = hub._id AND {sat_alias}._active AND ({sat_alias}.type = '{type}' OR {sat_alias}.type IS NULL)\r\n        """.format(
+                            **params)
                     index += 1
 
             else:
@@ -528,7 +627,11 @@ class DdlDv(Ddl):
 
 
                             # sql_sat_fields += self.mappings_sat_fields(sat_mapping, params['sat_alias']) + ','
-                sql_join += """LEFT OUTER JOIN {dv_schema}.{sat} AS {sat_alias} ON {sat_alias}._id = hub._id AND {sat_alias}._active\r\n        """.format(**params)
+                if pit_columns:
+                    params['pit_column'] = pit_columns[(sat_cls.cls_get_name(), '')]
+                    sql_join += """LEFT OUTER JOIN {dv_schema}.{sat} AS {sat_alias} ON {sat_alias}._id = hub._id AND ({sat_alias}._runid = pit.{pit_column} OR (pit._id IS NULL AND {sat_alias}._active))\r\n        """.format(**params)
+                else:
+                    sql_join += """LEFT OUTER JOIN {dv_schema}.{sat} AS {sat_alias} ON {sat_alias}._id = hub._id AND {sat_alias}._active\r\n        """.format(**params)
                 index += 1
 
                 # for field_map in sat_mapping.field_mappings:
@@ -547,27 +650,74 @@ class DdlDv(Ddl):
 
 
         if params['sat_fields']:
-            sql = """--DROP VIEW {dv_schema}.{view_name};
-CREATE OR REPLACE VIEW {dv_schema}.{view_name} AS
-    SELECT hub._id, hub.bk, hub.type, hub._runid, hub._source_system, True as _valid,
+            return """SELECT hub._id, hub.bk, hub.type, hub._runid, hub._source_system, True as _valid,
         {sat_fields}
     FROM {dv_schema}.{hub} hub
         {join}
     WHERE {filter}""".format(**params)
-
-            self.execute(sql, 'create <darkcyan>{}</>'.format(view_name))
         else:
-            sql = """CREATE OR REPLACE VIEW {dv_schema}.{view_name} AS
-                SELECT hub._id, hub.bk, hub.type,
+            return """SELECT hub._id, hub.bk, hub.type,
                     hub._runid as _runid, hub._source_system as hub_source_system, True as _valid
                 FROM {dv_schema}.{hub} hub
                     {join}
                 WHERE {filter}""".format(**params)
-            self.execute(sql, 'create <darkcyan>{}</>'.format(view_name))
-        # schema.is_reflected = False
+
+    def create_or_alter_materialized_view(self, schema: 'Schema', view_name: str, select_sql: str, key: str = '') -> None:
+        """Maakt een gematerialiseerde view aan als tabel, gevuld met select_sql. Een eventuele gewone view met dezelfde naam vervalt.
+
+        In het commentaar van de tabel staat een md5 van select_sql. Is de definitie gewijzigd (bijvoorbeeld een nieuwe sat), dan wordt de tabel opnieuw aangemaakt.
+        Het verversen gebeurt in de etl, zie :meth:`BaseEtl.refresh_materialized_view`.
+
+        :param key: kolom met de _id, waarop de tabel bij incrementeel verversen wordt bijgewerkt (krijgt een index)"""
+        params = {}
+        params['schema'] = schema.name
+        params['view_name'] = view_name
+        params['select'] = select_sql
+        params['key'] = key
+        params['definition'] = 'pyelt:' + hashlib.md5(select_sql.encode('utf8')).hexdigest()
+        if view_name in schema.views:
+            sql = """DROP VIEW {schema}.{view_name};""".format(**params)
+            self.execute(sql, 'drop view')
+        elif view_name in schema.tables:
+            definition = self.get_materialized_view_definition(schema, view_name)
+            if not definition:
+                self.logger.log_error(view_name, err_msg='Tabel {schema}.{view_name} bestaat al en is geen gematerialiseerde view van pyelt; de view wordt niet aangemaakt'.format(**params))
+                return
+            if definition == params['definition']:
+                return
+            sql = """DROP TABLE {schema}.{view_name};""".format(**params)
+            self.execute(sql, 'drop materialized view')
+
+        sql = """CREATE TABLE {schema}.{view_name} AS
+    {select};
+COMMENT ON TABLE {schema}.{view_name} IS '{definition}';""".format(**params)
+        if key:
+            sql += """
+CREATE INDEX ix_{view_name}_{key} ON {schema}.{view_name}({key});""".format(**params)
+        self.execute(sql, 'create materialized <darkcyan>{}</>'.format(view_name))
+
+    def get_materialized_view_definition(self, schema: 'Schema', view_name: str) -> str:
+        """:return: het commentaar ('pyelt:' + md5 van de select) van een tabel die door :meth:`create_or_alter_materialized_view` is aangemaakt; leeg als de tabel dat merkteken niet heeft"""
+        sql = """SELECT obj_description('{}.{}'::regclass, 'pg_class');""".format(schema.name, view_name)
+        rows = self.execute_read(sql, 'get definition of {}'.format(view_name))
+        if rows and rows[0][0] and rows[0][0].startswith('pyelt:'):
+            return rows[0][0]
+        return ''
 
     def create_or_alter_ensemble_view(self, ensemble_cls):
+        """Maakt de ensemble view aan; met __materialize__ = True als tabel, zie :meth:`create_or_alter_materialized_view`."""
+        dv = self.dwh.dv
+        ensemble_name, select_sql = self.get_ensemble_view_sql(ensemble_cls)
+        if ensemble_cls.__materialize__:
+            self.create_or_alter_materialized_view(dv, ensemble_name.split('.', 1)[1], select_sql)
+            return
+        params = {'ensemble': ensemble_name, 'select': select_sql}
+        sql = """CREATE OR REPLACE VIEW {ensemble} AS {select}; ALTER TABLE {ensemble} OWNER TO postgres;""".format(**params)
 
+        self.execute(sql, '<darkcyan>{}</>'.format(ensemble_name))
+
+    def get_ensemble_view_sql(self, ensemble_cls) -> Tuple[str, str]:
+        """:return: de naam (schema.naam) en de select van de ensemble view"""
         dv = self.dwh.dv
         dv.reflect()
 
@@ -618,10 +768,9 @@ CREATE OR REPLACE VIEW {dv_schema}.{view_name} AS
         if ensemble.name:  # als ensemble.name niet een lege string is dan wordt de aangemaakte string sql_ensemblename gebaseerd op de gebruikte entiteiten vervangen door de vooraf opgegeven alternatieve naam (bv 'test_view')
              sql_ensemblename = '{schema_name}.'.format(**params) + ensemble.name
 
-        params.update ({'ensemble': sql_ensemblename, 'columns': sql_columns, 'selected tables': sql_selectedtables, 'conditions': sql_conditions})
-        sql = """CREATE OR REPLACE VIEW {ensemble} AS SELECT {columns} FROM {selected tables} WHERE {conditions}; ALTER TABLE {ensemble} OWNER TO postgres;""".format(**params)
-
-        self.execute(sql, '<darkcyan>{}</>'.format(sql_ensemblename))
+        params.update ({'columns': sql_columns, 'selected tables': sql_selectedtables, 'conditions': sql_conditions})
+        sql = """SELECT {columns} FROM {selected tables} WHERE {conditions}""".format(**params)
+        return sql_ensemblename, sql
 
 
     def create_or_alter_table_valueset(self, dv_schema):
@@ -691,6 +840,11 @@ class DdlDatamart(Ddl):
 
     def create_or_alter_dim(self, dim_cls):
         super().create_or_alter_table(dim_cls)
+        if dim_cls.__scd_type__ == 2:
+            # een bestaande dim die een Scd2Dim wordt: de huidige rijen worden de eerste versie
+            params = {'dm': dim_cls.__dbschema__, 'dim': dim_cls.cls_get_name()}
+            sql = """UPDATE {dm}.{dim} SET _version = 1, _valid_from = now() WHERE _version IS NULL;""".format(**params)
+            self.execute(sql, 'init versions {}'.format(params['dim']))
 
     def create_or_alter_fact(self, fact_cls):
         super().create_or_alter_table(fact_cls)
@@ -1,15 +1,28 @@
-from typing import Any, Dict
+import datetime
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Any, Dict, List, Union
+
+import pygrametl
+from pygrametl.tables import BulkDimension, CachedDimension, SlowlyChangingDimension, TypeOneSlowlyChangingDimension
 
 from pyelt.datalayers.database import Table, Schema
-from pyelt.datalayers.dv import HybridSat
+from pyelt.datalayers.dm import Dim, Fact, DmReference
+from pyelt.datalayers.dv import HubEntity, LinkEntity, HybridSat, hash_key_sql, hashdiff_sql
 from pyelt.datalayers.sor import SorTable, SorQuery
 from pyelt.mappings.base import ConstantValue
+from pyelt.mappings.dv_to_datamart_mappings import DvToDimMapping, DvToFactMapping
 from pyelt.mappings.sor_to_dv_mappings import SorToEntityMapping, SorToLinkMapping, SorToValueSetMapping
 from pyelt.mappings.validations import DvValidation, SorValidation
-from pyelt.sources.databases import SourceTable, SourceQuery
+from pyelt.datalayers.database import DBDrivers
+from pyelt.helpers.hashing import hash_rows
+from pyelt.sources.databases import SourceTable, SourceQuery, CsvRowStream
 from pyelt.sources.files import File, CsvFile
+from pyelt.helpers.exceptions import PyeltException
+from pyelt.helpers.global_helper_functions import copy_text_value, strip_where
 from pyelt.helpers.pyelt_logging import Logger, LoggerTypes
 from pyelt.process.base import BaseProcess
+from pyelt.process.ddl import DdlDv
 
 
 class BaseEtl(BaseProcess):
@@ -60,6 +73,96 @@ WHERE NOT _valid AND  {key_values} NOT IN (SELECT key_fields FROM dv._exceptions
 
         # raise Exception(ex.args[0])
 
+    def use_fast_initial_load(self) -> bool:
+        """Met 'fast_initial_load' in de config wordt een lege sor-tabel, hub, sat of link gevuld zonder secundaire indexen, zie :meth:`initial_load`"""
+        return 'fast_initial_load' in self.dwh.config and self.dwh.config['fast_initial_load']
+
+    def is_empty_table(self, schema_name: str, table_name: str) -> bool:
+        sql = "SELECT NOT EXISTS (SELECT 1 FROM {}.{});".format(schema_name, table_name)
+        return self.execute_read(sql, 'is empty')[0][0]
+
+    @contextmanager
+    def initial_load(self, schema_name: str, table_name: str):
+        """Context manager rond het vullen van een tabel; geeft True als het om de eerste vulling gaat.
+
+        Is de tabel leeg en staat 'fast_initial_load' aan, dan worden de indexen die niet bij een constraint horen vooraf verwijderd. Na het laden worden ze in één keer opgebouwd (met 'index_build_workers' parallel) en volgt een ANALYZE. Bij honderden miljoenen historische rijen scheelt dat het bijwerken van elke index per rij.
+
+        Voorbeeld::
+
+            with self.initial_load('dv', 'patient_sat') as is_initial_load:
+                ...
+        """
+        if not self.use_fast_initial_load() or not self.is_empty_table(schema_name, table_name):
+            yield False
+            return
+        index_defs = self.__drop_secondary_indexes(schema_name, table_name)
+        try:
+            yield True
+        finally:
+            self.__create_indexes(schema_name, table_name, index_defs)
+
+    def __drop_secondary_indexes(self, schema_name: str, table_name: str) -> List[str]:
+        # indexen van primary keys en unique constraints blijven staan
+        sql = """SELECT i.indexname, i.indexdef FROM pg_indexes i
+                 WHERE i.schemaname = '{0}' AND i.tablename = '{1}'
+                 AND NOT EXISTS (SELECT 1 FROM pg_constraint c JOIN pg_namespace n ON n.oid = c.connamespace WHERE n.nspname = i.schemaname AND c.conname = i.indexname);""".format(schema_name, table_name)
+        rows = self.execute_read(sql, 'get indexes of {}'.format(table_name))
+        for row in rows:
+            self.execute('DROP INDEX {}.{};'.format(schema_name, row[0]), 'drop index {}'.format(row[0]))
+        return [row[1] for row in rows]
+
+    def __create_indexes(self, schema_name: str, table_name: str, index_defs: List[str]) -> None:
+        if index_defs and 'index_build_workers' in self.dwh.config and self.dwh.config['index_build_workers']:
+            # postgres (vanaf 11) bouwt een btree-index dan met meerdere workers
+            self.execute('SET max_parallel_maintenance_workers = {};'.format(int(self.dwh.config['index_build_workers'])), 'set index build workers')
+        for index_def in index_defs:
+            self.execute(index_def + ';', 'create index')
+        if index_defs and 'index_build_workers' in self.dwh.config and self.dwh.config['index_build_workers']:
+            self.execute('RESET max_parallel_maintenance_workers;', 'reset index build workers')
+        self.execute('ANALYZE {}.{};'.format(schema_name, table_name), 'analyze {}'.format(table_name))
+
+    def refresh_materialized_view(self, schema_name: str, view_name: str, select_sql: str, changed_sql: str = '') -> None:
+        """Ververst een gematerialiseerde view (zie :meth:`DdlDv.create_or_alter_materialized_view`) met de rijen van select_sql.
+
+        Met changed_sql (een select van _id's) worden alleen de rijen van die _id's opnieuw opgebouwd, anders de hele tabel. Verwijderen en opnieuw invoegen gebeurt in één statement, zodat lezers tot het einde de oude inhoud zien."""
+        params = {}
+        params['schema'] = schema_name
+        params['view_name'] = view_name
+        params['select'] = select_sql
+        params['changed'] = changed_sql
+        if not changed_sql or self.is_empty_table(schema_name, view_name):
+            with self.initial_load(schema_name, view_name) as is_initial_load:
+                sql = """WITH deleted AS (
+        DELETE FROM {schema}.{view_name}
+    )
+    INSERT INTO {schema}.{view_name}
+    SELECT * FROM ({select}) v;""".format(**params)
+                self.execute(sql, 'refresh <darkcyan>{}</>'.format(view_name))
+            if not is_initial_load:
+                self.execute('ANALYZE {schema}.{view_name};'.format(**params), 'analyze {}'.format(view_name))
+            return
+        sql = """WITH changed AS (
+        {changed}
+    ), deleted AS (
+        DELETE FROM {schema}.{view_name} WHERE _id IN (SELECT _id FROM changed)
+    )
+    INSERT INTO {schema}.{view_name}
+    SELECT * FROM ({select}) v WHERE v._id IN (SELECT _id FROM changed);""".format(**params)
+        self.execute(sql, 'refresh <darkcyan>{}</>'.format(view_name))
+
+    def refresh_ensemble_view(self, ensemble_cls: 'EnsembleView') -> bool:
+        """Ververst een gematerialiseerde ensemble view (__materialize__ = True). Een ensemble heeft geen eigen _id en wordt daarom altijd volledig ververst.
+
+        :return: False als er een fout is opgetreden"""
+        try:
+            ensemble_name, select_sql = DdlDv(self.pipeline).get_ensemble_view_sql(ensemble_cls)
+            schema_name, view_name = ensemble_name.split('.', 1)
+            self.refresh_materialized_view(schema_name, view_name, select_sql)
+            return True
+        except Exception as ex:
+            self.logger.log_error(ensemble_cls.__name__, err_msg=ex.args[0])
+            return False
+
 
 class EtlSourceToSor(BaseEtl):
     def __init__(self, pipe):
@@ -106,7 +209,12 @@ class EtlSourceToSor(BaseEtl):
             params['file_name'] = file_name
 
     def source_to_sor(self, mappings):
+        if mappings.watermark_column and isinstance(mappings.source, SourceTable):
+            self.source_to_sor_by_watermark(mappings)
+            return
         by_md5 = type(mappings.source) is SourceTable or type(mappings.source) is SourceQuery  # isinstance(mappings.source, SourceTable)
+        # bestanden alleen via de hash-methode als de hash in de etl wordt berekend
+        by_md5 = by_md5 or (isinstance(mappings.source, File) and self.get_hash_mode(mappings) == 'etl')
         if by_md5:
             self.source_to_sor_by_hash(mappings)
             return
@@ -124,20 +232,22 @@ class EtlSourceToSor(BaseEtl):
             params['delimiter'] = mappings.get_delimiter()
             params['quote'] = mappings.get_quote()
 
-            # STAP 1
-            if isinstance(mappings.source, SourceTable):
-                file_name = mappings.source.to_csv(filter=mappings.filter, ignore_fields=mappings.ignore_fields, debug=debug)
-                params['file_name'] = file_name
-                # self.logger.log('  source to csv'.format(mappings))
-
-            # STAP 2
+            # STAP 1 en 2
             sql = "TRUNCATE TABLE {sor}.{temp_table};".format(**params)
             self.execute(sql, 'truncate {}'.format(params['temp_table']))
 
             # STAP 3 Bron data naar temp
-            # we faken de quote voor textvelden opdat json velden (met dubbele quotes) goed worden ingelezen en later eenvoudig zijn te parsen naar jsonb
-            sql = "COPY {sor}.{temp_table} ({fields}) FROM  '{file_name}' DELIMITER '{delimiter}' CSV HEADER ENCODING '{encoding}' QUOTE '{quote}';".format(**params)
-            self.execute(sql, 'copy into {}'.format(params['temp_table']))
+            if isinstance(mappings.source, SourceTable):
+                self.source_to_temp(mappings, params['temp_table'], params['fields'], filter=mappings.filter, debug=debug)
+            elif self.is_streaming_datatransfer():
+                # bestand wordt door de etl-server gelezen en doorgestuurd; de dwh-server hoeft het bestand niet te kunnen zien
+                sql = "COPY {sor}.{temp_table} ({fields}) FROM STDIN DELIMITER '{delimiter}' CSV HEADER ENCODING '{encoding}' QUOTE '{quote}';".format(**params)
+                with open(params['file_name'], 'rb') as fp:
+                    self.execute_copy(sql, fp, 'copy into {}'.format(params['temp_table']))
+            else:
+                # we faken de quote voor textvelden opdat json velden (met dubbele quotes) goed worden ingelezen en later eenvoudig zijn te parsen naar jsonb
+                sql = "COPY {sor}.{temp_table} ({fields}) FROM  '{file_name}' DELIMITER '{delimiter}' CSV HEADER ENCODING '{encoding}' QUOTE '{quote}';".format(**params)
+                self.execute(sql, 'copy into {}'.format(params['temp_table']))
 
             # STAP 4a
             # sql = """INSERT INTO {sor}.{sor_table}(_runid, _insert_date, _hash, _revision, {fields})
@@ -204,20 +314,13 @@ class EtlSourceToSor(BaseEtl):
             params['fields_compare'] = mappings.get_fields_compare(source_alias='tmp', target_alias='hstg')
             params['keys_compare'] = mappings.get_keys_compare(source_alias='tmp', target_alias='hstg')
 
-              # STAP 1 data van database in csv file
-            if isinstance(mappings.source, SourceTable):
-                file_name = mappings.source.to_csv(md5_only=True, filter=mappings.filter, ignore_fields=mappings.ignore_fields, debug=debug)
-                params['file_name'] = file_name
-            # self.logger.log_simple('    source hash to csv'.format(mappings))
-
-            # STAP 2
+            # STAP 1 en 2
             sql = "TRUNCATE TABLE {sor}.{temp_table}_hash;".format(**params)
             self.execute(sql, 'truncate temp')
 
-            # STAP 3 Bron data naar temp_hash
-            sql = "COPY {sor}.{temp_table}_hash ({key_fields}, _hash) FROM  '{file_name}' DELIMITER ';' CSV HEADER;".format(
-                    **params)
-            self.execute(sql, 'copy into temp hash')
+            # STAP 3 hash-keys van bron database naar temp_hash
+            self.source_to_temp(mappings, params['temp_table'] + '_hash', params['key_fields'] + ', _hash', md5_only=True, filter=mappings.filter, debug=debug,
+                                log_message='copy into temp hash')
 
             # STAP 4a kijk of sor_table al data bevat zo ja dan wijzigingen bepalen. Zo nee dan alle data ophalen
             sql = "SELECT COUNT(*) FROM {sor}.{sor_table};".format(**params)
@@ -228,8 +331,6 @@ class EtlSourceToSor(BaseEtl):
             sql = "TRUNCATE TABLE {sor}.{temp_table};".format(**params)
             self.execute(sql, 'truncate temp')
 
-            filter = ''
-            i = 0
             if rowcount > 0:
                 # STAP 4 bepaal wijzigingen van temp tov laatste sor data
                 # CM : Vergelijk alleen met actieve records.
@@ -237,57 +338,16 @@ class EtlSourceToSor(BaseEtl):
                         **params)
                 self.execute(sql, 'set status(changed) of temp')
 
-                # STAP 5 haal alle data op uit bron
-                # maak where IN
-
+                # STAP 5 en 7 haal alleen de gewijzigde rijen op uit bron. De sleutels gaan in één keer (set-based) naar de bron, zie SourceTable.load_by_keys
                 sql = """SELECT {key_fields} FROM {sor}.{temp_table}_hash WHERE _changed;""".format(**params)
-                # changed_keys = []
-                changed_keys_str = ''
-                rows = self.dwh.engine.execute(sql)
-                # if len(rows) > 1000:
-                #     debug = True
-                for row in rows:
-                    i += 1
-                    keys_concat = ''.join(list(row))
-                    changed_keys_str += "'{}',".format(keys_concat)
-                    if i % 1000 == 0:
-
-                        changed_keys_str = changed_keys_str[:-1]
-                        key_concat = params['key_fields'].replace(',', '||')
-                        filter = 'WHERE {} IN ({})'.format(key_concat, changed_keys_str)
-                        file_name = mappings.source.to_csv(md5_only=False, filter=filter,  ignore_fields=mappings.ignore_fields, debug=debug)
-                        params['file_name'] = file_name
-
-                        sql = "COPY {sor}.{temp_table} ({fields}) FROM  '{file_name}' DELIMITER ';' CSV HEADER;".format(
-                            **params)
-
-                        self.execute(sql, 'copy into temp row {} - {}'.format(i, i+ 1000))
-
-                        changed_keys_str = ''
-
-                changed_keys_str = changed_keys_str[:-1]
-                if changed_keys_str.strip():
-                # changed_keys_str = ','.join(changed_keys)
-                    key_concat = params['key_fields'].replace(',', '||')
-                    filter = 'WHERE {} IN ({})'.format(key_concat, changed_keys_str)
-                # self.logger.log_simple('    generated where in sql'.format(mappings))
-                else:
-                    # CM: zonder gewijzigde records nooit iets ophalen
-                    filter= 'WHERE 1=2'
+                # via de connectie van de pipe: in een unit of work is de update van _changed nog niet gecommit
+                changed_keys = [tuple(row) for row in self.execute_read(sql, 'get changed keys')]
+                self.source_to_temp(mappings, params['temp_table'], params['fields'], changed_keys=changed_keys, debug=debug,
+                                    log_message='copy changed into temp')
             else:
-                filter = mappings.filter
-
-            #STAP 5b
-            if isinstance(mappings.source, SourceTable):
-                file_name = mappings.source.to_csv(md5_only=False, filter=filter, ignore_fields=mappings.ignore_fields, debug=debug)
-                params['file_name'] = file_name
-            # self.logger.log_simple('    source complete to csv'.format(mappings))
-
-
-
-            # STAP 7 Bron data naar temp
-            sql = "COPY {sor}.{temp_table} ({fields}) FROM  '{file_name}' DELIMITER ';' CSV HEADER;".format(**params)
-            self.execute(sql, 'copy into temp row {} - end'.format(i))
+                # STAP 5b en 7 Bron data naar temp
+                self.source_to_temp(mappings, params['temp_table'], params['fields'], filter=mappings.filter, debug=debug,
+                                    log_message='copy into temp')
 
             # STAP 7a Update _hash
             params['tmp_fields'] = mappings.get_fields(alias='tmp')
@@ -296,32 +356,163 @@ class EtlSourceToSor(BaseEtl):
             sql = "UPDATE {sor}.{temp_table} tmp set _hash = tmp_hash._hash FROM {sor}.{temp_table}_hash tmp_hash WHERE  {keys_compare};".format(**params)
             self.execute(sql, 'update _hash in temp')
 
-            # STAP 8  insert into sor
-            sql = """INSERT INTO {sor}.{sor_table}(_runid, _source_system, _insert_date, _hash, {fields})
-                SELECT {runid},'{source_system}', now(), tmp._hash, {tmp_fields}
+            with self.initial_load(params['sor'], params['sor_table']) as is_initial_load:
+                # STAP 8  insert into sor
+                sql = """INSERT INTO {sor}.{sor_table}(_runid, _source_system, _insert_date, _hash, {fields})
+                    SELECT {runid},'{source_system}', now(), tmp._hash, {tmp_fields}
+                    FROM {sor}.{temp_table} tmp
+                     --JOIN {sor}.{temp_table}_hash tmp_hash ON {keys_compare};""".format(**params)
+                self.execute(sql, 'insert new into sor')
+
+                if not is_initial_load:
+                    # bij de eerste vulling is er geen vorige versie: revisies en actieve records hoeven niet bijgewerkt
+                    params['keys_compare'] = mappings.get_keys_compare(source_alias='previous', target_alias='current')
+
+                    # STAP 9a SET revisienummers
+                    sql = """UPDATE {sor}.{sor_table} current SET _revision = previous._revision + 1
+                            --FROM (SELECT {key_fields}, max(_revision) as _revision, max(_runid) as _runid FROM {sor}.{sor_table} WHERE _active = TRUE GROUP BY {key_fields}) as previous
+                            FROM {sor}.{sor_table} previous
+                            WHERE current._active = True AND previous._active = True AND previous._runid < current._runid AND {keys_compare};
+                            --current._revision = 0 AND {keys_compare};""".format(**params)
+                    self.execute(sql, 'update sor set _revision')
+
+                    # STAP 9b SET actieve records
+                    sql = """UPDATE {sor}.{sor_table} previous SET _active = False, _finish_date = current._insert_date
+                            FROM {sor}.{sor_table} current WHERE previous._active = True AND ({keys_compare}) AND current._revision = (previous._revision + 1);""".format(
+                        **params)
+                    self.execute(sql, 'update sor set old ones inactive')
+
+
+        except Exception as ex:
+            self.logger.log_error(mappings.name, err_msg=ex.args[0])
+
+    def source_to_sor_by_watermark(self, mappings):
+        """Incrementeel laden op basis van de watermark_column van de mapping.
+
+        Alleen rijen met een waarde tussen de vorige high-water mark (uit sys.watermarks) en de huidige hoogste waarde in de bron worden opgehaald. Verwijderde rijen worden gevonden met een aparte pass die alleen de sleutels ophaalt.
+        De nieuwe high-water mark wordt pas opgeslagen als alle stappen zijn gelukt."""
+        try:
+            debug = 'debug' in self.pipe.pipeline.config and self.pipe.pipeline.config['debug']
+
+            params = mappings.__dict__
+            params.update(self._get_fixed_params())
+            params['fields'] = mappings.get_fields()
+            params['key_fields'] = mappings.get_keys()
+            params['tmp_fields'] = mappings.get_fields(alias='tmp')
+            params['keys_compare'] = mappings.get_keys_compare(source_alias='tmp', target_alias='hstg')
+            watermark_name = 'sor:{sor}.{sor_table}'.format(**params)
+            error_count = len(self.logger.errors)
+
+            # STAP 1 huidige hoogste waarde in bron bepalen, voordat de data wordt opgehaald; rijen die tijdens het laden binnenkomen worden de volgende run meegenomen
+            last_value = self.dwh.get_watermark(watermark_name)
+            high_value = mappings.source.get_max_value_literal(mappings.watermark_column, mappings.filter)
+
+            # STAP 2 gewijzigde rijen naar temp
+            sql = "TRUNCATE TABLE {sor}.{temp_table};".format(**params)
+            self.execute(sql, 'truncate temp')
+            if high_value is not None:
+                filters = ['{} <= {}'.format(mappings.watermark_column, high_value)]
+                if last_value is not None:
+                    filters.append('{} > {}'.format(mappings.watermark_column, last_value))
+                if mappings.filter:
+                    filters.append('({})'.format(strip_where(mappings.filter)))
+                self.source_to_temp(mappings, params['temp_table'], params['fields'], filter=' AND '.join(filters), debug=debug,
+                                    log_message='copy changed since {} into temp'.format(last_value))
+
+            # STAP 3 insert into sor, ongewijzigde rijen (bijvoorbeeld bij gelijke watermark) worden overgeslagen
+            sql = """INSERT INTO {sor}.{sor_table}(_runid, _source_system, _insert_date, _hash, _active, {fields})
+                SELECT {runid}, '{source_system}', now(), '', True, {tmp_fields}
                 FROM {sor}.{temp_table} tmp
-                 --JOIN {sor}.{temp_table}_hash tmp_hash ON {keys_compare};""".format(**params)
+                WHERE NOT EXISTS (SELECT 1 FROM {sor}.{sor_table} hstg WHERE hstg._active AND ({keys_compare})
+                    AND (ROW({tmp_fields}) IS NOT DISTINCT FROM ROW({hstg_fields})));""".format(hstg_fields=mappings.get_fields(alias='hstg'), **params)
             self.execute(sql, 'insert new into sor')
 
+            # STAP 4 revisienummers en oude versies inactief
             params['keys_compare'] = mappings.get_keys_compare(source_alias='previous', target_alias='current')
-
-            # STAP 9a SET revisienummers
             sql = """UPDATE {sor}.{sor_table} current SET _revision = previous._revision + 1
-                        --FROM (SELECT {key_fields}, max(_revision) as _revision, max(_runid) as _runid FROM {sor}.{sor_table} WHERE _active = TRUE GROUP BY {key_fields}) as previous
                         FROM {sor}.{sor_table} previous
-                        WHERE current._active = True AND previous._active = True AND previous._runid < current._runid AND {keys_compare};
-                        --current._revision = 0 AND {keys_compare};""".format(**params)
+                        WHERE current._runid = {runid} AND current._active = True AND previous._active = True AND previous._runid < current._runid AND {keys_compare};""".format(**params)
             self.execute(sql, 'update sor set _revision')
 
-            # STAP 9b SET actieve records
             sql = """UPDATE {sor}.{sor_table} previous SET _active = False, _finish_date = current._insert_date
-                        FROM {sor}.{sor_table} current WHERE previous._active = True AND ({keys_compare}) AND current._revision = (previous._revision + 1);""".format(
+                        FROM {sor}.{sor_table} current WHERE current._runid = {runid} AND previous._active = True AND ({keys_compare}) AND current._revision = (previous._revision + 1);""".format(
                 **params)
             self.execute(sql, 'update sor set old ones inactive')
 
+            # STAP 5 verwijderde rijen: alleen de sleutels van de hele bron ophalen
+            sql = "TRUNCATE TABLE {sor}.{temp_table}_hash;".format(**params)
+            self.execute(sql, 'truncate temp hash')
+            key_names = mappings.source.primary_keys()
+            key_columns = [col.name for col in mappings.source.columns if col.name in key_names]
+            self.source_to_temp(mappings, params['temp_table'] + '_hash', ','.join(key_columns), filter=mappings.filter, debug=debug,
+                                ignore_fields=[col.name for col in mappings.source.columns if col.name not in key_names], log_message='copy keys into temp hash')
+
+            params['keys_compare'] = mappings.get_keys_compare(source_alias='tmp', target_alias='hstg')
+            sql = """UPDATE {sor}.{sor_table} hstg SET _deleted_runid = {runid}, _active = FALSE, _finish_date = now()
+                    WHERE _active AND NOT EXISTS (SELECT 1 FROM {sor}.{temp_table}_hash tmp WHERE {keys_compare});""".format(**params)
+            if not debug:
+                # in debug wordt maar een deel van de bron opgehaald
+                self.execute(sql, 'update sor set deleted ones')
+
+            # bij een fout (execute en execute_copy loggen die alleen) blijft de oude watermark staan, zodat de volgende run dezelfde rijen opnieuw ophaalt
+            if high_value is not None and not debug and len(self.logger.errors) == error_count and not self.is_failed_transaction('set watermark'):
+                self.dwh.set_watermark(watermark_name, high_value, self.runid)
 
         except Exception as ex:
-            self.logger.log_error(mappings.name, err_msg=ex.args[0])
+            self.logger.log_error(mappings.name, ex=ex)
+
+    def is_streaming_datatransfer(self) -> bool:
+        """Met 'datatransfer_mode': 'stream' in de config gaat de data zonder tussenbestand van de bron via COPY FROM STDIN naar de dwh."""
+        config = self.pipe.pipeline.config
+        return 'datatransfer_mode' in config and config['datatransfer_mode'] == 'stream'
+
+    def get_hash_mode(self, mappings) -> str:
+        """'source': de hash wordt in de sql van de bron berekend (md5 in Oracle, Postgres en SQL Server).
+        'etl': de hash wordt tijdens het streamen van de rijen in de etl berekend (zie pyelt.helpers.hashing). Werkt voor elke bron, ook MySQL en bestanden.
+
+        In te stellen per mapping (hash_mode) of voor de hele pipeline in de config ('hash_mode'). MySQL kent geen hash in de bron en gebruikt altijd 'etl'."""
+        if mappings.hash_mode:
+            return mappings.hash_mode
+        if isinstance(mappings.source, SourceTable) and mappings.source.db.driver == DBDrivers.MYSQL:
+            return 'etl'
+        config = self.pipe.pipeline.config
+        if 'hash_mode' in config and config['hash_mode']:
+            return config['hash_mode']
+        return 'source'
+
+    def source_to_temp(self, mappings, temp_table, fields, md5_only=False, filter='', debug=False, log_message='', changed_keys=None, ignore_fields=None):
+        """Kopieert data uit de bron database naar een temp tabel in de sor.
+
+        Standaard via een csv-bestand in de datatransfer_path dat de dwh-server inleest. Bij datatransfer_mode 'stream' worden de rijen vanuit de bron-cursor direct in COPY FROM STDIN gestreamd.
+
+        :param temp_table: naam van de temp tabel in de sor
+        :param fields: kolommen van de temp tabel, in volgorde van de bron query
+        :param md5_only: alleen keys en hash ophalen
+        :param changed_keys: iterable met sleutel-tuples; alleen de rijen met deze sleutels worden opgehaald
+        :param ignore_fields: velden van de bron die niet worden opgehaald, standaard de ignore_fields van de mapping
+        """
+        if not log_message:
+            log_message = 'copy into {}'.format(temp_table)
+        if ignore_fields is None:
+            ignore_fields = mappings.ignore_fields
+        params = self._get_fixed_params()
+        params['temp_table'] = temp_table
+        params['fields'] = fields
+        if md5_only and self.get_hash_mode(mappings) == 'etl':
+            field_names = [col.name for col in mappings.source.columns if col.name not in ignore_fields]
+            rows = mappings.source.get_rows(filter=filter, ignore_fields=ignore_fields, debug=debug)
+            stream = CsvRowStream(hash_rows(rows, field_names, mappings.source.primary_keys()))
+            sql = "COPY {sor}.{temp_table} ({fields}) FROM STDIN DELIMITER ';' CSV;".format(**params)
+            self.execute_copy(sql, stream, log_message)
+        elif self.is_streaming_datatransfer() or isinstance(mappings.source, File):
+            # bestanden komen hier alleen langs bij hash_mode 'etl'; de rijen worden dan door de etl gelezen
+            stream = mappings.source.to_stream(md5_only=md5_only, filter=filter, ignore_fields=ignore_fields, debug=debug, keys=changed_keys)
+            sql = "COPY {sor}.{temp_table} ({fields}) FROM STDIN DELIMITER ';' CSV;".format(**params)
+            self.execute_copy(sql, stream, log_message)
+        else:
+            params['file_name'] = mappings.source.to_csv(md5_only=md5_only, filter=filter, ignore_fields=ignore_fields, debug=debug, keys=changed_keys)
+            sql = "COPY {sor}.{temp_table} ({fields}) FROM  '{file_name}' DELIMITER ';' CSV HEADER;".format(**params)
+            self.execute(sql, log_message)
 
     def validate_duplicate_keys(self, mappings, sor_schema):
         try:
@@ -400,97 +591,225 @@ class EtlSorToDv(BaseEtl):
         return params
 
     def sor_to_entity(self, mappings: 'SorToEntityMapping'):
+        """Laadt de hub en daarna achtereenvolgens alle sats van de entity.
+
+        Bij parallelle verwerking in de pipe worden :meth:`sor_to_hub`, :meth:`sor_to_sat` en :meth:`sor_to_hub_deletes` als losse taken uitgevoerd."""
+        if not self.sor_to_hub(mappings):
+            return
+        for sat_mappings in mappings.sat_mappings.values():
+            self.sor_to_sat(mappings, sat_mappings)
+        self.sor_to_hub_deletes(mappings)
+
+    def get_dv_watermark_name(self, mappings) -> str:
+        return 'dv:{}:{}'.format(self.pipe.sor.name, mappings.name)
+
+    def get_dv_delta_filter(self, watermark_name: str) -> str:
+        """Filter op de sor-rijen (hstg) voor een hub, sat of link: bij 'dv_delta_mode' alleen de rijen die na de vorige verwerking door deze mapping zijn toegevoegd, anders alle rijen."""
+        if not self.dwh.use_dv_delta_mode():
+            return '1=1'
+        last_runid = self.dwh.get_watermark(watermark_name)
+        if last_runid is None:
+            return '1=1'
+        return 'hstg._runid > {}'.format(last_runid)
+
+    def save_dv_watermark(self, watermark_name: str, error_count: int) -> None:
+        """Legt vast dat de mapping de sor-rijen t/m deze run heeft verwerkt. Als er sinds error_count fouten zijn gelogd (ook door andere taken) gebeurt dat niet; de volgende run leest die rijen dan opnieuw."""
+        if not ('dv_delta_mode' in self.dwh.config and self.dwh.config['dv_delta_mode']):
+            return
+        transaction = self.dwh.get_transaction()
+        if len(self.logger.errors) > error_count or (transaction and transaction.is_failed):
+            return
+        self.dwh.set_watermark(watermark_name, str(self.runid), self.runid)
+
+    def prepare_hub_params(self, mappings: 'SorToEntityMapping') -> Dict[str, Any]:
+        """Parameters van de hub voor de hub, de sats en de deletes. Elke taak krijgt een eigen kopie, zodat taken van dezelfde mapping in verschillende threads elkaars parameters niet overschrijven.
+
+        sat_id is de sql-expressie (op de sor-rij hstg) voor de _id van de hub: de fk-kolom in de sor, of bij hash keys de hash van de business key."""
+        params = dict(mappings.__dict__)
+        params['filter'] = mappings.filter or '1=1'
+        dv_schema = mappings.target.cls_get_schema(self.dwh)
+        params.update(self._get_fixed_params())
+        params['dv_schema'] = dv_schema.name
+        params['hub'] = mappings.target.cls_get_hub_name()
+        params['hub_type'] = mappings.target.cls_get_hub_type()
+        params['filter_type'] = '1=1'
+        if mappings.type:
+            params['hub_type'] = mappings.type
+            params['filter_type'] = "type = '{}'".format(mappings.type)
+        params['sor_table'] = mappings.source.name
+        if isinstance(mappings.source, SorQuery):
+            params['sor_table'] = mappings.source.get_main_table()
+        params['relation_type'] = mappings.type
+        params['filter_runid'] = '1=1'
+        params['sat_join'] = ''
+        params['sat_id'] = 'hstg.fk_{relation_type}{hub}'.format(**params)
+        params['sor_keys_relation'] = 'fk_{relation_type}{hub}'.format(**params)
+        if self.dwh.use_hash_keys() and mappings.bk_mapping:
+            params['sat_id'] = hash_key_sql(mappings.bk_mapping)
+        elif self.dwh.use_key_side_tables():
+            params['sat_id'] = 'hstg_keys.fk'
+            params['sat_join'] = "JOIN {sor}.{sor_table}_keys hstg_keys ON hstg_keys._id = hstg._id AND hstg_keys.relation = '{sor_keys_relation}'".format(**params)
+        return params
+
+    def __insert_sor_keys(self, params: Dict[str, Any], from_sql: str, where_sql: str, fk_sql: str = 'hub._id') -> None:
+        """Legt bij 'sor_key_resolution': 'side_table' per sor-rij de _id van de hub of link vast in {sor_table}_keys, in plaats van de fk-kolom in de sor-tabel bij te werken.
+
+        from_sql moet de sor-rij als hstg bevatten; fk_sql is de _id van de hub of link daarin. Rijen die al bekend zijn worden overgeslagen."""
+        params['keys_from'] = from_sql
+        params['keys_where'] = where_sql
+        params['keys_fk'] = fk_sql
+        sql = """INSERT INTO {sor}.{sor_table}_keys (_id, relation, fk)
+SELECT DISTINCT ON (hstg._id) hstg._id, '{sor_keys_relation}', {keys_fk}
+FROM {keys_from}
+WHERE {keys_where}
+ON CONFLICT (relation, _id) DO NOTHING;""".format(**params)
+        self.execute(sql, 'insert into {}_keys'.format(params['sor_table']))
+
+    def sor_to_hub(self, mappings: 'SorToEntityMapping') -> bool:
+        """Vult de hub en zet de fk naar de hub in de sor-tabel.
+
+        Bij hash keys (zie :meth:`Dwh.use_hash_keys`) wordt de _id uit de business key berekend en blijft de sor-tabel ongewijzigd; de sats hoeven dan niet op de hub te wachten.
+        Bij side tables (zie :meth:`Dwh.use_key_side_tables`) komt de fk niet in de sor-tabel maar in {sor_table}_keys.
+
+        :return: False als er een fout is opgetreden"""
         self.logger.log('START <blue>{}</>'.format(mappings), indent_level=3)
         try:
-            if not mappings.filter:
-                mappings.filter = '1=1'
-            params = mappings.__dict__
-            dv_schema = mappings.target.cls_get_schema(self.dwh)
-            params.update(self._get_fixed_params())
-            params['dv_schema'] = dv_schema.name
-            params['hub'] = mappings.target.cls_get_hub_name()
-            if 'zorgactiviteit' in str(mappings):
-                debug = True
-            params['hub_type'] = mappings.target.cls_get_hub_type()
-            params['filter_type'] = '1=1'
-            if mappings.type:
-                params['hub_type'] = mappings.type
-                params['filter_type'] = "type = '{}'".format(mappings.type)
-            params['sor_table'] = mappings.source.name
-            params['relation_type'] = mappings.type
+            params = self.prepare_hub_params(mappings)
             # params['filter_hub'] = params['filter']
+            watermark_name = self.get_dv_watermark_name(mappings)
+            params['filter_delta'] = self.get_dv_delta_filter(watermark_name)
+            error_count = len(self.logger.errors)
+            with self.initial_load(params['dv_schema'], params['hub']):
+                self.__load_hub(mappings, params)
+            self.save_dv_watermark(watermark_name, error_count)
+            return True
+        except Exception as ex:
+            self.logger.log_error(mappings.name, err_msg=ex.args[0])
+            return False
 
-            sql = "SELECT COUNT(*) FROM {dv_schema}.{hub} WHERE {filter_type};".format(**params)
-            result = self.execute_read(sql, 'get rowcount')
-            rowcount_hub = result[0][0]
+    def __load_hub(self, mappings: 'SorToEntityMapping', params: Dict[str, Any]) -> None:
+        if self.dwh.use_hash_keys() and mappings.bk_mapping:
+            params['from'] = "{sor}.{sor_table} hstg".format(**params)
+            if isinstance(mappings.source, SorQuery):
+                params['from'] = "({}) hstg".format(mappings.source.sql)
+            sql = """INSERT INTO {dv_schema}.{hub} (_id, _runid, _insert_date, _source_system, type, bk)
+SELECT DISTINCT {sat_id}, {runid}, now(), '{source_system}', '{hub_type}', {bk_mapping}
+FROM {from}
+WHERE hstg._valid AND ({bk_mapping}) IS NOT NULL AND NOT EXISTS (SELECT 1 FROM {dv_schema}.{hub} hub WHERE hub._id = {sat_id}) AND {filter} AND {filter_delta};""".format(
+                **params)
+            self.execute(sql, 'insert new '.format(params['hub']))
+            self.__validate_hash_key_collisions(mappings, params)
+            return
 
-            if rowcount_hub == 0:
-                params['filter_runid'] = '1=1'
-            else:
-                params['filter_runid'] = 'floor(hstg._runid) = floor({runid})'.format(**params)
+        sql = "SELECT COUNT(*) FROM {dv_schema}.{hub} WHERE {filter_type};".format(**params)
+        result = self.execute_read(sql, 'get rowcount')
+        rowcount_hub = result[0][0]
 
-            if mappings.bk_mapping and isinstance(mappings.source, SorTable):
-                sql = """INSERT INTO {dv_schema}.{hub} (_runid, _insert_date, _source_system, type, bk)
+        if rowcount_hub == 0:
+            params['filter_runid'] = '1=1'
+        else:
+            params['filter_runid'] = 'floor(hstg._runid) = floor({runid})'.format(**params)
+
+        if mappings.bk_mapping and isinstance(mappings.source, SorTable):
+            sql = """INSERT INTO {dv_schema}.{hub} (_runid, _insert_date, _source_system, type, bk)
 SELECT DISTINCT {runid}, now(), '{source_system}', '{hub_type}', {bk_mapping}
 FROM {sor}.{sor_table} hstg
-WHERE hstg._valid AND ({bk_mapping}) IS NOT NULL AND NOT EXISTS (SELECT 1 FROM {dv_schema}.{hub} WHERE bk = ({bk_mapping})) AND {filter}
---AND {filter_runid};""".format(
-                    **params)
-                self.execute(sql, 'insert new '.format(params['hub']))
+WHERE hstg._valid AND ({bk_mapping}) IS NOT NULL AND NOT EXISTS (SELECT 1 FROM {dv_schema}.{hub} WHERE bk = ({bk_mapping})) AND {filter} AND {filter_delta};""".format(
+                **params)
+            self.execute(sql, 'insert new '.format(params['hub']))
 
-                # onderstaande regels voor performance
-                sql = """SELECT hub._id FROM {dv_schema}.{hub} hub JOIN {sor}.{sor_table} hstg ON {bk_mapping} = hub.bk WHERE hstg._valid AND {filter}
---AND {filter_runid};""".format(
-                    **params)
-                self.execute(sql, 'load hub_ids in mem (performance)')
+            # onderstaande regels voor performance
+            sql = """SELECT hub._id FROM {dv_schema}.{hub} hub JOIN {sor}.{sor_table} hstg ON {bk_mapping} = hub.bk WHERE hstg._valid AND {filter} AND {filter_delta};""".format(
+                **params)
+            self.execute(sql, 'load hub_ids in mem (performance)')
 
-                sql = """UPDATE {sor}.{sor_table} hstg SET fk_{relation_type}{hub} = hub._id FROM {dv_schema}.{hub} hub WHERE {bk_mapping} = hub.bk AND hstg._valid AND {filter}
---AND {filter_runid};""".format(
-                    **params)
-                self.execute(sql, 'update fk_hub in sor table')
-            elif mappings.bk_mapping and isinstance(mappings.source, SorQuery):
-                params['sql'] = mappings.source.sql
-                params['sor_table'] = mappings.source.main_table
+            if self.dwh.use_key_side_tables():
+                self.__insert_sor_keys(params, '{sor}.{sor_table} hstg JOIN {dv_schema}.{hub} hub ON {bk_mapping} = hub.bk'.format(**params),
+                                       'hstg._valid AND {filter} AND {filter_delta}'.format(**params))
+                return
+            sql = """UPDATE {sor}.{sor_table} hstg SET fk_{relation_type}{hub} = hub._id FROM {dv_schema}.{hub} hub WHERE {bk_mapping} = hub.bk AND hstg._valid AND {filter} AND {filter_delta};""".format(
+                **params)
+            self.execute(sql, 'update fk_hub in sor table')
+        elif mappings.bk_mapping and isinstance(mappings.source, SorQuery):
+            params['sql'] = mappings.source.sql
+            params['sor_table'] = mappings.source.main_table
 
-                sql = """INSERT INTO {dv_schema}.{hub} (_runid, _insert_date, _source_system, type, bk)
+            sql = """INSERT INTO {dv_schema}.{hub} (_runid, _insert_date, _source_system, type, bk)
 SELECT DISTINCT {runid}, now(), '{source_system}', '{hub_type}', {bk_mapping}
 FROM ({sql}) hstg
 WHERE hstg._valid AND ({bk_mapping}) IS NOT NULL
 AND NOT EXISTS (SELECT 1 FROM {dv_schema}.{hub} hub WHERE hub.bk = {bk_mapping})
-AND {filter} AND {filter_runid};""".format( **params)
-                self.execute(sql, 'insert new '.format(params['hub']))
-
-                if mappings.source.update_query_fk_hub:
-                    sql = mappings.source.update_query_fk_hub
-                    self.execute(sql, 'update fk_hub in sor table')
-                else:
-                    sql = """SELECT * FROM ({sql}) as q""".format(**params)
-                    self.execute(sql, 'load in mem performance')
+AND {filter} AND {filter_runid} AND {filter_delta};""".format( **params)
+            self.execute(sql, 'insert new '.format(params['hub']))
+
+            if self.dwh.use_key_side_tables():
+                # de query moet hiervoor de _id van de hoofdtabel teruggeven
+                self.__insert_sor_keys(params, '({sql}) hstg JOIN {dv_schema}.{hub} hub ON {bk_mapping} = hub.bk'.format(**params),
+                                       'hstg._valid AND {filter} AND {filter_runid} AND {filter_delta}'.format(**params))
+            elif mappings.source.update_query_fk_hub:
+                sql = mappings.source.update_query_fk_hub
+                self.execute(sql, 'update fk_hub in sor table')
+            else:
+                sql = """SELECT * FROM ({sql}) as q""".format(**params)
+                self.execute(sql, 'load in mem performance')
 
-                    sql = """WITH sorquery as (SELECT {bk_mapping} as bk FROM ({sql}) hstg
-    WHERE hstg._valid AND {filter} AND {filter_runid})
+                sql = """WITH sorquery as (SELECT {bk_mapping} as bk FROM ({sql}) hstg
+    WHERE hstg._valid AND {filter} AND {filter_runid} AND {filter_delta})
     UPDATE {sor}.{sor_table} hstg SET fk_{relation_type}{hub} = hub._id FROM {dv_schema}.{hub} hub JOIN sorquery ON sorquery.bk = hub.bk""".format(**params)
-                    self.execute(sql, 'update fk_hub in sor table')
-
-            elif mappings.key_mappings:
-                target_key_sat = ''
-                compare_key_fields = ''
-                for key_mapping in mappings.key_mappings:
-                    target_key_sat = key_mapping.target.table.name
-                    compare_key_fields += "hstg.{} = key_sat.{} AND ".format(key_mapping.source, key_mapping.target)
-                compare_key_fields = compare_key_fields[:-5]
-                params['target_key_sat'] = target_key_sat
-                params['compare_key_fields'] = compare_key_fields
-                sql = """UPDATE {sor}.{sor_table} hstg SET fk_{relation_type}{hub} = hub._id FROM {dv_schema}.{hub} hub, {dv_schema}.{target_key_sat} key_sat WHERE hub._id = key_sat._id AND key_sat._active AND {compare_key_fields} AND hstg._valid AND {filter_hub};""".format(
-                    **params)
                 self.execute(sql, 'update fk_hub in sor table')
 
-            # fk_name = "fk_{relation_type}{hub}".format(**params)
-            # EtlSourceToSor(self.pipe).validate_duplicate_fks(mappings.source, dv_schema, fk_name)
+        elif mappings.key_mappings:
+            target_key_sat = ''
+            compare_key_fields = ''
+            for key_mapping in mappings.key_mappings:
+                target_key_sat = key_mapping.target.table.name
+                compare_key_fields += "hstg.{} = key_sat.{} AND ".format(key_mapping.source, key_mapping.target)
+            compare_key_fields = compare_key_fields[:-5]
+            params['target_key_sat'] = target_key_sat
+            params['compare_key_fields'] = compare_key_fields
+            if self.dwh.use_key_side_tables():
+                self.__insert_sor_keys(params, '{sor}.{sor_table} hstg JOIN {dv_schema}.{target_key_sat} key_sat ON {compare_key_fields} AND key_sat._active JOIN {dv_schema}.{hub} hub ON hub._id = key_sat._id'.format(**params),
+                                       'hstg._valid AND {filter} AND {filter_delta}'.format(**params))
+                return
+            sql = """UPDATE {sor}.{sor_table} hstg SET fk_{relation_type}{hub} = hub._id FROM {dv_schema}.{hub} hub, {dv_schema}.{target_key_sat} key_sat WHERE hub._id = key_sat._id AND key_sat._active AND {compare_key_fields} AND hstg._valid AND {filter} AND {filter_delta};""".format(
+                **params)
+            self.execute(sql, 'update fk_hub in sor table')
+
+        # fk_name = "fk_{relation_type}{hub}".format(**params)
+        # EtlSourceToSor(self.pipe).validate_duplicate_fks(mappings.source, dv_schema, fk_name)
+
+    def __validate_hash_key_collisions(self, mappings: 'SorToEntityMapping', params: Dict[str, Any]) -> None:
+        """Bij hash keys slaat de insert in de hub een bk over als er al een rij met dezelfde _id is. Is de bk van die rij een andere, dan hebben twee bk's dezelfde hash: de sats van de nieuwe bk zouden dan aan de verkeerde hub-rij komen te hangen. Zo'n botsing wordt als fout gelogd."""
+        sql = """SELECT DISTINCT hub._id, hub.bk, ({bk_mapping}) AS sor_bk
+FROM {from} JOIN {dv_schema}.{hub} hub ON hub._id = {sat_id}
+WHERE hstg._valid AND hub.bk <> ({bk_mapping}) AND {filter} AND {filter_delta}
+LIMIT 10;""".format(**params)
+        rows = self.execute_read(sql, 'validate hash key collisions')
+        if rows:
+            collisions = ', '.join(["{} en {} (_id {})".format(row[1], row[2], row[0]) for row in rows])
+            self.logger.log_error(mappings.name, err_msg='hash key botsing in {}: {}'.format(params['hub'], collisions))
+
+    def sor_to_sat(self, mappings, sat_mappings) -> bool:
+        """Vult 1 sat van een entity of link. Verwacht dat de hub of link van de mapping al geladen is, behalve bij een entity met hash keys.
 
-            for sat_mappings in mappings.sat_mappings.values():
-                self.__sor_to_sat(params, sat_mappings)
+        :return: False als er een fout is opgetreden"""
+        try:
+            if isinstance(mappings, SorToEntityMapping):
+                params = self.prepare_hub_params(mappings)
+            else:
+                params = self.prepare_link_params(mappings)
+            watermark_name = self.get_dv_watermark_name(sat_mappings)
+            error_count = len(self.logger.errors)
+            self.__sor_to_sat(params, sat_mappings, self.get_dv_delta_filter(watermark_name))
+            self.save_dv_watermark(watermark_name, error_count)
+            return True
+        except Exception as ex:
+            self.logger.log_error(sat_mappings.name, err_msg=ex.args[0])
+            return False
 
+    def sor_to_hub_deletes(self, mappings: 'SorToEntityMapping') -> bool:
+        try:
+            params = self.prepare_hub_params(mappings)
             # deletes
             hub_entity = mappings.target  # type: HubEntity
             if hub_entity.cls_has_record_status_sat():
@@ -499,31 +818,30 @@ AND {filter} AND {filter_runid};""".format( **params)
                                     SELECT _id, {runid}, '{source_system}', now(), now()
                                     FROM {dv_schema}.{hub}
         WHERE _id NOT IN (SELECT _id FROM {dv_schema}.{record_satus_sat}) AND
-              _id IN (SELECT fk_{relation_type}{hub}
-                        FROM sor_test_system.traject_hstage hstg
+              _id IN (SELECT {sat_id}
+                        FROM {sor}.{sor_table} hstg {sat_join}
                         WHERE hstg._deleted_runid = {runid})""".format(**params)
                 self.execute(sql, 'update deleted records')
             self.logger.log('FINISH {}'.format(mappings), indent_level=3)
+            return True
         except Exception as ex:
             self.logger.log_error(mappings.name, err_msg=ex.args[0])
+            return False
 
-    def __sor_to_sat(self, params, sat_mappings):
+    def __sor_to_sat(self, params, sat_mappings, filter_delta='1=1'):
         self.logger.log('START {}'.format(sat_mappings), indent_level=4)
-        satparams = sat_mappings.__dict__
+        satparams = dict(sat_mappings.__dict__)
         satparams.update(self._get_fixed_params())
         sat_cls = sat_mappings.target
         satparams['dv_schema'] = params['dv_schema']
         satparams['sat'] = sat_cls.cls_get_name()
-        if satparams['sat'] == 'afspraak_sat_identificatie':
-            bedug = True
-
         if 'hub' in params:
             satparams['hub_or_link'] = params['hub']
             satparams['relation_type'] = params['relation_type']
         else:
             satparams['hub_or_link'] = params['link']
             satparams['relation_type'] = ''
-        satparams['filter'] = params['filter']
+        satparams['filter'] = '{} AND {}'.format(params['filter'], filter_delta)
         satparams['filter_runid'] = params['filter_runid']
         satparams['sor_fields'] = sat_mappings.get_source_fields(alias='hstg')
         satparams['sat_fields'] = sat_mappings.get_sat_fields()
@@ -531,6 +849,10 @@ AND {filter} AND {filter_runid};""".format( **params)
         satparams['from'] = "{sor}.{sor_table} AS hstg".format(**params)
         if isinstance(sat_mappings.source, SorQuery):
             satparams['from'] = "({}) AS hstg".format(sat_mappings.source.sql)
+        # _id van de hub of link: fk-kolom in de sor, of bij hash keys de berekende hash (zie prepare_hub_params en prepare_link_params)
+        satparams['sat_id'] = params['sat_id'] if 'sat_id' in params else 'hstg.fk_{relation_type}{hub_or_link}'.format(**satparams)
+        if 'sat_join' in params and params['sat_join']:
+            satparams['from'] += ' ' + params['sat_join']
 
         # sql = "SELECT COUNT(*) FROM {dv_schema}.{sat};".format(**satparams)
         # result = self.execute_read(sql, 'get rowcount')
@@ -541,61 +863,58 @@ AND {filter} AND {filter_runid};""".format( **params)
         # else:
         #     satparams['filter_runid'] = 'floor(hstg._runid) = floor({runid})'.format(**params)
 
+        satparams['type_filter'] = ''
+        satparams['type_field'] = ''
+        satparams['type_value'] = ''
         if sat_cls.__base__ == HybridSat:
-            sql = """INSERT INTO {dv_schema}.{sat} (_id, _runid, type, _source_system, _insert_date, _revision, {sat_fields})
-                    SELECT DISTINCT ON(fk_{relation_type}{hub_or_link})  fk_{relation_type}{hub_or_link}, {runid}, '{type}', '{source_system}', now(), 0, {sor_fields}
-                    FROM {from} WHERE hstg._valid AND hstg._active AND hstg.fk_{relation_type}{hub_or_link} IS NOT NULL AND {filter}
-                    --AND NOT EXISTS (SELECT 1 FROM {dv_schema}.{sat} sat where sat._id = fk_{relation_type}{hub_or_link} and sat._runid = {runid} AND type = '{type}')
-                    --AND {filter_runid}
-                    EXCEPT
-                    SELECT _id, {runid}, '{type}', '{source_system}', now(), 0, {sat_fields}
-                    FROM {dv_schema}.{sat} sat
-                    WHERE _active AND type = '{type}';""".format(
-                **satparams)
-            self.execute(sql, 'insert new in sat')
-
-            # oude is nog actief, maar runid is kleiner. Dit is het laatste record
-            sql = """update {dv_schema}.{sat} current set _revision = previous._revision + 1
-                    from {dv_schema}.{sat} previous where current._active = True AND previous._active = True AND previous._id = current._id and previous._runid < current._runid AND current.type = '{type}' AND previous.type = '{type}';""".format(
-                **satparams)
-            self.execute(sql, 'update sat revision')
-            # nu oude inctief maken
-            sql = """update {dv_schema}.{sat} previous set _active = False, _finish_date = current._insert_date
-                    from {dv_schema}.{sat} current where previous._active = True AND previous._id = current._id and previous._runid < current._runid AND current.type = '{type}' AND previous.type = '{type}';""".format(
-                **satparams)
-            self.execute(sql, 'update sat set old ones inactive')
-
-            self.logger.log('FINISH {}'.format(sat_mappings), indent_level=4)
-        else:
-            # satparams['from'] = "{sor}.{sor_table} AS hstg".format(**params)
-            # if isinstance(sat_mappings.source, SorQuery):
-            #     satparams['from'] = "({}) AS hstg".format(sat_mappings.source.sql)
-
-
-            sql = """INSERT INTO {dv_schema}.{sat} (_id, _runid, _source_system, _insert_date, _revision, {sat_fields})
-                    SELECT DISTINCT ON(fk_{relation_type}{hub_or_link}) fk_{relation_type}{hub_or_link}, {runid}, '{source_system}', now(), 0, {sor_fields}
-                    FROM {from} WHERE hstg._valid AND hstg._active AND hstg.fk_{relation_type}{hub_or_link} IS NOT NULL AND {filter}
-                    --AND NOT EXISTS (SELECT 1 FROM {dv_schema}.{sat} sat where sat._id = fk_{relation_type}{hub_or_link} and sat._runid = {runid})
-                    -- AND {filter_runid}
-                    EXCEPT
-                    SELECT _id, {runid}, '{source_system}', now(), 0, {sat_fields}
-                    FROM {dv_schema}.{sat} sat
-                    WHERE sat._active;""".format(
-                **satparams)
-            self.execute(sql, 'insert new in sat')
-
-            # oude is nog actief, maar runid is kleiner. Dit is het laatste record
-            sql = """update {dv_schema}.{sat} current set _revision = previous._revision + 1
-                    from {dv_schema}.{sat} previous where current._active = True AND previous._active = True AND previous._id = current._id and previous._runid < current._runid;""".format(
-                **satparams)
-            self.execute(sql, 'update sat revision')
-            # nu oude inctief maken
-            sql = """update {dv_schema}.{sat} previous set _active = False, _finish_date = current._insert_date
-                    from {dv_schema}.{sat} current where previous._active = True AND previous._id = current._id and previous._runid < current._runid;""".format(
-                **satparams)
-            self.execute(sql, 'update sat set old ones inactive')
-
-            self.logger.log('FINISH {}'.format(sat_mappings), indent_level=4)
+            satparams['type_filter'] = "AND sat.type = '{type}'".format(**satparams)
+            satparams['type_field'] = 'type, '
+            satparams['type_value'] = "'{type}', ".format(**satparams)
+        sat_field_names = satparams['sat_fields'].split(',')
+        satparams['src_sat_fields'] = ', '.join(['src.' + name for name in sat_field_names])
+        satparams['sat_sat_fields'] = ', '.join(['sat.' + name for name in sat_field_names])
+        satparams['changed_fields'] = ', '.join(['changed.' + name for name in sat_field_names])
+        satparams['src_hashdiff'] = hashdiff_sql(['src.' + name for name in sat_field_names])
+
+        with self.initial_load(satparams['dv_schema'], satparams['sat']) as is_initial_load:
+            if is_initial_load:
+                # lege sat: alles is nieuw, er valt niets te vergelijken of af te sluiten
+                sql = """WITH src_fields (_id, {sat_fields}) AS (
+                    SELECT DISTINCT ON({sat_id}) {sat_id}, {sor_fields}
+                    FROM {from} WHERE hstg._valid AND hstg._active AND {sat_id} IS NOT NULL AND {filter})
+                INSERT INTO {dv_schema}.{sat} (_id, _runid, {type_field}_source_system, _insert_date, _revision, _hashdiff, {sat_fields})
+                SELECT src._id, {runid}, {type_value}'{source_system}', now(), 0, {src_hashdiff}, {src_sat_fields}
+                FROM src_fields src;""".format(**satparams)
+                self.execute(sql, 'insert all in empty sat')
+            else:
+                self.__sor_to_sat_changes(satparams)
+
+        self.logger.log('FINISH {}'.format(sat_mappings), indent_level=4)
+
+    def __sor_to_sat_changes(self, satparams: Dict[str, Any]) -> None:
+        # wijzigingen bepalen, oude versies afsluiten en nieuwe versies toevoegen in één statement met één scan van de sat:
+        # src: actuele sor-rij per _id met de _hashdiff van de velden; changed: nieuw of afwijkende _hashdiff t.o.v. de actieve sat-rij;
+        # closed: afgesloten oude versies met hun revisie.
+        # Sat-rijen zonder _hashdiff (van voor deze kolom, of niet door de etl geschreven) worden veld voor veld vergeleken.
+        sql = """WITH src_fields (_id, {sat_fields}) AS (
+                    SELECT DISTINCT ON({sat_id}) {sat_id}, {sor_fields}
+                    FROM {from} WHERE hstg._valid AND hstg._active AND {sat_id} IS NOT NULL AND {filter}),
+                src AS (
+                    SELECT src.*, {src_hashdiff} AS _hashdiff FROM src_fields src),
+                changed AS (
+                    SELECT src.* FROM src
+                    LEFT JOIN {dv_schema}.{sat} sat ON sat._id = src._id AND sat._active {type_filter}
+                    WHERE sat._id IS NULL
+                    OR (sat._hashdiff IS NOT NULL AND sat._hashdiff <> src._hashdiff)
+                    OR (sat._hashdiff IS NULL AND ROW({src_sat_fields}) IS DISTINCT FROM ROW({sat_sat_fields}))),
+                closed AS (
+                    UPDATE {dv_schema}.{sat} sat SET _active = False, _finish_date = now()
+                    FROM changed WHERE sat._id = changed._id AND sat._active {type_filter}
+                    RETURNING sat._id, sat._revision)
+                INSERT INTO {dv_schema}.{sat} (_id, _runid, {type_field}_source_system, _insert_date, _revision, _hashdiff, {sat_fields})
+                SELECT changed._id, {runid}, {type_value}'{source_system}', now(), COALESCE(closed._revision + 1, 0), changed._hashdiff, {changed_fields}
+                FROM changed LEFT JOIN closed ON closed._id = changed._id;""".format(**satparams)
+        self.execute(sql, 'insert new in sat, set old ones inactive')
 
     def __sor_to_sat_old(self, params, sat_mappings):
         self.logger.log('    START {}'.format(sat_mappings))
@@ -679,25 +998,70 @@ AND {filter} AND {filter_runid};""".format( **params)
                 self.logger.log('    FINISH {}'.format(sat_mappings))
 
     def sor_to_link(self, mappings):
+        """Laadt de link en daarna achtereenvolgens alle sats van de link.
+
+        Bij parallelle verwerking in de pipe worden :meth:`sor_to_link_table`, :meth:`sor_to_sat` en :meth:`sor_to_link_deletes` als losse taken uitgevoerd."""
+        if not self.sor_to_link_table(mappings):
+            return
+        for sat_mappings in mappings.sat_mappings.values():
+            self.sor_to_sat(mappings, sat_mappings)
+        self.sor_to_link_deletes(mappings)
+
+    def sor_to_link_table(self, mappings) -> bool:
+        """Vult de link tabel en zet (bij link-sats) de fk naar de link in de sor-tabel.
+
+        :return: False als er een fout is opgetreden"""
         self.logger.log('  START {}'.format(mappings))
         try:
-            if not mappings.filter:
-                mappings.filter = '1=1'
-            params = mappings.__dict__
-            params.update(self._get_fixed_params())
-            dv_schema = mappings.target.cls_get_schema(self.dwh)
-            params['dv_schema'] = dv_schema.name
-            params['link'] = mappings.target.Link.cls_get_name()
-            params['link_type'] = mappings.type
-            params['sor_table'] = mappings.source.name
-            params['source_fks'] = self.__get_link_source_fks(mappings)
-            params['source_fks_is_not_null'] = self.__get_link_source_fks_is_not_null(mappings)
-            params['source_fks_is_null'] = params['source_fks_is_not_null'].replace('NOT ', '')
-            params['target_fks'] = self.__get_link_target_fks(mappings)
+            params = self.prepare_link_params(mappings)
+            watermark_name = self.get_dv_watermark_name(mappings)
+            params['filter_delta'] = self.get_dv_delta_filter(watermark_name)
+            error_count = len(self.logger.errors)
+            with self.initial_load(params['dv_schema'], params['link']):
+                if self.dwh.use_hash_keys():
+                    self.__sor_to_link_table_by_hash_keys(params)
+                else:
+                    self.__load_link(mappings, params)
+            self.save_dv_watermark(watermark_name, error_count)
+            return True
+        except Exception as ex:
+            self.logger.log_error(mappings.name, err_msg=ex.args[0])
+            return False
 
-            params['join'] = self.__get_link_join(mappings, schema_name=self.pipe.sor.name)
-            params['fks_compare'] = self.__get_link_fks_compare(mappings, source_alias='hstg', target_alias='link')
+    def prepare_link_params(self, mappings: 'SorToLinkMapping') -> Dict[str, Any]:
+        """Parameters van de link voor de link, de link-sats en de deletes. Elke taak krijgt een eigen kopie, zodat taken van dezelfde mapping in verschillende threads elkaars parameters niet overschrijven.
 
+        sat_id en sat_join bepalen (op de sor-rij hstg) de _id van de link: de fk-kolom in de sor, de fk in {sor_table}_keys of bij hash keys de hash van de fk's."""
+        params = dict(mappings.__dict__)
+        params['filter'] = mappings.filter or '1=1'
+        params.update(self._get_fixed_params())
+        dv_schema = mappings.target.cls_get_schema(self.dwh)
+        params['dv_schema'] = dv_schema.name
+        params['link'] = mappings.target.Link.cls_get_name()
+        params['link_type'] = mappings.type
+        params['sor_table'] = mappings.source.name
+        params['filter_runid'] = '1=1'
+        params['source_fks'] = self.__get_link_source_fks(mappings)
+        params['source_fks_is_not_null'] = self.__get_link_source_fks_is_not_null(mappings)
+        params['source_fks_is_null'] = params['source_fks_is_not_null'].replace('NOT ', '')
+        params['target_fks'] = self.__get_link_target_fks(mappings)
+
+        params['sat_id'] = 'hstg.fk_{type}{link}'.format(**params)
+        params['sat_join'] = ''
+        if self.dwh.use_hash_keys():
+            self.__set_link_hash_key_params(mappings, params)
+            return params
+        join_aliases = {}  # type: Dict[int, str]
+        params['join'] = self.__get_link_join(mappings, schema_name=self.pipe.sor.name, aliases=join_aliases)
+        params['fks_compare'] = self.__get_link_fks_compare(mappings, source_alias='hstg', target_alias='link')
+        if self.dwh.use_key_side_tables():
+            self.__set_link_side_table_params(mappings, params, join_aliases)
+        return params
+
+    def __load_link(self, mappings: 'SorToLinkMapping', params: Dict[str, Any]) -> None:
+        if self.dwh.use_dv_delta_mode():
+            params['filter'] = 'hstg._active'
+        else:
             sql = "SELECT COUNT(*) FROM {dv_schema}.{link};".format(**params)
             result = self.execute_read(sql, 'get rowcount')
             rowcount_link = result[0][0]
@@ -707,42 +1071,124 @@ AND {filter} AND {filter_runid};""".format( **params)
             else:
                 params['filter'] = 'floor(hstg._runid) = floor({runid})'.format(**params)
 
-            sql = """
-            INSERT INTO {dv_schema}.{link} (_runid, _source_system, _insert_date, type, {target_fks})
-            SELECT DISTINCT {runid}, '{source_system}', now(), '{link_type}', {source_fks}
-            FROM {sor}.{sor_table} hstg {join}
-            WHERE {filter}
-            AND NOT ({source_fks_is_null})
-            AND NOT EXISTS (SELECT 1 FROM {dv_schema}.{link} link WHERE {fks_compare} AND link.type='{link_type}') AND {filter};""".format(**params)
-            self.execute(sql,  'insert new links')
-
-            if len(mappings.sat_mappings) > 0:
-                # todo refactor
-                from_sql = ''
-                where_sql = ''
-                for field_mapping in mappings.field_mappings:
-                    join = field_mapping.join
-                    if field_mapping.bk:
-                        join_tbl = field_mapping.get_source_table()
-                        from_sql += ', dv.{}'.format(join_tbl)
-                        where_sql += 'dv.{}.bk = {} AND '.format(join_tbl, field_mapping.bk)
-                # from_sql = from_sql[:-1]
-                where_sql = where_sql[:-5]
-
-                params['from'] = from_sql
-                params['where'] = where_sql
-
-                sql = """UPDATE {sor}.{sor_table} hstg SET fk_{type}{link} = link._id
+        sql = """
+        INSERT INTO {dv_schema}.{link} (_runid, _source_system, _insert_date, type, {target_fks})
+        SELECT DISTINCT {runid}, '{source_system}', now(), '{link_type}', {source_fks}
+        FROM {sor}.{sor_table} hstg {join}
+        WHERE {filter} AND {filter_delta}
+        AND NOT ({source_fks_is_null})
+        AND NOT EXISTS (SELECT 1 FROM {dv_schema}.{link} link WHERE {fks_compare} AND link.type='{link_type}') AND {filter};""".format(**params)
+        self.execute(sql,  'insert new links')
+
+        if len(mappings.sat_mappings) > 0 and self.dwh.use_key_side_tables():
+            self.__insert_sor_keys(params, '{sor}.{sor_table} hstg {join} JOIN {dv_schema}.{link} link ON {fks_compare} AND link.type = \'{link_type}\''.format(**params),
+                                   'hstg._valid AND {filter} AND {filter_delta}'.format(**params), fk_sql='link._id')
+        elif len(mappings.sat_mappings) > 0:
+            # todo refactor
+            from_sql = ''
+            where_sql = ''
+            for field_mapping in mappings.field_mappings:
+                join = field_mapping.join
+                if field_mapping.bk:
+                    join_tbl = field_mapping.get_source_table()
+                    from_sql += ', dv.{}'.format(join_tbl)
+                    where_sql += 'dv.{}.bk = {} AND '.format(join_tbl, field_mapping.bk)
+            # from_sql = from_sql[:-1]
+            where_sql = where_sql[:-5]
+
+            params['from'] = from_sql
+            params['where'] = where_sql
+
+            sql = """UPDATE {sor}.{sor_table} hstg SET fk_{type}{link} = link._id
 FROM {dv_schema}.{link} link {from}
 WHERE {fks_compare} AND {where}
-AND hstg._valid AND {filter};""".format(
-                    **params)
+AND hstg._valid AND {filter} AND {filter_delta};""".format(
+                **params)
 
-                self.execute(sql, 'update fk_link in sor table')
+            self.execute(sql, 'update fk_link in sor table')
+
+    def __set_link_hash_key_params(self, mappings: 'SorToLinkMapping', params: Dict[str, Any]) -> None:
+        """Bij hash keys worden de fk's naar de hubs en de _id van de link uit de business keys berekend; link-sats rekenen dezelfde _id uit, met dezelfde joins."""
+        source_fks = self.__get_link_hash_key_fks(mappings)
+        params['source_fks'] = ', '.join(source_fks)
+        params['source_fks_is_null'] = ' AND '.join(['{} IS NULL'.format(fk) for fk in source_fks])
+        params['join'] = self.__get_link_join(mappings, schema_name=self.pipe.sor.name, join_hubs=False)
+        link_key = "'{}'".format(mappings.type) + ''.join([" || '|' || coalesce(({})::text, '')".format(fk) for fk in source_fks])
+        params['link_id'] = hash_key_sql(link_key)
+        params['sat_id'] = params['link_id']
+        params['sat_join'] = params['join']
+
+    def __sor_to_link_table_by_hash_keys(self, params: Dict[str, Any]) -> None:
+        """Vult de link met hash keys (zie :meth:`__set_link_hash_key_params`). Er wordt niets opgezocht in de hubs en niets teruggeschreven in de sor."""
+        sql = """
+            INSERT INTO {dv_schema}.{link} (_id, _runid, _source_system, _insert_date, type, {target_fks})
+            SELECT DISTINCT {link_id}, {runid}, '{source_system}', now(), '{link_type}', {source_fks}
+            FROM {sor}.{sor_table} hstg {join}
+            WHERE hstg._valid AND hstg._active AND NOT ({source_fks_is_null}) AND {filter} AND {filter_delta}
+            AND NOT EXISTS (SELECT 1 FROM {dv_schema}.{link} link WHERE link._id = {link_id});""".format(**params)
+        self.execute(sql, 'insert new links')
+
+    def __set_link_side_table_params(self, mappings: 'SorToLinkMapping', params: Dict[str, Any], join_aliases: Dict[int, str]) -> None:
+        """Bij 'sor_key_resolution': 'side_table' staan de fk's naar de hubs niet in de sor-tabel maar in {sor_table}_keys. Voegt per fk een join met die tabel toe en past source_fks en fks_compare daarop aan.
+
+        :param join_aliases: de aliassen van de bron-tabellen per field_mapping, zoals :meth:`__get_link_join` ze heeft uitgedeeld"""
+        source_fks = []
+        fks_compare = []
+        keys_join = ''
+        for index, field_mapping in enumerate(mappings.field_mappings):
+            if isinstance(field_mapping.source, ConstantValue):
+                source_fk = '{}'.format(field_mapping.source)
+            elif field_mapping.is_view_mapping:
+                source_fk = '{}.{}'.format(field_mapping.source.table, field_mapping.source)
+            elif field_mapping.bk:
+                source_fk = '{}.{}'.format(field_mapping.source_alias, field_mapping.source)
+            else:
+                source_alias = join_aliases.get(index, 'hstg')
+                keys_alias = 'keys{}'.format(index)
+                keys_join += " LEFT JOIN {}.{}_keys {} ON {}._id = {}._id AND {}.relation = '{}' \r\n".format(
+                    self.pipe.sor.name, field_mapping.get_source_table(), keys_alias, keys_alias, source_alias, keys_alias, field_mapping.source.name)
+                source_fk = '{}.fk'.format(keys_alias)
+            source_fks.append(source_fk)
+            fks_compare.append('COALESCE({}, 0) = COALESCE(link.{}, 0)'.format(source_fk, field_mapping.target))
+        params['source_fks'] = ', '.join(source_fks)
+        params['source_fks_is_null'] = ' AND '.join(['{} IS NULL'.format(fk) for fk in source_fks])
+        params['join'] += keys_join
+        params['fks_compare'] = ' AND '.join(fks_compare)
+        params['sor_keys_relation'] = 'fk_{type}{link}'.format(**params)
+        params['sat_id'] = 'hstg_keys.fk'
+        params['sat_join'] = "JOIN {sor}.{sor_table}_keys hstg_keys ON hstg_keys._id = hstg._id AND hstg_keys.relation = '{sor_keys_relation}'".format(**params)
+
+    def __get_link_hash_key_fks(self, mappings: 'SorToLinkMapping') -> List[str]:
+        """sql-expressies voor de fk's van de link bij hash keys.
+
+        Bij map_bk de hash van de bk; bij map_sor_fk de hash van de bk van de entity-mapping die die fk in de sor zou vullen."""
+        fks = []
+        for field_mapping in mappings.field_mappings:
+            if isinstance(field_mapping.source, ConstantValue):
+                fks.append('{}'.format(field_mapping.source))
+            elif field_mapping.bk:
+                fks.append(hash_key_sql(field_mapping.bk))
+            elif field_mapping.is_view_mapping:
+                fks.append('{}.{}'.format(field_mapping.source.table, field_mapping.source))
+            else:
+                bk_mapping = self.__find_bk_mapping_of_sor_fk(field_mapping.get_source_table(), field_mapping.source.name)
+                if not bk_mapping:
+                    raise PyeltException('Hash keys: geen SorToEntityMapping met bk gevonden die {} in {} vult'.format(field_mapping.source.name, field_mapping.get_source_table()))
+                fks.append(hash_key_sql(bk_mapping))
+        return fks
 
-            for sat_mappings in mappings.sat_mappings.values():
-                self.__sor_to_sat(params, sat_mappings)
+    def __find_bk_mapping_of_sor_fk(self, sor_table: str, fk_name: str) -> str:
+        for mapping in self.pipe.mappings:
+            if type(mapping) != SorToEntityMapping or not mapping.bk_mapping:
+                continue
+            mapping_table = mapping.source.get_main_table() if isinstance(mapping.source, SorQuery) else mapping.source.name
+            if mapping_table == sor_table and 'fk_{}{}'.format(mapping.type, mapping.target.cls_get_hub_name()) == fk_name:
+                return mapping.bk_mapping
+        return ''
 
+    def sor_to_link_deletes(self, mappings) -> bool:
+        try:
+            params = self.prepare_link_params(mappings)
             #deletes
             link_entity = mappings.target #type: LinkEntity
             if link_entity.cls_has_record_status_sat():
@@ -752,17 +1198,115 @@ AND hstg._valid AND {filter};""".format(
                             FROM {dv_schema}.{link}
 WHERE _id NOT IN (SELECT _id FROM {dv_schema}.{record_satus_sat}) AND
       ({target_fks}) IN (SELECT {source_fks}
-                            FROM sor_test_system.traject_hstage hstg
+                            FROM {sor}.{sor_table} hstg
                               {join}
   WHERE hstg._deleted_runid = {runid})""".format(**params)
                 self.execute(sql, 'update deleted records')
 
+            self.logger.log('  FINISH {}'.format(mappings))
+            return True
+        except Exception as ex:
+            self.logger.log_error(mappings.name, err_msg=ex.args[0])
+            return False
 
+    def update_pit(self, entity_cls: 'HubEntity') -> bool:
+        """Werkt de point-in-time tabel van een entity (__pit__ = True) bij, nadat de hub en alle sats zijn geladen.
 
+        :return: False als er een fout is opgetreden"""
+        try:
+            filter = "hub.type = '{}'".format(entity_cls.__subtype__) if entity_cls.__subtype__ else '1=1'
+            self.__update_pit_table(entity_cls.cls_get_pit(), entity_cls.cls_get_hub_name(), 'hub', filter)
+            return True
+        except Exception as ex:
+            self.logger.log_error(entity_cls.cls_get_pit_name(), err_msg=ex.args[0])
+            return False
 
-            self.logger.log('  FINISH {}'.format(mappings))
+    def refresh_entity_view(self, entity_cls: 'HubEntity') -> bool:
+        """Ververst de gematerialiseerde view van een entity (__materialize__ = True), nadat de hub, de sats en een eventuele pit zijn bijgewerkt.
+
+        Alleen de _id's waarvan in deze run de hub of een sat is gewijzigd worden opnieuw opgebouwd. Met 'materialized_full_refresh' in de config wordt de hele tabel ververst, bijvoorbeeld om gewijzigde omschrijvingen uit valuesets mee te nemen.
+
+        :return: False als er een fout is opgetreden"""
+        try:
+            params = self._get_fixed_params()
+            params['dv_schema'] = entity_cls.__dbschema__
+            params['hub'] = entity_cls.cls_get_hub_name()
+            changed_sql = 'SELECT _id FROM {dv_schema}.{hub} WHERE _runid = {runid}'.format(**params)
+            for sat_cls in entity_cls.cls_get_sats().values():
+                params['sat'] = sat_cls.cls_get_name()
+                changed_sql += '\r\n        UNION SELECT _id FROM {dv_schema}.{sat} WHERE _runid = {runid}'.format(**params)
+            if 'materialized_full_refresh' in self.dwh.config and self.dwh.config['materialized_full_refresh']:
+                changed_sql = ''
+            select_sql = DdlDv(self.pipe).get_view_sql(entity_cls)
+            self.refresh_materialized_view(params['dv_schema'], entity_cls.cls_get_view_name(), select_sql, changed_sql)
+            return True
         except Exception as ex:
-            self.logger.log_error(mappings.name, err_msg=ex.args[0])
+            self.logger.log_error(entity_cls.cls_get_view_name(), err_msg=ex.args[0])
+            return False
+
+    def update_bridge(self, link_entity_cls: 'LinkEntity') -> bool:
+        """Werkt de bridge tabel van een link entity (__bridge__ = True) bij, nadat de link en alle sats zijn geladen.
+
+        :return: False als er een fout is opgetreden"""
+        try:
+            self.__update_pit_table(link_entity_cls.cls_get_bridge(), link_entity_cls.Link.cls_get_name(), 'link')
+            return True
+        except Exception as ex:
+            self.logger.log_error(link_entity_cls.cls_get_bridge_name(), err_msg=ex.args[0])
+            return False
+
+    def __update_pit_table(self, pit_cls, base_table: str, base_alias: str, filter: str = '1=1') -> None:
+        """Voegt voor elke _id waarvan in deze run de hub of link of een van de sats is gewijzigd een nieuwe snapshot toe en maakt de vorige inactief.
+
+        Is de pit of bridge nog leeg, dan krijgen alle _id's een snapshot."""
+        params = self._get_fixed_params()
+        params['dv_schema'] = pit_cls.__dbschema__
+        params['pit'] = pit_cls.cls_get_name()
+        params['base_table'] = base_table
+        params['base'] = base_alias
+        params['filter'] = filter
+        params['changed'] = 'SELECT _id FROM {dv_schema}.{base_table} WHERE _runid = {runid}'.format(**params)
+        base_fields = [col.name for col in pit_cls.cls_get_columns() if not col.name.startswith('_') and col.name not in pit_cls.__sat_columns__]
+        fields = base_fields
+        select_fields = ['{}.{}'.format(base_alias, field) for field in base_fields]
+        join = ''
+        changed_sats = []
+        index = 1
+        for col_name, (sat_cls, type) in pit_cls.__sat_columns__.items():
+            params['sat'] = sat_cls.cls_get_name()
+            params['sat_alias'] = 'sat' + str(index)
+            params['type'] = type
+            fields = fields + [col_name]
+            select_fields.append('{sat_alias}._runid'.format(**params))
+            if type:
+                join += """LEFT OUTER JOIN {dv_schema}.{sat} AS {sat_alias} ON {sat_alias}._id = {base}._id AND {sat_alias}._active AND {sat_alias}.type = '{type}'\r\n        """.format(**params)
+            else:
+                join += """LEFT OUTER JOIN {dv_schema}.{sat} AS {sat_alias} ON {sat_alias}._id = {base}._id AND {sat_alias}._active\r\n        """.format(**params)
+            if sat_cls not in changed_sats:
+                changed_sats.append(sat_cls)
+                params['changed'] += '\r\n        UNION SELECT _id FROM {dv_schema}.{sat} WHERE _runid = {runid}'.format(**params)
+            index += 1
+        params['fields'] = ''.join(', ' + field for field in fields)
+        params['select_fields'] = ''.join(', ' + field for field in select_fields)
+        params['join'] = join
+        params['update_fields'] = ', '.join('{0} = EXCLUDED.{0}'.format(field) for field in ['_snapshot_date'] + fields)
+        params['filter_changed'] = '{base}._id IN (SELECT _id FROM changed)'.format(**params)
+        if self.is_empty_table(params['dv_schema'], params['pit']):
+            params['filter_changed'] = '1=1'
+        with self.initial_load(params['dv_schema'], params['pit']):
+            sql = """WITH changed AS (
+        {changed}
+    ), closed AS (
+        UPDATE {dv_schema}.{pit} pit SET _active = False
+        FROM changed WHERE pit._id = changed._id AND pit._active AND pit._runid <> {runid}
+    )
+    INSERT INTO {dv_schema}.{pit} (_id, _runid, _snapshot_date, _active{fields})
+    SELECT {base}._id, {runid}, now(), True{select_fields}
+    FROM {dv_schema}.{base_table} {base}
+        {join}
+    WHERE {filter} AND {filter_changed}
+    ON CONFLICT (_id, _runid) DO UPDATE SET {update_fields};""".format(**params)
+            self.execute(sql, 'update <blue>{}</>'.format(params['pit']))
 
     def __get_link_source_fks(self, mappings: 'SorToLinkMapping'):
         fks = ''
@@ -808,10 +1352,13 @@ WHERE _id NOT IN (SELECT _id FROM {dv_schema}.{record_satus_sat}) AND
         fks_compare = fks_compare[:-4]
         return fks_compare
 
-    def __get_link_join(self, mappings, schema_name='sor'):
+    def __get_link_join(self, mappings, schema_name='sor', join_hubs=True, aliases: Dict[int, str] = None):
+        """Joins van de link-mapping op de sor (en met join_hubs op de hubs). Als aliases is opgegeven wordt daarin per index van de field_mapping de alias van de gejoinde tabel gezet."""
         #todo robuuster maken met aliassen en ands
+        if aliases is None:
+            aliases = {}
         join_sql = ''
-        for field_mapping in mappings.field_mappings:
+        for index, field_mapping in enumerate(mappings.field_mappings):
             join = field_mapping.join
             bk = field_mapping.bk
             if join:
@@ -821,11 +1368,13 @@ WHERE _id NOT IN (SELECT _id FROM {dv_schema}.{record_satus_sat}) AND
                     join_sql += ' INNER JOIN {}.{} ON {} \r\n'.format(schema_name, join_tbl, join)
                 else:
                     join_alias = self.__get_link_alias_of_source_tbl(field_mapping, join_sql)
+                    aliases[index] = join_alias
                     join = join.replace(join_tbl + '.', join_alias + '.')
                     join_sql += ' INNER JOIN {}.{} {} ON {} \r\n'.format(schema_name, join_tbl, join_alias, join)
-            elif bk:
+            elif bk and join_hubs:
                 join_tbl = field_mapping.get_source_table()
                 join_alias = self.__get_link_alias_of_source_tbl(field_mapping, join_sql)
+                aliases[index] = join_alias
                 join_sql += ' LEFT JOIN dv.{0} AS {1} ON {1}.bk = {2} \r\n'.format(join_tbl, join_alias, bk)
         return join_sql
 
@@ -996,6 +1545,13 @@ WHERE _id NOT IN (SELECT _id FROM {dv_schema}.{record_satus_sat}) AND
           SELECT DISTINCT {runid}, now(), '{source_system}', '{type}', {bk_mapping} FROM {dv_schema}.{view} view
           WHERE view._valid AND {bk_mapping} NOT IN (SELECT bk FROM {dv_schema}.{hub}) AND {filter};""".format(
                 **params)
+            if self.dwh.use_hash_keys():
+                # bij hash keys heeft de hub geen volgnummer; de _id is de hash van de bk
+                sql = """
+          INSERT INTO {dv_schema}.{hub} (_id, _runid, _insert_date, _source_system, type, bk)
+          SELECT DISTINCT {hash_id}, {runid}, now(), '{source_system}', '{type}', {bk_mapping} FROM {dv_schema}.{view} view
+          WHERE view._valid AND ({bk_mapping}) IS NOT NULL AND NOT EXISTS (SELECT 1 FROM {dv_schema}.{hub} hub WHERE hub._id = {hash_id}) AND {filter};""".format(
+                    hash_id=hash_key_sql(mappings.bk_mapping), **params)
             self.execute(sql,  'insert new hub')
 
             # sql = """SELECT hub._id FROM {dv_schema}.{hub} hub JOIN {dv_schema}.{sor_table} view ON {bk_mapping} = hub.bk WHERE floor(view._runid) = floor({runid}) AND view._valid AND {filter};""".format(
@@ -1096,3 +1652,241 @@ WHERE _id NOT IN (SELECT _id FROM {dv_schema}.{record_satus_sat}) AND
         except Exception as ex:
             self.logger.log_error(validation.msg, err_msg=ex.args[0])
             # raise Exception(ex.args[0])
+
+
+class EtlDvToDatamart(BaseEtl):
+    """Laadt de dims en facts van de datamarts vanuit de dv met pygrametl.
+
+    De rijen van de bron-query worden via een server-side cursor gelezen en per 'datamart_bulksize' (standaard 50000) rijen met COPY weggeschreven. De sleutels van een dim worden na het laden in het geheugen gehouden, zodat het opzoeken van de fk's van een fact geen queries kost.
+
+    Met 'datamart_delta_mode' worden alleen de hubs en links verwerkt die sinds de vorige verversing van de datamart zijn gewijzigd (zie :meth:`get_changed_ids_sql`)."""
+
+    def __init__(self, pipeline):
+        super().__init__(pipeline)
+        self.bulksize = 50000
+        if 'datamart_bulksize' in self.dwh.config and self.dwh.config['datamart_bulksize']:
+            self.bulksize = int(self.dwh.config['datamart_bulksize'])
+        self.dims = {}  # type: Dict[Dim, CachedDimension]
+        # runid van de vorige verversing van de datamart die geladen wordt; None als alles moet worden gelezen
+        self.last_runid = None  # type: str
+
+    def dv_to_datamarts(self, mappings: List[Union[DvToDimMapping, DvToFactMapping]]) -> None:
+        """Ververst per datamart (schema van de target) eerst alle dims en daarna alle facts."""
+        self.dims = {}
+        datamarts = OrderedDict()  # type: Dict[str, List[Union[DvToDimMapping, DvToFactMapping]]]
+        for mapping in mappings:
+            datamarts.setdefault(mapping.target.__dbschema__, []).append(mapping)
+        with self.dwh.connection() as connection:
+            pygrametl.ConnectionWrapper(connection, paramstyle='pyformat').setasdefault()
+            for dm_schema, dm_mappings in datamarts.items():
+                self.dv_to_datamart(dm_schema, dm_mappings)
+
+    def dv_to_datamart(self, dm_schema: str, mappings: List[Union[DvToDimMapping, DvToFactMapping]]) -> None:
+        """Ververst één datamart. Bij 'datamart_delta_mode' wordt daarna in sys.watermarks (naam 'dm:<schema>') vastgelegd t/m welke run de dv is verwerkt, tenzij er een fout is opgetreden."""
+        watermark_name = 'dm:{}'.format(dm_schema)
+        self.last_runid = None
+        if self.dwh.use_datamart_delta_mode():
+            self.last_runid = self.dwh.get_watermark(watermark_name)
+        error_count = len(self.logger.errors)
+        is_ok = True
+        facts = OrderedDict()  # type: Dict[Fact, List[DvToFactMapping]]
+        for mapping in mappings:
+            if isinstance(mapping, DvToDimMapping):
+                is_ok = self.dv_to_dim(mapping) and is_ok
+            elif isinstance(mapping, DvToFactMapping):
+                facts.setdefault(mapping.target, []).append(mapping)
+        for fact_cls, fact_mappings in facts.items():
+            is_ok = self.dv_to_fact(fact_cls, fact_mappings) and is_ok
+        if 'datamart_delta_mode' in self.dwh.config and self.dwh.config['datamart_delta_mode'] and is_ok and len(self.logger.errors) == error_count:
+            self.dwh.set_watermark(watermark_name, str(self.runid), self.runid)
+
+    def get_changed_ids_sql(self, dv_cls: Union[HubEntity, LinkEntity]) -> str:
+        """Sql voor de _id's van de hub of link van dv_cls waarvan de hub of link zelf, of een van de sats, een _runid na de vorige verversing heeft."""
+        params = {'dv_schema': dv_cls.__dbschema__, 'last_runid': self.last_runid}
+        if issubclass(dv_cls, HubEntity):
+            params['base_table'] = dv_cls.cls_get_hub_name()
+        else:
+            params['base_table'] = dv_cls.Link.cls_get_name()
+        sql = 'SELECT _id FROM {dv_schema}.{base_table} WHERE _runid > {last_runid}'.format(**params)
+        for sat_cls in dv_cls.cls_get_sats().values():
+            params['sat'] = sat_cls.cls_get_name()
+            sql += '\r\n    UNION SELECT _id FROM {dv_schema}.{sat} WHERE _runid > {last_runid}'.format(**params)
+        return sql
+
+    def get_source_sql(self, mappings: Union[DvToDimMapping, DvToFactMapping]) -> str:
+        """De bron-query van de mapping; bij een incrementele verversing alleen de rijen waarvan een van de hubs of links uit :meth:`BaseDvToDmMapping.track_changes` is gewijzigd."""
+        change_keys = mappings.get_change_keys()
+        if self.last_runid is None or not change_keys:
+            return mappings.generate_sql(self.dwh)
+        if isinstance(mappings, DvToDimMapping) and not isinstance(mappings.source, str):
+            return mappings.generate_sql(self.dwh, filter='hub._id IN ({})'.format(self.get_changed_ids_sql(mappings.source)))
+        filters = ['src.{} IN ({})'.format(source_field, self.get_changed_ids_sql(dv_cls)) for source_field, dv_cls in change_keys]
+        return """SELECT * FROM ({}) src
+WHERE {}""".format(mappings.generate_sql(self.dwh).strip().rstrip(';'), '\r\n    OR '.join(filters))
+
+    def dv_to_dim(self, mappings: DvToDimMapping) -> bool:
+        """Vult of werkt de dim bij.
+
+        Een lege dim wordt in één keer met COPY gevuld. Anders worden de rijen uit de bron (bij een incrementele verversing alleen de gewijzigde) met scdensure verwerkt: een bestaand lid (gevonden op de _lookup_fields) wordt overschreven, of krijgt bij een :class:`Scd2Dim` een nieuwe versie.
+
+        :return: False als er een fout is opgetreden"""
+        self.logger.log('START <blue>{}</>'.format(mappings), indent_level=3)
+        dim_cls = mappings.target
+        with self.dwh.transaction() as transaction:
+            try:
+                if not dim_cls.cls_get_lookup_fields() or self.is_empty_table(dim_cls.__dbschema__, dim_cls.cls_get_name()):
+                    self.dims[dim_cls] = self.__bulk_load_dim(mappings)
+                else:
+                    self.dims[dim_cls] = self.__update_dim(mappings)
+            except Exception as ex:
+                transaction.is_failed = True
+                self.logger.log_error(mappings.name, err_msg=ex.args[0])
+            if transaction.is_failed:
+                # de cache bevat dan rijen die niet in de database staan
+                self.dims.pop(dim_cls, None)
+                return False
+        self.logger.log('FINISH {}'.format(mappings), indent_level=3)
+        return True
+
+    def __bulk_load_dim(self, mappings: DvToDimMapping) -> BulkDimension:
+        dim_cls = mappings.target
+        dim = dim_cls.cls_to_pygram_bulk_dim(dim_cls.__dbschema__, bulkloader=self.__bulkload, bulksize=self.bulksize, strconverter=copy_text_value)
+        names = self.__get_source_names(mappings)
+        scd_values = {}
+        if dim_cls.__scd_type__ == 2:
+            scd_values = {'_version': 1, '_valid_from': datetime.datetime.now(), '_valid_to': None}
+        for row in self.dwh.execute_stream(mappings.generate_sql(self.dwh), self.bulksize, 'read {}'.format(dim_cls.cls_get_name())):
+            dim_row = {att: row.get(names.get(att, att)) for att in dim.attributes}
+            dim_row.update(scd_values)
+            dim.ensure(dim_row)
+        dim.endload()
+        return dim
+
+    def __update_dim(self, mappings: DvToDimMapping) -> Union[SlowlyChangingDimension, TypeOneSlowlyChangingDimension]:
+        dim_cls = mappings.target
+        dim = dim_cls.cls_to_pygram_scd_dim(dim_cls.__dbschema__)
+        names = self.__get_source_names(mappings)
+        # de versie-kolommen worden door scdensure gevuld
+        attributes = [att for att in dim.attributes if att not in dim_cls.cls_get_scd_column_names()]
+        for row in self.dwh.execute_stream(self.get_source_sql(mappings), self.bulksize, 'read {}'.format(dim_cls.cls_get_name())):
+            dim.scdensure({att: row.get(names.get(att, att)) for att in attributes})
+        return dim
+
+    def dv_to_fact(self, fact_cls: Fact, mappings: List[DvToFactMapping]) -> bool:
+        """Leidt de fact opnieuw af uit alle mappings naar die fact, in één transactie, zodat lezers tot het einde de oude inhoud zien. De fk's naar de dims worden opgezocht in het geheugen (zie :meth:`DvToFactMapping.map_lookup_field`).
+
+        Bij een incrementele verversing worden alleen de partities (waardes van de _partition_fields van de fact) vervangen waarin een bronrij is gewijzigd, of waarin de fact nu rijen van een gewijzigde sleutel heeft. Dat kan alleen als de fact _partition_fields heeft, alle mappings naar de fact track_changes gebruiken en die sleutels in de fact terug te vinden zijn (zie :meth:`__get_changed_partitions_sql`); anders wordt de hele fact opnieuw gevuld.
+
+        :return: False als er een fout is opgetreden"""
+        params = {}
+        params['dm_schema'] = fact_cls.__dbschema__
+        params['fact'] = fact_cls.cls_get_name()
+        self.logger.log('START <blue>{fact}</>'.format(**params), indent_level=3)
+        partition_fields = fact_cls.cls_get_partition_fields()
+        is_delta = self.last_runid is not None and partition_fields and all(mapping.get_change_keys() for mapping in mappings)
+        changed_sqls = []
+        if is_delta:
+            changed_sqls = [self.__get_changed_partitions_sql(mapping, partition_fields) for mapping in mappings]
+            if not all(changed_sqls):
+                self.logger.log('niet alle gewijzigde sleutels zijn in {fact} terug te vinden; de hele fact wordt opnieuw gevuld'.format(**params), indent_level=4)
+                is_delta = False
+        with self.dwh.transaction() as transaction:
+            try:
+                if is_delta:
+                    params['partition_fields'] = ', '.join(partition_fields)
+                    params['changed'] = '\r\nUNION '.join(changed_sqls)
+                    sql = """CREATE TEMP TABLE {fact}_changed ON COMMIT DROP AS
+{changed};""".format(**params)
+                    self.execute(sql, 'get changed partitions {fact}'.format(**params))
+                    sql = """DELETE FROM {dm_schema}.{fact} WHERE ({partition_fields}) IN (SELECT {partition_fields} FROM {fact}_changed);""".format(**params)
+                    self.execute(sql, 'delete changed partitions {fact}'.format(**params))
+                else:
+                    self.execute('DELETE FROM {dm_schema}.{fact};'.format(**params), 'clear {fact}'.format(**params))
+                for mapping in mappings:
+                    self.logger.log('START <blue>{}</>'.format(mapping), indent_level=4)
+                    sql = mapping.generate_sql(self.dwh)
+                    if is_delta:
+                        names = self.__get_source_names(mapping)
+                        source_fields = ', '.join('src.' + names.get(field, field) for field in partition_fields)
+                        sql = """SELECT * FROM ({}) src
+WHERE ({}) IN (SELECT {partition_fields} FROM {fact}_changed)""".format(sql.strip().rstrip(';'), source_fields, **params)
+                    self.__load_fact(mapping, sql)
+            except Exception as ex:
+                transaction.is_failed = True
+                self.logger.log_error(params['fact'], err_msg=ex.args[0])
+            if transaction.is_failed:
+                return False
+        self.logger.log('FINISH {fact}'.format(**params), indent_level=3)
+        return True
+
+    def __get_changed_partitions_sql(self, mappings: DvToFactMapping, partition_fields: List[str]) -> str:
+        """Sql voor de partities die opnieuw moeten worden afgeleid: die van de gewijzigde bronrijen en die waarin de fact nu rijen van de gewijzigde sleutels heeft. Dat laatste is nodig voor sleutels waarvoor de bron geen rijen meer geeft, of waarvan de waarde van een partitie-veld is veranderd.
+
+        Een sleutel wordt in de fact gevonden via een kolom van de fact die uit het bron-veld wordt gevuld, of via de fk naar een dim waarvoor het bron-veld een opzoekveld is (:meth:`DvToFactMapping.map_lookup_field`).
+
+        :return: leeg als een van de sleutels niet in de fact is terug te vinden"""
+        names = self.__get_source_names(mappings)
+        fields = ', '.join('src.{} AS {}'.format(names.get(field, field), field) for field in partition_fields)
+        changed_sqls = ['SELECT DISTINCT {} FROM ({}) src'.format(fields, self.get_source_sql(mappings))]
+        fact_cls = mappings.target
+        params = {}
+        params['dm_schema'] = fact_cls.__dbschema__
+        params['fact'] = fact_cls.cls_get_name()
+        params['fields'] = ', '.join('fact.' + field for field in partition_fields)
+        fact_columns = [col.name for col in fact_cls.cls_get_columns()]
+        for source_field, dv_cls in mappings.get_change_keys():
+            params['changed_ids'] = self.get_changed_ids_sql(dv_cls)
+            fact_fields = [col_name for col_name in fact_columns if names.get(col_name, col_name) == source_field]
+            lookups = [(source_names, dim_reference) for source_names, dim_reference in mappings.lookup_mappings if source_field in source_names]
+            if fact_fields:
+                params['fact_field'] = fact_fields[0]
+                changed_sqls.append('SELECT DISTINCT {fields} FROM {dm_schema}.{fact} fact WHERE fact.{fact_field} IN ({changed_ids})'.format(**params))
+            elif lookups:
+                source_names, dim_reference = lookups[0]
+                dim_cls = dim_reference.ref_table
+                params['dim_schema'] = dim_cls.__dbschema__
+                params['dim'] = dim_cls.cls_get_name()
+                params['fk'] = dim_reference.fk
+                params['lookup_field'] = dim_cls.cls_get_lookup_fields()[source_names.index(source_field)]
+                # het opzoekveld van de dim hoeft niet hetzelfde type te hebben als de _id
+                changed_sqls.append("""SELECT DISTINCT {fields} FROM {dm_schema}.{fact} fact JOIN {dim_schema}.{dim} dim ON dim.id = fact.{fk}
+WHERE dim.{lookup_field}::text IN (SELECT changed._id::text FROM ({changed_ids}) changed)""".format(**params))
+            else:
+                return ''
+        return '\r\nUNION '.join(changed_sqls)
+
+    def __load_fact(self, mappings: DvToFactMapping, sql: str) -> None:
+        fact_cls = mappings.target
+        fact = fact_cls.cls_to_pygram_bulk_fact(fact_cls.__dbschema__, bulkloader=self.__bulkload, bulksize=self.bulksize, strconverter=copy_text_value)
+        names = self.__get_source_names(mappings)
+        lookups = [(source_names, dim_reference.fk, self.__get_lookup_dim(dim_reference.ref_table)) for source_names, dim_reference in mappings.lookup_mappings]
+        for row in self.dwh.execute_stream(sql, self.bulksize, 'read {}'.format(fact_cls.cls_get_name())):
+            fact_row = {att: row.get(names.get(att, att)) for att in fact.all}
+            for source_names, fk, dim in lookups:
+                fact_row[fk] = dim.lookup(dict(zip(dim.lookupatts, [row[name] for name in source_names])))
+            fact.insert(fact_row)
+        fact.endload()
+
+    def __get_lookup_dim(self, dim_cls: Dim):
+        # dims die in deze run niet zijn geladen worden in één keer in het geheugen gelezen; bij een Scd2Dim alleen de nieuwste versies
+        if dim_cls not in self.dims:
+            if dim_cls.__scd_type__ == 2:
+                self.dims[dim_cls] = dim_cls.cls_to_pygram_scd_dim(dim_cls.__dbschema__)
+            else:
+                self.dims[dim_cls] = dim_cls.cls_to_pygram_dim(dim_cls.__dbschema__, prefill=True)
+        return self.dims[dim_cls]
+
+    def __get_source_names(self, mappings) -> Dict[str, str]:
+        """Per kolom van de dim of fact de naam van het veld in de bron-query. Velden zonder mapping hebben in de bron dezelfde naam (zoals bij :meth:`DvToDimMapping.generate_sql`) of worden NULL."""
+        names = {}
+        if not isinstance(mappings.source, str):
+            return names
+        for field_mapping in mappings.field_mappings:
+            if field_mapping.source:
+                target_name = field_mapping.target.fk if isinstance(field_mapping.target, DmReference) else field_mapping.target.name
+                names[target_name] = field_mapping.source.name
+        return names
+
+    def __bulkload(self, name, attributes, fieldsep, rowsep, nullsubst, tempdest):
+        sql = "COPY {} ({}) FROM STDIN".format(name, ', '.join(attributes))
+        self.execute_copy(sql, tempdest, 'copy into {}'.format(name))
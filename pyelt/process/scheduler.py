@@ -0,0 +1,157 @@
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, Future, wait, FIRST_COMPLETED
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterable, List
+
+from pyelt.helpers.exceptions import PyeltException
+from pyelt.helpers.pyelt_logging import Logger
+
+
+class TableLocks():
+    """Houdt per tabel een lock bij, zodat parallel lopende processen die dezelfde tabel vullen na elkaar worden uitgevoerd.
+
+    Processen zonder overlap in tabellen lopen gewoon naast elkaar.
+
+    Voorbeeld::
+
+        locks = TableLocks()
+        with locks.acquire(['dv.patient_hub', 'dv.patient_sat']):
+            ...
+    """
+
+    def __init__(self):
+        self.__locks = {}  # type: Dict[str, threading.Lock]
+        self.__guard = threading.Lock()
+
+    def get_lock(self, name: str) -> threading.Lock:
+        with self.__guard:
+            if name not in self.__locks:
+                self.__locks[name] = threading.Lock()
+            return self.__locks[name]
+
+    @contextmanager
+    def acquire(self, names: Iterable[str]):
+        # altijd in dezelfde (gesorteerde) volgorde locken om deadlocks tussen processen te voorkomen
+        locks = [self.get_lock(name) for name in sorted(set(names))]
+        for lock in locks:
+            lock.acquire()
+        try:
+            yield
+        finally:
+            for lock in reversed(locks):
+                lock.release()
+
+
+class TaskGraph():
+    """Een graaf van taken met afhankelijkheden, die serieel of op een pool van threads kan worden uitgevoerd.
+
+    Een taak start pas als alle taken waarvan hij afhankelijk is klaar zijn. Een taak die een exception geeft of False retourneert geldt als mislukt; taken die daarvan afhankelijk zijn worden overgeslagen.
+
+    Voorbeeld::
+
+        graph = TaskGraph()
+        hub = graph.add_task('hub', etl.sor_to_hub, mapping)
+        graph.add_task('sat1', etl.sor_to_sat, mapping, sat_mapping1, depends_on=[hub])
+        graph.add_task('sat2', etl.sor_to_sat, mapping, sat_mapping2, depends_on=[hub])
+        graph.run(max_workers=4)
+    """
+    DONE = 'DONE'
+    FAILED = 'FAILED'
+    SKIPPED = 'SKIPPED'
+
+    def __init__(self, logger: 'Logger' = None, task_context: Callable = None):
+        """
+        :param logger: logger voor overgeslagen taken
+        :param task_context: optionele functie die een context manager geeft waarbinnen elke taak draait, bijvoorbeeld :meth:`Database.connection` zodat elke worker één connectie vasthoudt
+        """
+        self.tasks = OrderedDict()  # type: Dict[str, Dict[str, Any]]
+        self.status = {}  # type: Dict[str, str]
+        self.logger = logger
+        self.task_context = task_context
+        self.__last_writers = {}  # type: Dict[str, str]
+
+    def add_task(self, name: str, func: Callable, *args, depends_on: List[str] = None, writes: List[str] = None) -> str:
+        """Voegt een taak toe aan de graaf.
+
+        :param name: unieke naam van de taak
+        :param func: de uit te voeren functie
+        :param args: argumenten voor func
+        :param depends_on: namen van eerder toegevoegde taken die eerst klaar moeten zijn
+        :param writes: namen van tabellen die de taak vult. De taak wacht op de laatst toegevoegde taak die dezelfde tabel vult.
+        :return: name
+        """
+        if name in self.tasks:
+            raise PyeltException('Taak {} bestaat al'.format(name))
+        depends_on = depends_on or []
+        writes = writes or []
+        dependencies = []
+        for dependency in list(depends_on) + [self.__last_writers[table] for table in writes if table in self.__last_writers]:
+            if dependency not in self.tasks:
+                raise PyeltException('Taak {} is afhankelijk van onbekende taak {}'.format(name, dependency))
+            if dependency not in dependencies:
+                dependencies.append(dependency)
+        for table in writes:
+            self.__last_writers[table] = name
+        self.tasks[name] = {'func': func, 'args': args, 'depends_on': dependencies}
+        return name
+
+    def run(self, max_workers: int = 1) -> None:
+        """Voert alle taken uit. Met max_workers = 1 worden de taken in volgorde van toevoegen uitgevoerd, in de huidige thread.
+
+        Een exception uit een taak wordt, nadat alle andere taken klaar zijn, opnieuw opgegooid."""
+        self.status = {}
+        if max_workers <= 1:
+            for name in self.tasks:
+                if self.__should_skip(name):
+                    continue
+                self.status[name] = TaskGraph.DONE if self.__call(name) is not False else TaskGraph.FAILED
+            return
+
+        errors = []
+        context = Logger.get_context()
+        pending = list(self.tasks.keys())
+        running = {}  # type: Dict[Future, str]
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            while pending or running:
+                for name in list(pending):
+                    if not all(dependency in self.status for dependency in self.tasks[name]['depends_on']):
+                        continue
+                    pending.remove(name)
+                    if not self.__should_skip(name):
+                        running[executor.submit(self.__execute, name, context)] = name
+                if not running:
+                    continue
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    name = running.pop(future)
+                    try:
+                        self.status[name] = TaskGraph.DONE if future.result() is not False else TaskGraph.FAILED
+                    except Exception as ex:
+                        self.status[name] = TaskGraph.FAILED
+                        errors.append(ex)
+        if errors:
+            raise errors[0]
+
+    def __should_skip(self, name: str) -> bool:
+        failed = [dependency for dependency in self.tasks[name]['depends_on'] if self.status[dependency] != TaskGraph.DONE]
+        if failed:
+            self.status[name] = TaskGraph.SKIPPED
+            if self.logger:
+                self.logger.log('<red>SKIPPED</> {} (wacht op mislukte taak {})'.format(name, failed[0]), indent_level=4)
+        return len(failed) > 0
+
+    def __execute(self, name: str, context: str):
+        # de worker-thread logt onder dezelfde naam (pipe) als de thread die de graaf start
+        Logger.set_context(context)
+        try:
+            return self.__call(name)
+        finally:
+            Logger.set_context('')
+
+    def __call(self, name: str):
+        task = self.tasks[name]
+        if self.task_context is None:
+            return task['func'](*task['args'])
+        with self.task_context():
+            return task['func'](*task['args'])
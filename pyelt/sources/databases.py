@@ -1,9 +1,14 @@
 import csv
+import datetime
+import io
 import os
-from sqlalchemy import create_engine, MetaData, Table
+from decimal import Decimal
+from itertools import islice
+from sqlalchemy import create_engine, MetaData, Table, text
 from sqlalchemy.engine import reflection
 
 from pyelt.datalayers.database import Database, Schema, Table, Column, DBDrivers
+from pyelt.helpers.global_helper_functions import strip_where
 
 
 # from etl_mappings.general_configs import config as pyelt_config
@@ -39,11 +44,12 @@ def sqlserver_type_to_postgres_type(type: str) -> str:
 
 
 class SourceDatabase(Database):
-    def __init__(self, conn_string='', default_schema='public', temp_datatransfer_path=''):
+    def __init__(self, conn_string='', default_schema='public', temp_datatransfer_path='', fetch_batch_size=10000):
         super().__init__(conn_string, default_schema)
         self.driver = self.get_driver_from_conn_string(conn_string)
         self.user_name = self.get_user_name_from_conn_string(conn_string)
         self.temp_datatransfer_path = temp_datatransfer_path
+        self.fetch_batch_size = fetch_batch_size
 
 
     def get_driver_from_conn_string(self, conn_string):
@@ -74,17 +80,68 @@ class SourceDatabase(Database):
             os.makedirs(path)
         return path
 
+    def iter_rows(self, sql):
+        """Generator die de rijen van een query in blokken van fetch_batch_size ophaalt (fetchmany).
+
+        Waar de driver het ondersteunt (postgres, oracle, mysql) wordt een server-side cursor gebruikt, zodat ook de driver niet de hele resultset in het geheugen houdt."""
+        connection = self.engine.connect().execution_options(stream_results=True)
+        try:
+            result = connection.execute(text(sql))
+            while True:
+                rows = result.fetchmany(self.fetch_batch_size)
+                if not rows:
+                    break
+                for row in rows:
+                    yield row
+            result.close()
+        finally:
+            connection.close()
+
     def execute_read(self, sql, log_message=''):
         if self.driver == DBDrivers.POSTGRESS:
             return super().execute_read(sql, log_message)
-        connection = self.engine.raw_connection()
-        cursor = connection.cursor()
-        cursor.execute(sql)
-        result = cursor.fetchall()
-        cursor.close()
+        with self.connection() as connection:
+            cursor = connection.cursor()
+            try:
+                cursor.execute(sql)
+                result = cursor.fetchall()
+            finally:
+                cursor.close()
+            connection.rollback()
         return result
 
 
+class CsvRowStream():
+    """File-achtig object dat rijen uit een iterator (bijvoorbeeld een database cursor) als csv aanbiedt.
+
+    Bedoeld voor psycopg2 copy_expert (COPY ... FROM STDIN): bij elke read(size) worden net zoveel rijen opgehaald als nodig is om het blok te vullen. Het geheugengebruik blijft daardoor gelijk, ongeacht het aantal rijen."""
+
+    def __init__(self, rows, delimiter=';'):
+        self.rows = iter(rows)
+        self.rowcount = 0
+        self.__buffer = io.StringIO()
+        self.__csv_writer = csv.writer(self.__buffer, delimiter=delimiter)
+        self.__is_exhausted = False
+
+    def read(self, size=-1) -> str:
+        while not self.__is_exhausted and (size < 0 or self.__buffer.tell() < size):
+            row = next(self.rows, None)
+            if row is None:
+                self.__is_exhausted = True
+            else:
+                self.__csv_writer.writerow(row)
+                self.rowcount += 1
+        data = self.__buffer.getvalue()
+        if 0 <= size < len(data):
+            data, rest = data[:size], data[size:]
+        else:
+            rest = ''
+        self.__buffer.seek(0)
+        self.__buffer.truncate()
+        self.__buffer.write(rest)
+        return data
+
+
 class SourceSchema(Schema):
     def __init__(self, name, db):
         super().__init__(name, db)
@@ -94,7 +151,7 @@ class SourceTable(Table):
         super().__init__(name, schema, db)
         self.alias = alias
 
-    def to_csv(self, path='', md5_only=False, filter='', ignore_fields=[], debug=False):
+    def to_csv(self, path='', md5_only=False, filter='', ignore_fields=[], debug=False, keys=None):
         path = self.db.get_or_create_datatransfer_path()
         if not self.alias:
             self.alias = self.name
@@ -108,12 +165,133 @@ class SourceTable(Table):
         with open(file_name, 'w', newline='', encoding='utf8') as fp:
             csv_writer = csv.writer(fp, delimiter=';')
             csv_writer.writerow(head)
-            data = self.load(md5_only=md5_only, filter=filter, ignore_fields=ignore_fields, debug=debug)
-            csv_writer.writerows(data)
+            # get_rows geeft een generator: rijen worden per blok weggeschreven
+            csv_writer.writerows(self.get_rows(md5_only=md5_only, filter=filter, ignore_fields=ignore_fields, debug=debug, keys=keys))
         return file_name
 
+    def to_stream(self, md5_only=False, filter='', ignore_fields=[], debug=False, keys=None) -> 'CsvRowStream':
+        """Geeft de data als csv-stream (zonder header) die direct kan worden ingelezen met COPY ... FROM STDIN.
+
+        De rijen worden pas uit de bron-cursor gehaald als de stream gelezen wordt; er komt geen bestand aan te pas."""
+        return CsvRowStream(self.get_rows(md5_only=md5_only, filter=filter, ignore_fields=ignore_fields, debug=debug, keys=keys))
+
+    def get_rows(self, md5_only=False, filter='', ignore_fields=[], debug=False, keys=None):
+        """Alle rijen (:meth:`load`) of, als keys is opgegeven, alleen de rijen met die sleutels (:meth:`load_by_keys`)."""
+        if keys is not None:
+            return self.load_by_keys(keys, ignore_fields=ignore_fields)
+        return self.load(md5_only=md5_only, filter=filter, ignore_fields=ignore_fields, debug=debug)
+
     def load(self, md5_only=False, filter='', ignore_fields=[], debug=False):
-        rows = []
+        """Generator met de rijen uit de bron, opgehaald in blokken van fetch_batch_size (zie :meth:`SourceDatabase.iter_rows`)."""
+        sql = self.get_load_sql(md5_only=md5_only, filter=filter, ignore_fields=ignore_fields, debug=debug)
+        return self.db.iter_rows(sql)
+
+    def load_by_keys(self, keys, ignore_fields=[]):
+        """Generator met alleen de rijen waarvan de sleutel in keys voorkomt.
+
+        De sleutels worden met executemany in een tijdelijke tabel op de bron gezet, waarna alle rijen in één query met een join op die tabel worden opgehaald. Zo kan de bron zijn index op de sleutelvelden gebruiken en is er maar één round-trip voor de data, ongeacht het aantal gewijzigde sleutels.
+        Bij Oracle (geen sessie-tijdelijke tabel zonder ddl) wordt de bron één keer doorlopen en in het geheugen op de sleutels gefilterd.
+
+        :param keys: iterable met tuples van sleutelwaardes, in de volgorde van :meth:`primary_keys`
+        """
+        keys = iter(keys)
+        batch_size = self.db.fetch_batch_size
+        batch = list(islice(keys, batch_size))
+        if not batch:
+            return
+        key_names = self.primary_keys()
+        params = {}
+        params['from'] = self.get_from_sql()
+        params['key_fields'] = ','.join(key_names)
+        params['src_fields'] = ','.join(['src.' + col.name for col in self.columns if col.name not in ignore_fields])
+
+        if self.db.driver == DBDrivers.ORACLE:
+            wanted_keys = set()
+            while batch:
+                wanted_keys.update(tuple(str(value) for value in key) for key in batch)
+                batch = list(islice(keys, batch_size))
+            sql = """SELECT {key_fields}, {src_fields} FROM {from}""".format(**params)
+            for row in self.db.iter_rows(sql):
+                if tuple(str(value) for value in row[:len(key_names)]) in wanted_keys:
+                    yield tuple(row[len(key_names):])
+            return
+
+        if self.db.driver == DBDrivers.SQLSERVER:
+            params['tmp'] = '#pyelt_keys'
+            create_sql = text("""SELECT {key_fields} INTO {tmp} FROM {from} WHERE 1=0""".format(**params))
+            drop_sql = text("""IF OBJECT_ID('tempdb..{tmp}') IS NOT NULL DROP TABLE {tmp}""".format(**params))
+        else:
+            # zo krijgt de tijdelijke tabel dezelfde datatypes als de sleutelvelden in de bron
+            params['tmp'] = 'pyelt_keys'
+            create_sql = text("""CREATE TEMPORARY TABLE {tmp} AS SELECT {key_fields} FROM {from} WHERE 1=0""".format(**params))
+            drop_sql = text("""DROP TABLE IF EXISTS {tmp}""".format(**params))
+        params['bind_params'] = ','.join([':k{}'.format(index) for index in range(len(key_names))])
+        params['join_on'] = ' AND '.join(['src.{0} = tmp.{0}'.format(key_name) for key_name in key_names])
+        insert_sql = text("""INSERT INTO {tmp} ({key_fields}) VALUES ({bind_params})""".format(**params))
+        select_sql = text("""SELECT {src_fields} FROM {from} INNER JOIN {tmp} tmp ON {join_on}""".format(**params))
+
+        # tijdelijke tabel bestaat alleen binnen de sessie: alles op dezelfde connectie
+        connection = self.db.engine.connect()
+        result = None
+        try:
+            # restant van een eerdere, afgebroken aanroep op deze connectie uit de pool
+            connection.execute(drop_sql)
+            connection.execute(create_sql)
+            while batch:
+                connection.execute(insert_sql, [{'k{}'.format(index): value for index, value in enumerate(key)} for key in batch])
+                batch = list(islice(keys, batch_size))
+            result = connection.execution_options(stream_results=True).execute(select_sql)
+            while True:
+                rows = result.fetchmany(batch_size)
+                if not rows:
+                    break
+                for row in rows:
+                    yield row
+        finally:
+            # ook bij een fout of als de generator niet helemaal is gelezen; anders blijft de tabel op de connectie in de pool staan
+            try:
+                if result is not None:
+                    result.close()
+                connection.execute(drop_sql)
+            except Exception:
+                # de connectie niet teruggeven aan de pool: met de sessie verdwijnt ook de tijdelijke tabel
+                connection.invalidate()
+            connection.close()
+
+    def get_max_value_literal(self, column_name: str, filter: str = '') -> str:
+        """Hoogste waarde van column_name in de bron, als sql-literal die direct in een filter kan worden gebruikt. None als er geen rijen zijn."""
+        sql = """SELECT MAX({}) FROM {}""".format(column_name, self.get_from_sql())
+        if filter:
+            sql += ' WHERE ' + strip_where(filter)
+        value = self.db.execute_read(sql)[0][0]
+        if value is None:
+            return None
+        if isinstance(value, (int, float, Decimal)) and not isinstance(value, bool):
+            return str(value)
+        if isinstance(value, datetime.datetime):
+            if self.db.driver == DBDrivers.SQLSERVER:
+                # datetime in sql server kent maar 3 decimalen; naar beneden afronden is veilig, hooguit wordt een rij opnieuw geladen
+                value = value.isoformat(sep=' ', timespec='milliseconds')
+            else:
+                value = value.isoformat(sep=' ')
+            if self.db.driver == DBDrivers.ORACLE:
+                return "TIMESTAMP '{}'".format(value)
+            return "'{}'".format(value)
+        if isinstance(value, datetime.date):
+            if self.db.driver == DBDrivers.ORACLE:
+                return "DATE '{}'".format(value.isoformat())
+            return "'{}'".format(value.isoformat())
+        return "'{}'".format(str(value).replace("'", "''"))
+
+    def get_from_sql(self) -> str:
+        """FROM-deel voor een query op deze tabel, met alias src"""
+        if isinstance(self, SourceQuery):
+            if self.db.driver == DBDrivers.ORACLE:
+                return """({}) src""".format(self.sql)
+            return """({}) AS src""".format(self.sql)
+        return """{}.{} src""".format(self.schema.name, self.name)
+
+    def get_load_sql(self, md5_only=False, filter='', ignore_fields=[], debug=False) -> str:
         field_names = [col.name for col in self.columns if col.name not in ignore_fields]
         field_names_str = ','.join(field_names)
 
@@ -154,7 +332,7 @@ class SourceTable(Table):
             sql = """SELECT {} FROM {}.{}""".format(field_names_str, self.schema.name, self.name)
 
         if filter:
-            filter = filter.replace('WHERE', '')
+            filter = strip_where(filter)
             sql += ' WHERE ' + filter
         # print(sql)
         if debug:
@@ -162,11 +340,7 @@ class SourceTable(Table):
                 sql = sql.replace('SELECT', 'SELECT TOP 100')
             else:
                 sql += " OFFSET 0 ROWS FETCH NEXT 100 ROWS ONLY"
-
-        result = self.db.engine.execute(sql)
-        for row in result:
-            rows.append(row)
-        return rows
+        return sql
 
 
 class SourceQuery(SourceTable):
@@ -183,7 +357,6 @@ class SourceQuery(SourceTable):
 
     def reflect(self):
         self.columns = []
-        cursor = self.db.engine.raw_connection().cursor()
         if self.db.driver == DBDrivers.ORACLE:
             sql = self.sql + ' OFFSET 0 ROWS FETCH NEXT 1 ROWS ONLY'
         elif self.db.driver == DBDrivers.SQLSERVER:
@@ -206,7 +379,7 @@ class SourceQuery(SourceTable):
         self.is_reflected = True
 
     def load2(self, md5_only=False, filter='', ignore_fields=[], debug=False):
-        rows = []
+        """Generator met de rijen van de query zelf, opgehaald in blokken van fetch_batch_size."""
         sql = self.sql
 
         if filter:
@@ -221,11 +394,7 @@ class SourceQuery(SourceTable):
                 sql = self.sql_to_top_select(self.sql, 100)
             else:
                 sql += " OFFSET 0 ROWS FETCH NEXT 1000 ROWS ONLY"
-
-        result = self.db.engine.execute(sql)
-        for row in result:
-            rows.append(row)
-        return rows
+        return self.db.iter_rows(sql)
 
     def sql_to_top_select(self, sql, top=1):
         "Voor SQL SERVER"
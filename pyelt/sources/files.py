@@ -1,6 +1,7 @@
 import csv
 
 from pyelt.datalayers.database import Column
+from pyelt.sources.databases import CsvRowStream
 
 
 class File():
@@ -37,6 +38,39 @@ class File():
             self.reflect()
         return self.columns
 
+    def iter_rows(self):
+        """Generator met de datarijen uit het bestand als lijst van waardes, in volgorde van columns. Lege waardes worden None (zoals bij COPY CSV)."""
+        return iter([])
+
+    def load(self, md5_only=False, filter='', ignore_fields=[], debug=False):
+        """Generator met de rijen uit het bestand zonder de ignore_fields; zelfde aanroep als SourceTable.load. md5_only en filter worden niet ondersteund, hashen gebeurt in de etl (zie pyelt.helpers.hashing)."""
+        if not self.is_reflected:
+            self.reflect()
+        indexes = [index for index, col in enumerate(self.columns) if col.name not in ignore_fields]
+        for row_number, row in enumerate(self.iter_rows()):
+            if debug and row_number >= 100:
+                break
+            yield tuple(row[index] for index in indexes)
+
+    def load_by_keys(self, keys, ignore_fields=[]):
+        """Generator met alleen de rijen waarvan de sleutel in keys voorkomt. Het bestand wordt één keer gelezen en in het geheugen gefilterd."""
+        wanted_keys = set(tuple(str(value) for value in key) for key in keys)
+        if not wanted_keys:
+            return
+        field_names = [col.name for col in self.columns if col.name not in ignore_fields]
+        key_indexes = [field_names.index(key_name) for key_name in self.primary_keys()]
+        for row in self.load(ignore_fields=ignore_fields):
+            if tuple(str(row[index]) for index in key_indexes) in wanted_keys:
+                yield row
+
+    def get_rows(self, md5_only=False, filter='', ignore_fields=[], debug=False, keys=None):
+        if keys is not None:
+            return self.load_by_keys(keys, ignore_fields=ignore_fields)
+        return self.load(md5_only=md5_only, filter=filter, ignore_fields=ignore_fields, debug=debug)
+
+    def to_stream(self, md5_only=False, filter='', ignore_fields=[], debug=False, keys=None) -> 'CsvRowStream':
+        return CsvRowStream(self.get_rows(md5_only=md5_only, filter=filter, ignore_fields=ignore_fields, debug=debug, keys=keys))
+
 class CsvFile(File):
     def __init__(self, file_name, **kwargs):
         super().__init__(file_name )
@@ -69,6 +103,15 @@ class CsvFile(File):
                 self.columns.append(col)
         self.is_reflected = True
 
+    def iter_rows(self):
+        csv_kwargs = dict(self.csv_kwargs)
+        csv_kwargs['quotechar'] = self.quote
+        with open(self.file_name, 'r', newline='', **self.file_kwargs) as csvfile:
+            reader = csv.reader(csvfile, **csv_kwargs)
+            next(reader, None)
+            for row in reader:
+                yield [value if value != '' else None for value in row]
+
 
 class FixedLengthFile(File):
     def __init__(self, file_name, import_def):
@@ -86,6 +129,22 @@ class FixedLengthFile(File):
             self.columns.append(col)
         self.is_reflected = True
 
+    def iter_rows(self):
+        """import_def bevat per veld (naam, lengte[, is_key])"""
+        lengths = [int(field_def[1]) for field_def in self.import_def]
+        with open(self.file_name, 'r', encoding=self.encoding) as file:
+            for line in file:
+                line = line.rstrip('\r\n')
+                if not line:
+                    continue
+                row = []
+                pos = 0
+                for length in lengths:
+                    value = line[pos:pos + length].strip()
+                    row.append(value if value != '' else None)
+                    pos += length
+                yield row
+
     def primary_key_from_import_def(self):
         key_names = []
         for field_def in self.import_def:
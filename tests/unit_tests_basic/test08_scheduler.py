@@ -0,0 +1,79 @@
+import threading
+import time
+import unittest
+
+from pyelt.process.scheduler import TableLocks, TaskGraph
+
+
+class TestCase_TaskGraph(unittest.TestCase):
+    def setUp(self):
+        self.started = []
+        self.lock = threading.Lock()
+
+    def task(self, name, result=True, sleep=0.05):
+        with self.lock:
+            self.started.append(name)
+        time.sleep(sleep)
+        return result
+
+    def test_serial_runs_in_order(self):
+        graph = TaskGraph()
+        hub = graph.add_task('hub', self.task, 'hub')
+        graph.add_task('sat1', self.task, 'sat1', depends_on=[hub])
+        graph.add_task('sat2', self.task, 'sat2', depends_on=[hub])
+        graph.run(max_workers=1)
+        self.assertEqual(['hub', 'sat1', 'sat2'], self.started)
+
+    def test_parallel_sats_after_hub(self):
+        graph = TaskGraph()
+        hub = graph.add_task('hub', self.task, 'hub', True, 0.01)
+        for i in range(4):
+            graph.add_task('sat{}'.format(i), self.task, 'sat{}'.format(i), True, 0.2, depends_on=[hub])
+        start = time.time()
+        graph.run(max_workers=4)
+        self.assertLess(time.time() - start, 0.6)
+        self.assertEqual('hub', self.started[0])
+        self.assertEqual(TaskGraph.DONE, graph.status['sat3'])
+
+    def test_same_table_is_serialised(self):
+        graph = TaskGraph()
+        graph.add_task('hub_a', self.task, 'hub_a', writes=['dv.patient_hub'])
+        second = graph.add_task('hub_b', self.task, 'hub_b', writes=['dv.patient_hub'])
+        self.assertEqual(['hub_a'], graph.tasks[second]['depends_on'])
+
+    def test_failed_task_skips_dependants(self):
+        graph = TaskGraph()
+        hub = graph.add_task('hub', self.task, 'hub', False)
+        graph.add_task('sat', self.task, 'sat', depends_on=[hub])
+        graph.add_task('other', self.task, 'other')
+        graph.run(max_workers=2)
+        self.assertEqual(TaskGraph.FAILED, graph.status['hub'])
+        self.assertEqual(TaskGraph.SKIPPED, graph.status['sat'])
+        self.assertEqual(TaskGraph.DONE, graph.status['other'])
+        self.assertNotIn('sat', self.started)
+
+
+class TestCase_TableLocks(unittest.TestCase):
+    def test_overlapping_tables_do_not_run_together(self):
+        locks = TableLocks()
+        running = []
+        overlap = []
+
+        def run(tables):
+            with locks.acquire(tables):
+                running.append(1)
+                if len(running) > 1:
+                    overlap.append(1)
+                time.sleep(0.05)
+                running.pop()
+
+        threads = [threading.Thread(target=run, args=(['dv.b', 'dv.a'],)), threading.Thread(target=run, args=(['dv.a', 'dv.c'],))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual([], overlap)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,28 @@
+import datetime
+import unittest
+from decimal import Decimal
+
+from pyelt.helpers.hashing import row_hash, hash_rows
+
+
+class TestCase_Hashing(unittest.TestCase):
+    def test_row_hash_is_vendor_neutral(self):
+        # zelfde waardes uit verschillende drivers geven dezelfde hash
+        self.assertEqual(row_hash([1, 'abc', datetime.date(2017, 1, 31)]), row_hash([Decimal('1.00'), 'abc', datetime.date(2017, 1, 31)]))
+        self.assertEqual(row_hash([1.5]), row_hash([Decimal('1.50')]))
+        self.assertEqual(32, len(row_hash(['abc'])))
+
+    def test_row_hash_differs(self):
+        self.assertNotEqual(row_hash(['a', 'bc']), row_hash(['ab', 'c']))
+        self.assertNotEqual(row_hash([None]), row_hash(['']))
+        self.assertNotEqual(row_hash([1, None]), row_hash([None, 1]))
+
+    def test_hash_rows(self):
+        rows = [('1', 'jan', 'a'), ('2', 'piet', None)]
+        result = list(hash_rows(rows, ['id', 'naam', 'type'], ['id']))
+        self.assertEqual(('1', row_hash(rows[0])), result[0])
+        self.assertEqual(('2', row_hash(rows[1])), result[1])
+
+
+if __name__ == '__main__':
+    unittest.main()
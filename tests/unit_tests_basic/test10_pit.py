@@ -0,0 +1,64 @@
+import unittest
+
+from pyelt.datalayers.database import Columns
+from pyelt.datalayers.dv import HubEntity, Sat
+from pyelt.mappings.sor_to_dv_mappings import EntityViewToEntityMapping
+from pyelt.pipeline import Pipe
+from tests.unit_tests_basic._domainmodel import Patient, Patient_Traject_Link, SubTraject
+
+
+class Opname(HubEntity):
+    """Entity die alleen vanuit een view wordt gevuld en niet in een geregistreerd domein staat"""
+    __pit__ = True
+    __materialize__ = True
+
+    class Default(Sat):
+        afdeling = Columns.TextColumn()
+
+
+class FakeDwh():
+    def get_or_create_sor_schema(self, name):
+        return None
+
+
+class FakePipeline():
+    config = {}
+    domain_modules = {}
+    dwh = FakeDwh()
+
+
+class TestCase_Pit(unittest.TestCase):
+    def test_pit_columns(self):
+        pit = Patient.cls_get_pit()
+        self.assertEqual('patient_pit', pit.cls_get_name())
+        self.assertEqual(['_id', '_runid'], pit.cls_get_key())
+        col_names = [col.name for col in pit.cls_get_columns()]
+        self.assertIn('personalia_runid', col_names)
+        # een hybrid sat krijgt per type een kolom
+        for type in Patient.Contactgegevens.cls_get_types():
+            self.assertIn('contactgegevens_{}_runid'.format(type), col_names)
+        self.assertIs(pit, Patient.cls_get_pit())
+
+    def test_pit_of_sub_entity(self):
+        pit = SubTraject.cls_get_pit()
+        self.assertEqual('subtraject_pit', pit.cls_get_name())
+        self.assertEqual(len(SubTraject.cls_get_sats()), len(pit.__sat_columns__))
+
+    def test_bridge_columns(self):
+        bridge = Patient_Traject_Link.cls_get_bridge()
+        self.assertEqual('patient_traject_bridge', bridge.cls_get_name())
+        col_names = [col.name for col in bridge.cls_get_columns()]
+        for link_ref in Patient_Traject_Link.Link.cls_get_link_refs().values():
+            self.assertIn(link_ref.fk, col_names)
+        self.assertIn('default_runid', col_names)
+
+    def test_dv_table_names_of_view_mapping(self):
+        pipe = Pipe('test', FakePipeline(), {'sor_schema': 'sor_test'})
+        pipe.mappings.append(EntityViewToEntityMapping('opname_view', Opname))
+        table_names = pipe.get_dv_table_names()
+        for table_name in ['opname_hub', 'opname_sat', 'opname_pit', 'opname_view']:
+            self.assertIn('dv.' + table_name, table_names)
+
+
+if __name__ == '__main__':
+    unittest.main()
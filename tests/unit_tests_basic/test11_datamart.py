@@ -0,0 +1,68 @@
+import unittest
+
+from pyelt.datalayers.database import Columns
+from pyelt.datalayers.dm import Dim, Scd2Dim, Fact
+from pyelt.mappings.dv_to_datamart_mappings import DvToFactMapping
+from pyelt.process.etl import EtlDvToDatamart, copy_text_value
+from tests.unit_tests_basic._domainmodel import Patient, Patient_Traject_Link
+
+
+class DimPatient(Scd2Dim):
+    bk = Columns.TextColumn()
+    achternaam = Columns.TextColumn()
+    _lookup_fields = [bk]
+
+
+class FactBehandeling(Fact):
+    patient_id = Columns.IntColumn()
+    aantal = Columns.IntColumn()
+    _partition_fields = [patient_id]
+    __dbschema__ = 'dm'
+
+
+class TestCase_Datamart(unittest.TestCase):
+    def test_scd2_dim_columns(self):
+        self.assertEqual(2, DimPatient.__scd_type__)
+        self.assertEqual(1, Dim.__scd_type__)
+        self.assertEqual(['_version', '_valid_from', '_valid_to', 'bk', 'achternaam'], DimPatient.cls_get_column_names_no_id())
+        self.assertEqual(['patient_id'], FactBehandeling.cls_get_partition_fields())
+
+    def test_copy_text_value(self):
+        self.assertEqual('\\N', copy_text_value(None))
+        self.assertEqual('a\\tb\\nc\\\\', copy_text_value('a\tb\nc\\'))
+        self.assertEqual('t', copy_text_value(True))
+
+    def test_delta_source_sql(self):
+        etl = object.__new__(EtlDvToDatamart)
+        etl.dwh = None
+        mapping = DvToFactMapping('SELECT hub._id AS patient_id, 1 AS aantal FROM dv.patient_hub hub;', FactBehandeling)
+        etl.last_runid = None
+        self.assertEqual(mapping.source, etl.get_source_sql(mapping))
+
+        mapping.track_changes('patient_id', Patient)
+        mapping.track_changes('link_id', Patient_Traject_Link)
+        etl.last_runid = '12.01'
+        sql = etl.get_source_sql(mapping)
+        self.assertIn('src.patient_id IN (SELECT _id FROM dv.patient_hub WHERE _runid > 12.01', sql)
+        self.assertIn('UNION SELECT _id FROM dv.patient_sat_personalia WHERE _runid > 12.01', sql)
+        self.assertIn('OR src.link_id IN', sql)
+        self.assertNotIn(';', sql)
+
+    def test_changed_partitions_sql(self):
+        etl = object.__new__(EtlDvToDatamart)
+        etl.dwh = None
+        etl.last_runid = '12.01'
+        mapping = DvToFactMapping('SELECT hub._id AS patient_id, 1 AS aantal FROM dv.patient_hub hub;', FactBehandeling)
+        mapping.track_changes('patient_id', Patient)
+        sql = etl._EtlDvToDatamart__get_changed_partitions_sql(mapping, ['patient_id'])
+        # ook de partities waarin de fact nu rijen van de gewijzigde patienten heeft
+        self.assertIn('SELECT DISTINCT src.patient_id AS patient_id FROM', sql)
+        self.assertIn('UNION SELECT DISTINCT fact.patient_id FROM dm.{} fact WHERE fact.patient_id IN (SELECT _id FROM dv.patient_hub'.format(FactBehandeling.cls_get_name()), sql)
+
+        # link_id staat niet in de fact: dan is niet te bepalen welke partities weg moeten
+        mapping.track_changes('link_id', Patient_Traject_Link)
+        self.assertEqual('', etl._EtlDvToDatamart__get_changed_partitions_sql(mapping, ['patient_id']))
+
+
+if __name__ == '__main__':
+    unittest.main()
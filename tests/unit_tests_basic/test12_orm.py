@@ -0,0 +1,173 @@
+import unittest
+from contextlib import contextmanager
+
+from pyelt.helpers.exceptions import PyeltException
+from pyelt.orm.base_controller import Controller
+from pyelt.orm.dv_objects import DBStatus, DbSession, LruCache, get_row_class, insert_hub_row, save_sat_rows, statement_name
+from tests.unit_tests_basic._domainmodel import Patient
+
+
+class Patienten(Controller):
+    entity_cls = Patient
+
+
+class FakeSchema():
+    name = 'dv'
+
+
+class FakeDwh():
+    """Geeft per hub- of sat-query vaste rijen terug en onthoudt de queries"""
+    dv = FakeSchema()
+
+    def __init__(self, hub_rows, hash_keys=False):
+        self.hub_rows = hub_rows
+        self.hash_keys = hash_keys
+        self.queries = []
+
+    def use_hash_keys(self):
+        return self.hash_keys
+
+    def execute_read(self, sql, log_message=''):
+        self.queries.append(sql)
+        if '_hub' in sql:
+            return [row for row in self.hub_rows if '_id > ' not in sql or row['_id'] > int(sql.split('_id > ')[1].split(' ')[0])][:2]
+        if 'personalia' in sql:
+            return [{'_id': 1, '_runid': 1.0, 'achternaam': 'Jansen'}]
+        return []
+
+    @contextmanager
+    def transaction(self):
+        yield
+
+    def execute(self, sql, log_message=''):
+        self.queries.append(sql)
+
+    def execute_values(self, sql, rows, log_message=''):
+        self.queries.append((sql, rows))
+        return len(rows)
+
+    def execute_prepared(self, name, sql, params=(), log_message=''):
+        self.queries.append((name, sql, params))
+        if 'personalia' in sql:
+            return [{'_id': 1, '_runid': 1.0, 'achternaam': 'Jansen'}]
+        return []
+
+    def execute_returning(self, sql, log_message=''):
+        self.queries.append(sql)
+        if '_hub' in sql:
+            return [(10 + index, row[0]) for index, row in enumerate(self.queries[-2][1])]
+        return []
+
+
+class TestCase_Orm(unittest.TestCase):
+    def test_eager_load(self):
+        dwh = FakeDwh([{'_id': id, 'bk': str(id)} for id in range(1, 6)])
+        patienten = Patienten(dwh)
+        patients = patienten.load(sats=['personalia'], chunk_size=2)
+        self.assertEqual([1, 2, 3, 4, 5], [patient._id for patient in patients])
+        # per chunk van 2 één hub-query en één sat-query; na de onvolledige laatste chunk stopt het laden
+        self.assertEqual(6, len(dwh.queries))
+        self.assertEqual(([1, 2], ), dwh.queries[1][2])
+        self.assertEqual('Jansen', patients[0].personalia.achternaam)
+        self.assertEqual(DBStatus.loaded, patients[0].personalia.dbstatus)
+        self.assertEqual(DBStatus.new, patients[1].personalia.dbstatus)
+
+    def test_eager_load_hybrid_sat(self):
+        dwh = FakeDwh([{'_id': 1, 'bk': '1'}])
+        patienten = Patienten(dwh)
+        # een HybridSat heeft per _id een rij per type: niet vooraf laden
+        patienten.load()
+        self.assertFalse([query for query in dwh.queries if 'contactgegevens' in str(query)])
+        with self.assertRaises(PyeltException):
+            patienten.load(sats=['contactgegevens'])
+
+    def test_save_hybrid_sat_rows(self):
+        dwh = FakeDwh([])
+        rows = [{'_id': 1, '_runid': 2.0, '_source_system': 'sys', 'type': 'telefoon', 'telnummer': '1'},
+                {'_id': 1, '_runid': 2.0, '_source_system': 'sys', 'type': 'mobiel', 'telnummer': '2'}]
+        save_sat_rows(dwh, 'dv', 'patient_sat_contactgegevens', rows, hybrid=True)
+        # per _id en type een rij; alleen de actieve rij van hetzelfde type wordt afgesloten
+        self.assertEqual(2, len(dwh.queries[1][1]))
+        self.assertIn('current.type = stage.type', dwh.queries[2])
+        self.assertIn('sat.type = changed.type', dwh.queries[2])
+        with self.assertRaises(PyeltException):
+            save_sat_rows(dwh, 'dv', 'patient_sat_contactgegevens', [{'_id': 1, '_runid': 2.0, '_source_system': 'sys'}], hybrid=True)
+
+    def test_bulk_save(self):
+        dwh = FakeDwh([])
+        patienten = Patienten(dwh)
+        patients = []
+        for index in range(3):
+            patient = patienten.new(bk='bk{}'.format(index), runid=2.0)
+            patient.personalia.achternaam = 'Jansen{}'.format(index)
+            patients.append(patient)
+        patienten.save(patients)
+        self.assertEqual([10, 11, 12], [patient._id for patient in patients])
+        # hub en één sat: elk een tijdelijke tabel, één execute_values en één insert; niet per entity
+        self.assertEqual(6, len(dwh.queries))
+        sql, rows = dwh.queries[4]
+        self.assertIn('patient_sat_personalia_orm_stage', sql)
+        self.assertEqual([(10, 2.0, 'sys', 'Jansen0'), (11, 2.0, 'sys', 'Jansen1'), (12, 2.0, 'sys', 'Jansen2')], rows)
+        self.assertEqual(DBStatus.loaded, patients[0].dbstatus)
+
+    def test_slotted_rows(self):
+        row_cls = get_row_class('patient_sat_personalia', ['_id', '_runid', 'achternaam'])
+        self.assertIs(row_cls, get_row_class('patient_sat_personalia', ('_id', '_runid', 'achternaam')))
+        row = row_cls(1, 2.0, 'Jansen', db_status=DBStatus.loaded)
+        self.assertFalse(hasattr(row, '__dict__'))
+        self.assertEqual('Jansen', row.achternaam)
+        self.assertEqual(DBStatus.loaded, row.db_status)
+        self.assertEqual({'_id': 1, '_runid': 2.0, 'achternaam': 'Jansen', 'db_status': DBStatus.loaded}, dict(row.as_dict()))
+        self.assertIsNone(row_cls(1).achternaam)
+
+    def test_prepared_statements(self):
+        dwh = FakeDwh([])
+        insert_hub_row(dwh, 'dv', 'patient_hub', {'_runid': 1.0, '_source_system': 'sys', 'type': 'patient', 'bk': "o'brien"})
+        name, sql, params = dwh.queries[0]
+        self.assertEqual('orm_insert_dv_patient_hub', name)
+        # de bk gaat als parameter mee, niet in de sql
+        self.assertNotIn("o'brien", sql)
+        self.assertEqual((1.0, 'sys', 'patient', "o'brien"), params)
+        # bij hash keys heeft de hub geen serial: de _id wordt in de insert uit de bk berekend
+        dwh = FakeDwh([], hash_keys=True)
+        insert_hub_row(dwh, 'dv', 'patient_hub', {'_runid': 1.0, '_source_system': 'sys', 'type': 'patient', 'bk': "o'brien"})
+        self.assertIn('(_id, _runid', dwh.queries[0][1])
+        self.assertIn('md5(($4)::text)', dwh.queries[0][1])
+        self.assertNotEqual(statement_name('insert', 'dv', 'patient_sat', ['a']), statement_name('insert', 'dv', 'patient_sat', ['a', 'b']))
+        self.assertLessEqual(len(statement_name('insert', 'dv', 'x' * 100)), 63)
+
+    def test_lru_cache(self):
+        cache = LruCache(2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)
+        # b is het langst niet gebruikt
+        self.assertNotIn('b', cache)
+        self.assertEqual(1, cache.get('a'))
+        self.assertEqual(2, len(cache))
+
+    def test_identity_map(self):
+        session = object.__new__(DbSession)
+        session.init_cache(100)
+        dwh = FakeDwh([{'_id': 1, 'bk': '1'}])
+        patienten = Patienten(dwh)
+        patienten.session = session
+        patienten.load(sats=['personalia'])
+        patienten.load(sats=['personalia'])
+        # de tweede keer komt de sat-rij uit de identity map: alleen nog de hub-query
+        self.assertEqual(3, len(dwh.queries))
+        session.invalidate('patient_sat_personalia', [1])
+        self.assertIsNone(session.get_row('patient_sat_personalia', 1))
+        # een rij die SatData in de identity map heeft gezet kan de controller ook gebruiken
+        row_cls = get_row_class('patient_sat_personalia', ['_id', '_runid', '_revision', 'achternaam'])
+        session.add_rows('patient_sat_personalia', [row_cls(1, 2.0, 1, 'Pietersen', db_status=DBStatus.loaded)])
+        patient = patienten.load(sats=['personalia'])[0]
+        self.assertEqual('Pietersen', patient.personalia.achternaam)
+        self.assertNotIn('db_status', patient.personalia.__dict__)
+        session.set_hub_ids('patient_hub', {'1': 1})
+        self.assertEqual(1, session.get_hub_id('patient_hub', '1'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,68 @@
+import unittest
+
+from pyelt.datalayers.database import Catalog, Schema
+
+
+class FakeDb():
+    """Geeft vaste catalog-rijen terug voor de tabellen patient_hub en patient_sat in schema dv, en onthoudt de queries"""
+
+    def __init__(self):
+        self.queries = []
+
+    def execute_read(self, sql, log_message='', params=None):
+        self.queries.append((log_message, params))
+        if log_message.startswith('catalog functions'):
+            return []
+        names = params['names'] or ['patient_hub', 'patient_sat']
+        if log_message.startswith('catalog relations'):
+            return [{'name': name, 'kind': 'r', 'definition': None} for name in names]
+        if log_message.startswith('catalog columns'):
+            return [{'table_name': name, 'name': col_name, 'type': 'integer'} for name in names for col_name in ['_id', 'bk']]
+        if log_message.startswith('catalog indexes'):
+            return [{'table_name': name, 'name': 'ix_{}_bk'.format(name)} for name in names]
+        if log_message.startswith('catalog constraints'):
+            return [{'table_name': name, 'name': '{}_pk'.format(name), 'type': 'p', 'column_names': ['_id']} for name in names]
+
+
+class TestCase_Catalog(unittest.TestCase):
+    def setUp(self):
+        self.db = FakeDb()
+        self.db.catalog = Catalog(self.db)
+
+    def test_reflect(self):
+        dv = Schema('dv', self.db)
+        dv.reflect()
+        # per schema één query voor relaties, kolommen, indexen, constraints en functies
+        self.assertEqual(5, len(self.db.queries))
+        self.assertIn('patient_hub', dv)
+        tbl = dv.tables['patient_hub']
+        self.assertEqual(['_id'], tbl.key_names)
+        self.assertIn('bk', tbl)
+        self.assertIn('ix_patient_hub_bk', tbl)
+        self.assertNotIn('achternaam', tbl)
+
+    def test_invalidate_sql(self):
+        dv = Schema('dv', self.db)
+        dv.reflect()
+        hub, sat = dv.tables['patient_hub'], dv.tables['patient_sat']
+        self.db.catalog.invalidate_sql('CREATE TEMP TABLE patient_sat_stage (bk text) ON COMMIT DROP;')
+        self.db.catalog.invalidate_sql('ALTER TABLE dv.patient_sat ADD COLUMN achternaam text, DROP COLUMN x;')
+        dv.reflect()
+        # alleen patient_sat wordt opnieuw opgehaald, zonder functies
+        self.assertEqual(['patient_sat'], self.db.queries[5][1]['names'])
+        self.assertEqual(9, len(self.db.queries))
+        self.assertIs(hub, dv.tables['patient_hub'])
+        self.assertIsNot(sat, dv.tables['patient_sat'])
+
+        self.db.catalog.invalidate_sql('DROP INDEX dv.ix_patient_hub_bk;')
+        dv.reflect()
+        self.assertEqual(['patient_hub'], self.db.queries[9][1]['names'])
+
+        # onbekende ddl maakt alles ongeldig
+        self.db.catalog.invalidate_sql('CREATE POLICY p ON dv.patient_hub USING (true);')
+        dv.reflect()
+        self.assertEqual([], self.db.queries[13][1]['names'])
+
+
+if __name__ == '__main__':
+    unittest.main()